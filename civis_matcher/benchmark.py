@@ -0,0 +1,392 @@
+''' Latency, throughput and memory benchmarks for the matchers, run against
+local fakes of Civis, S3 and memcached. Results are written as JSON so runs
+from different versions can be compared:
+
+    python -m civis_matcher.benchmark --output before.json
+    python -m civis_matcher.benchmark --output after.json --compare before.json
+'''
+import argparse
+import cPickle as pickle
+import json
+import platform
+import resource
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from requests.exceptions import RequestException
+
+from civis_matcher import columnar, fakes, matcher, serialization
+
+
+def _person(i):
+    return {'first_name': 'Test', 'last_name': 'User%s' % i, 'state': 'IL'}
+
+
+def _people(start, size):
+    return dict(('%s' % i, _person(i)) for i in xrange(start, start + size))
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def deep_size(obj, seen=None):
+    ''' Approximate number of bytes used by obj and everything it refers
+    to, counting shared objects once
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, type):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            size += deep_size(getattr(obj, name, None), seen)
+    return size
+
+
+class LegacyPerson(matcher.Struct):
+    pass
+
+
+class LegacyMatchResult(matcher.Struct):
+    ''' MatchResult as it was before results were made compact, kept to
+    compare memory use against
+    '''
+
+    def __init__(self, **entries):
+        self.__dict__.update(entries)
+        self.url = ''
+        self.people = [LegacyPerson(**person) for person in self.people or []]
+
+
+def measure(func, iterations, items_per_call=1):
+    ''' Calls ``func(i)`` for each iteration, returning latency statistics,
+    throughput, the number of failed calls and the peak memory use of the
+    process so far
+    '''
+    latencies = []
+    errors = 0
+    start = time.time()
+    for i in xrange(iterations):
+        call_start = time.time()
+        try:
+            func(i)
+        except (matcher.MatchException, RequestException):
+            errors += 1
+        latencies.append(time.time() - call_start)
+
+    elapsed = time.time() - start
+    return {
+        'iterations': iterations,
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': iterations / elapsed if elapsed else 0,
+        'items_per_second': (
+            iterations * items_per_call / elapsed if elapsed else 0
+        ),
+        'latency': matcher.summarize_latencies(latencies),
+        'max_rss_kb': _max_rss_kb(),
+    }
+
+
+def single_match(server, options):
+    cm = matcher.CivisMatcher(base_url=server.url)
+    return measure(
+        lambda i: cm.match('Test', 'User%s' % i), options.iterations
+    )
+
+
+def bulk_match(server, options):
+    cm = matcher.CivisMatcher(base_url=server.url)
+    size = options.bulk_size
+    return measure(
+        lambda i: cm.bulk_match({'people': _people(i * size, size)}),
+        options.iterations, size
+    )
+
+
+def cache_cold(server, options):
+    cm = matcher.CivisMatcher(
+        base_url=server.url,
+        cache_tiers=[fakes.FakeMemcache(options.cache_latency)]
+    )
+    return measure(
+        lambda i: cm.match('Test', 'User%s' % i), options.iterations
+    )
+
+
+def cache_hot(server, options):
+    cm = matcher.CivisMatcher(
+        base_url=server.url,
+        cache_tiers=[fakes.FakeMemcache(options.cache_latency)]
+    )
+    cm.match('Test', 'User')
+    return measure(lambda i: cm.match('Test', 'User'), options.iterations)
+
+
+def _stored_batches(options):
+    size = options.bulk_size
+    return [
+        dict(
+            (fbid, fakes.fake_result(person, options.people_count))
+            for fbid, person in _people(i * size, size).items()
+        )
+        for i in xrange(options.iterations)
+    ]
+
+
+def s3_write(server, options):
+    cm = matcher.S3CivisMatcher(
+        None, None, bucket=fakes.FakeBucket(options.s3_latency),
+        base_url=server.url
+    )
+    batches = _stored_batches(options)
+    return measure(
+        lambda i: cm._store_match_results(batches[i]),
+        options.iterations, options.bulk_size
+    )
+
+
+def s3_read(server, options):
+    bucket = fakes.FakeBucket(options.s3_latency)
+    cm = matcher.S3CivisMatcher(None, None, bucket=bucket,
+                                base_url=server.url)
+    batches = _stored_batches(options)
+    for batch in batches:
+        for fbid, result in batch.items():
+            bucket.objects[fbid] = json.dumps(result)
+    return measure(
+        lambda i: cm.cache_match(batches[i].keys()),
+        options.iterations, options.bulk_size
+    )
+
+
+def result_memory(server, options):
+    ''' Times building MatchResults, and compares their size with the legacy
+    classes before and after their people are accessed
+    '''
+    raw = [
+        fakes.fake_result(_person(i), options.people_count)['result']
+        for i in xrange(options.bulk_size)
+    ]
+    result = measure(
+        lambda i: [matcher.MatchResult(**entry) for entry in raw],
+        options.iterations, options.bulk_size
+    )
+    count = float(len(raw))
+    legacy = [LegacyMatchResult(**entry) for entry in raw]
+    compact = [matcher.MatchResult(**entry) for entry in raw]
+    result['legacy_bytes_per_result'] = deep_size(legacy) / count
+    result['compact_bytes_per_result'] = deep_size(compact) / count
+    for match_result in compact:
+        match_result.people
+    result['compact_materialized_bytes_per_result'] = (
+        deep_size(compact) / count
+    )
+    return result
+
+
+def _time_per_entry(func, values):
+    start = time.time()
+    for value in values:
+        func(value)
+    return (time.time() - start) / len(values)
+
+
+def serialized_size(server, options):
+    ''' Times encoding and decoding results with the default serializer, and
+    compares bytes per entry and encode/decode time with the formats used
+    before: pickle in memcached and plain JSON in S3
+    '''
+    raw = [
+        fakes.fake_result(_person(i), options.people_count)
+        for i in xrange(options.bulk_size)
+    ]
+    serializer = serialization.DEFAULT_SERIALIZER
+    result = measure(
+        lambda i: [serializer.loads(serializer.dumps(entry))
+                   for entry in raw],
+        options.iterations, options.bulk_size
+    )
+    formats = OrderedDict([
+        ('pickle', (lambda data: pickle.dumps(data, -1), pickle.loads)),
+        ('json', (json.dumps, json.loads)),
+        ('compressed', (serializer.dumps, serializer.loads)),
+    ])
+    result['formats'] = {}
+    for name, (dumps, loads) in formats.items():
+        encoded = [dumps(entry) for entry in raw]
+        result['formats'][name] = {
+            'bytes_per_entry': sum(map(len, encoded)) / float(len(encoded)),
+            'encode_seconds': _time_per_entry(dumps, raw),
+            'decode_seconds': _time_per_entry(loads, encoded),
+        }
+    return result
+
+
+def _loop_aggregate(results):
+    ''' Per score mean and max, computed the way reports did before
+    columnar exports
+    '''
+    totals = {}
+    for result in results.values():
+        for person in result.people:
+            for name, value in (person.scores or {}).items():
+                count, total, highest = totals.get(name, (0, 0.0, value))
+                totals[name] = (count + 1, total + value, max(highest, value))
+    return dict(
+        (name, (total / count, highest))
+        for name, (count, total, highest) in totals.items()
+    )
+
+
+def score_aggregation(server, options):
+    ''' Times summarizing the scores of bulk results through a columnar
+    export, and compares it with looping over each result's people
+    '''
+    def results():
+        return dict(
+            ('%s' % i, matcher.MatchResult(**fakes.fake_result(
+                _person(i), options.people_count
+            )['result']))
+            for i in xrange(options.bulk_size)
+        )
+
+    batches = [results() for _ in xrange(options.iterations)]
+    result = measure(
+        lambda i: columnar.to_columns(batches[i]).summarize(),
+        options.iterations, options.bulk_size
+    )
+    result['numpy'] = columnar.numpy is not None
+    # Each run gets fresh results, as looping builds their Person objects
+    loop_results, columnar_results = results(), results()
+    start = time.time()
+    _loop_aggregate(loop_results)
+    result['loop_seconds'] = time.time() - start
+    start = time.time()
+    columnar.to_columns(columnar_results).summarize()
+    result['columnar_seconds'] = time.time() - start
+    return result
+
+
+SCENARIOS = OrderedDict([
+    ('single_match', single_match),
+    ('bulk_match', bulk_match),
+    ('cache_cold', cache_cold),
+    ('cache_hot', cache_hot),
+    ('s3_write', s3_write),
+    ('s3_read', s3_read),
+    ('result_memory', result_memory),
+    ('serialized_size', serialized_size),
+    ('score_aggregation', score_aggregation),
+])
+
+
+def run(options):
+    ''' Runs the selected scenarios against a fresh fake Civis server '''
+    scenarios = OrderedDict()
+    with fakes.FakeCivisServer(latency=options.latency,
+                               error_rate=options.error_rate,
+                               people_count=options.people_count) as server:
+        for name in options.scenarios or SCENARIOS.keys():
+            scenarios[name] = SCENARIOS[name](server, options)
+
+    return {
+        'label': options.label,
+        'timestamp': datetime.now().strftime(matcher.TIME_FORMAT),
+        'python': platform.python_version(),
+        'options': dict(
+            (k, v) for k, v in vars(options).items()
+            if k not in ('output', 'compare')
+        ),
+        'scenarios': scenarios,
+    }
+
+
+def _change(before, after):
+    if not before:
+        return 'n/a'
+    return '%+.1f%%' % ((after - before) * 100.0 / before)
+
+
+def compare(baseline, current):
+    ''' Returns lines comparing the p50/p99 latency and throughput of each
+    scenario present in both runs
+    '''
+    lines = []
+    for name, result in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if not before or not result['latency'].get('count'):
+            continue
+        lines.append('%-14s p50 %8s  p99 %8s  req/s %8s' % (
+            name,
+            _change(before['latency'].get('p50'), result['latency']['p50']),
+            _change(before['latency'].get('p99'), result['latency']['p99']),
+            _change(before['requests_per_second'],
+                    result['requests_per_second']),
+        ))
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', dest='scenarios', action='append',
+                        choices=SCENARIOS.keys(),
+                        help='Scenario to run, may be repeated (default: all)')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--bulk-size', type=int, default=50,
+                        help='People per bulk request or S3 batch')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to each fake Civis request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of fake Civis requests that fail')
+    parser.add_argument('--people-count', type=int, default=1,
+                        help='People returned per match (payload size)')
+    parser.add_argument('--cache-latency', type=float, default=0)
+    parser.add_argument('--s3-latency', type=float, default=0)
+    parser.add_argument('--label', default='',
+                        help='Free text recorded with the results')
+    parser.add_argument('--output', help='File to write JSON results to')
+    parser.add_argument('--compare', help='Earlier results to compare with')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = run(options)
+    for name, result in results['scenarios'].items():
+        latency = result['latency']
+        print '%-14s p50 %8.2fms  p99 %8.2fms  %10.1f req/s  %s errors' % (
+            name,
+            latency.get('p50', 0) * 1000,
+            latency.get('p99', 0) * 1000,
+            result['requests_per_second'],
+            result['errors'],
+        )
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            for line in compare(json.load(baseline), results):
+                print line
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
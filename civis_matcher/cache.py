@@ -0,0 +1,522 @@
+import hashlib
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+
+
+logger = logging.getLogger(__name__)
+
+
+# Bump whenever the shape of cached values changes so old entries are ignored
+CACHE_KEY_VERSION = 1
+
+
+class CacheKeyBuilder(object):
+    ''' Derives cache keys for Civis requests. The same builder is used when
+    reading from and writing to the cache, so a person always maps to the
+    same key regardless of field order, case or stray whitespace.
+    '''
+
+    def __init__(self, namespace='civis', version=CACHE_KEY_VERSION):
+        self.namespace = namespace
+        self.version = version
+
+    def normalize(self, params):
+        ''' Returns the params as a sorted list of (field, value) pairs with
+        field names and values lowercased, whitespace collapsed and empty
+        values dropped.
+        '''
+        items = []
+        for field, value in params.items():
+            if value is None:
+                continue
+            if not isinstance(value, basestring):
+                value = '%s' % value
+            value = ' '.join(value.split()).lower()
+            if not value:
+                continue
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            items.append((field.strip().lower(), value))
+
+        return sorted(items)
+
+    def key(self, url, params):
+        digest = hashlib.md5(
+            '%s?%s' % (url, urlencode(self.normalize(params)))
+        ).hexdigest()
+        return '%s:v%s:%s' % (self.namespace, self.version, digest)
+
+    def negative(self, key):
+        ''' Key for the negative (no match) entry of the given key '''
+        return '%s:none' % key
+
+
+class LockedClient(object):
+    ''' Serializes access to a memcached client, which isn't safe to share
+    between threads.
+    '''
+    name = 'memcached'
+
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self.client.get(key)
+
+    def get_multi(self, keys):
+        with self._lock:
+            return self.client.get_multi(keys)
+
+    def set(self, key, value, time=0):
+        with self._lock:
+            return self.client.set(key, value, time=time)
+
+    def set_multi(self, mapping, time=0):
+        with self._lock:
+            return self.client.set_multi(mapping, time=time)
+
+    def delete(self, key):
+        with self._lock:
+            return self.client.delete(key)
+
+
+class SerializingClient(object):
+    ''' Encodes values with ``serializer`` as they're written to a cache
+    client, and decodes them as they're read back. Entries written in older
+    formats are still read.
+    '''
+
+    def __init__(self, client, serializer):
+        self.client = client
+        self.serializer = serializer
+        self.name = getattr(client, 'name', client.__class__.__name__)
+
+    def get(self, key):
+        return self.serializer.loads(self.client.get(key))
+
+    def get_multi(self, keys):
+        return dict(
+            (key, self.serializer.loads(value))
+            for key, value in self.client.get_multi(keys).iteritems()
+        )
+
+    def set(self, key, value, time=0):
+        return self.client.set(key, self.serializer.dumps(value), time=time)
+
+    def set_multi(self, mapping, time=0):
+        return self.client.set_multi(dict(
+            (key, self.serializer.dumps(value))
+            for key, value in mapping.iteritems()
+        ), time=time)
+
+    def delete(self, key):
+        return self.client.delete(key)
+
+
+class CacheStats(object):
+    ''' Thread safe hit/miss/set counters for a cache '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.negative_hits = 0
+
+    def record(self, hits=0, misses=0, sets=0, negative_hits=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.sets += sets
+            self.negative_hits += negative_hits
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'negative_hits': self.negative_hits,
+            'hit_rate': self.hit_rate,
+        }
+
+
+def _now():
+    return time.time()
+
+
+def _pair_names(pairs):
+    return [name for pair in pairs for name in pair if name is not None]
+
+
+def first_found(hits, pairs):
+    ''' For each (key, fallback) pair, picks the value of key from a dict of
+    hits, or failing that the value of fallback, which may be None. Returns
+    the values found by key and the set of keys whose value came from their
+    fallback.
+    '''
+    found = {}
+    fallbacks = set()
+    for key, fallback in pairs:
+        if hits.get(key):
+            found[key] = hits[key]
+        elif fallback is not None and hits.get(fallback):
+            found[key] = hits[fallback]
+            fallbacks.add(key)
+    return found, fallbacks
+
+
+def get_first(client, pairs):
+    ''' Looks up a list of (key, fallback) pairs in a single get_multi, as
+    described for first_found
+    '''
+    return first_found(client.get_multi(_pair_names(pairs)), pairs)
+
+
+class LocalCache(object):
+    ''' Bounded, thread safe, in-process LRU cache with a TTL. Values are
+    stored as-is rather than copied, so callers should treat them as read
+    only.
+    '''
+    name = 'local'
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, key, now):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < now:
+            self.expirations += 1
+            return None
+        # Re-inserting moves the key to the most recently used end
+        self._data[key] = entry
+        return value
+
+    def _set(self, key, value, ttl, now):
+        self._data.pop(key, None)
+        self._data[key] = (now + ttl, value)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _ttl(self, time):
+        return min(time, self.ttl) if time else self.ttl
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, _now())
+
+    def get_multi(self, keys):
+        now = _now()
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    found[key] = value
+        return found
+
+    def set(self, key, value, time=0):
+        ttl = self._ttl(time)
+        with self._lock:
+            self._set(key, value, ttl, _now())
+
+    def set_multi(self, mapping, time=0):
+        ttl = self._ttl(time)
+        now = _now()
+        with self._lock:
+            for key, value in mapping.iteritems():
+                self._set(key, value, ttl, now)
+        return []
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class TieredCache(object):
+    ''' Stack of caches checked in order, fastest first, such as a
+    LocalCache in front of memcached. A hit in a lower tier is copied into
+    the tiers above it. With ``write_through`` sets go to every tier,
+    otherwise only to the last one, leaving the upper tiers to be filled as
+    entries are read.
+
+    Tiers need get/get_multi/set/set_multi/delete methods like a pylibmc
+    client, and may provide a stats() method.
+    '''
+
+    def __init__(self, tiers, write_through=True):
+        self.tiers = tiers
+        self.write_through = write_through
+        self.tier_stats = [CacheStats() for _ in tiers]
+
+    def _write_tiers(self):
+        return self.tiers if self.write_through else self.tiers[-1:]
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is None:
+                self.tier_stats[i].record(misses=1)
+                continue
+
+            self.tier_stats[i].record(hits=1)
+            for upper in self.tiers[:i]:
+                upper.set(key, value)
+            return value
+
+        return None
+
+    def get_multi(self, keys):
+        found = {}
+        remaining = list(keys)
+        for i, tier in enumerate(self.tiers):
+            if not remaining:
+                break
+
+            hits = tier.get_multi(remaining)
+            self.tier_stats[i].record(
+                hits=len(hits), misses=len(remaining) - len(hits)
+            )
+            if hits:
+                for upper in self.tiers[:i]:
+                    upper.set_multi(hits)
+                found.update(hits)
+                remaining = [key for key in remaining if key not in hits]
+
+        return found
+
+    def get_first(self, pairs):
+        ''' Same as the get_first function, with both keys of a pair looked
+        up in the same request to each tier. Pairs found in a tier aren't
+        looked up in the tiers below it.
+        '''
+        found = {}
+        fallbacks = set()
+        remaining = list(pairs)
+        for i, tier in enumerate(self.tiers):
+            if not remaining:
+                break
+
+            hits = tier.get_multi(_pair_names(remaining))
+            tier_found, tier_fallbacks = first_found(hits, remaining)
+            self.tier_stats[i].record(
+                hits=len(tier_found), misses=len(remaining) - len(tier_found)
+            )
+            if hits:
+                for upper in self.tiers[:i]:
+                    upper.set_multi(hits)
+                found.update(tier_found)
+                fallbacks.update(tier_fallbacks)
+                remaining = [
+                    pair for pair in remaining if pair[0] not in tier_found
+                ]
+
+        return found, fallbacks
+
+    def set(self, key, value, time=0):
+        for tier in self._write_tiers():
+            tier.set(key, value, time=time)
+
+    def set_multi(self, mapping, time=0):
+        for tier in self._write_tiers():
+            tier.set_multi(mapping, time=time)
+        return []
+
+    def delete(self, key):
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def discard(self, keys):
+        ''' Drops keys from every tier above the last, so they're next read
+        from the backing tier
+        '''
+        for tier in self.tiers[:-1]:
+            for key in keys:
+                tier.delete(key)
+
+    def stats(self):
+        ''' Per tier hit rates, plus any stats the tier itself reports '''
+        tier_stats = []
+        for tier, counters in zip(self.tiers, self.tier_stats):
+            stats = counters.as_dict()
+            stats['name'] = getattr(tier, 'name', tier.__class__.__name__)
+            if hasattr(tier, 'stats'):
+                stats.update(tier.stats())
+            tier_stats.append(stats)
+        return tier_stats
+
+
+class _Call(object):
+    ''' A single in-flight call that other threads can wait on '''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        self.event.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class SingleFlight(object):
+    ''' Coalesces identical concurrent calls. The first caller for a key
+    makes the call and every caller that arrives while it's in flight waits
+    for and shares its result, or its exception.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def begin(self, key):
+        ''' Returns the in-flight call for key and whether the caller is
+        responsible for making it, in which case it must call finish()
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+
+            call = self._calls[key] = _Call()
+            self.leaders += 1
+            return call, True
+
+    def finish(self, key, call, result=None, exc_info=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        call.result = result
+        call.exc_info = exc_info
+        call.event.set()
+
+    def do(self, key, func, *args, **kwargs):
+        call, leader = self.begin(key)
+        if not leader:
+            return call.wait()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.finish(key, call, exc_info=sys.exc_info())
+            raise
+        self.finish(key, call, result=result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._calls)
+        return {
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'in_flight': in_flight,
+        }
+
+
+class BackgroundRefresher(object):
+    ''' Refreshes cache entries past their soft expiry on a pool of
+    ``workers`` threads, so callers can be served the cached value straight
+    away. ``refresh_func`` is called with a dict of key -> whatever is needed
+    to refresh it. Keys scheduled close together are refreshed in batches of
+    up to ``batch_size``, and keys already queued or being refreshed are
+    skipped.
+    '''
+
+    def __init__(self, refresh_func, workers=2, batch_size=100):
+        self.refresh_func = refresh_func
+        self.batch_size = batch_size
+        self.pool = ThreadPool(workers)
+        self._lock = threading.Lock()
+        self._queued = OrderedDict()
+        self._pending = set()
+        self.scheduled = 0
+        self.refreshed = 0
+        self.failed = 0
+
+    def schedule(self, items):
+        with self._lock:
+            items = dict(
+                (key, value) for key, value in items.iteritems()
+                if key not in self._pending
+            )
+            self._pending.update(items)
+            self._queued.update(items)
+            self.scheduled += len(items)
+        if items:
+            self.pool.apply_async(self._drain)
+        return len(items)
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._queued:
+                    return
+                keys = list(islice(self._queued, self.batch_size))
+                batch = dict((key, self._queued.pop(key)) for key in keys)
+            self._refresh(batch)
+
+    def _refresh(self, batch):
+        try:
+            self.refresh_func(batch)
+        except Exception as e:
+            logger.error('Failed to refresh %s cache entries: %s' % (
+                len(batch), e
+            ))
+            with self._lock:
+                self.failed += len(batch)
+        else:
+            with self._lock:
+                self.refreshed += len(batch)
+        finally:
+            with self._lock:
+                self._pending.difference_update(batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'scheduled': self.scheduled,
+                'refreshed': self.refreshed,
+                'failed': self.failed,
+                'pending': len(self._pending),
+            }
+
+    def close(self):
+        ''' Waits for any refreshes already scheduled to finish '''
+        self.pool.close()
+        self.pool.join()
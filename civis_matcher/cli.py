@@ -0,0 +1,348 @@
+''' civis-match: bulk matches a CSV or JSON lines file of people against
+Civis, writing the raw results as JSON lines. Progress is checkpointed after
+every batch, so an interrupted job can be re-run with the same arguments and
+will pick up where it left off, retrying only the rows that failed.
+'''
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from itertools import islice
+
+from civis_matcher import matcher, storage
+
+
+def read_csv(path, id_column):
+    with open(path, 'rb') as input_file:
+        for row in csv.DictReader(input_file):
+            person_id = row.pop(id_column)
+            yield person_id, dict((k, v) for k, v in row.items() if v)
+
+
+def read_jsonl(path, id_column):
+    with open(path) as input_file:
+        for line in input_file:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            person_id = row.pop(id_column)
+            yield person_id, row
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+class Checkpoint(object):
+    ''' Records how many input rows have been matched, how much of the output
+    file holds their results and which of those rows got no result
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.rows_done = 0
+        self.output_bytes = 0
+        self.failed_rows = []
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            self.rows_done = state['rows_done']
+            self.output_bytes = state['output_bytes']
+            self.failed_rows = state.get('failed_rows', [])
+        return self
+
+    def save(self, rows_done, output_bytes, failed_rows=()):
+        self.rows_done = rows_done
+        self.output_bytes = output_bytes
+        self.failed_rows = sorted(failed_rows)
+        # Written to a temporary file and renamed so a crash can't leave a
+        # half written checkpoint behind
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump({
+                'rows_done': rows_done,
+                'output_bytes': output_bytes,
+                'failed_rows': self.failed_rows,
+            }, checkpoint_file)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Progress(object):
+    ''' Periodically reports rows processed and throughput to a stream '''
+
+    def __init__(self, stream, interval=5, start_rows=0):
+        self.stream = stream
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = 0
+        self.start_rows = start_rows
+        self.rows = start_rows
+        self.matched = 0
+        self.failed = 0
+
+    def update(self, rows, matched, failed):
+        self.rows += rows
+        self.matched += matched
+        self.failed += failed
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        self.last_report = time.time()
+        elapsed = self.last_report - self.start
+        rate = (self.rows - self.start_rows) / elapsed if elapsed else 0
+        self.stream.write(
+            'rows: %s  matched: %s  failed: %s  %.1f rows/s  %.0fs\n' % (
+                self.rows, self.matched, self.failed, rate, elapsed
+            )
+        )
+        self.stream.flush()
+
+
+def _matcher_kwargs(args):
+    kwargs = {
+        'base_url': args.base_url,
+        'timeout': args.timeout,
+        'pool_size': args.concurrency,
+    }
+    if args.user:
+        kwargs['user'] = args.user
+    if args.password:
+        kwargs['password'] = args.password
+    return kwargs
+
+
+def build_store(args):
+    ''' Returns the S3CivisMatcher results are stored with, if any '''
+    kwargs = _matcher_kwargs(args)
+    if args.local_store:
+        return matcher.S3CivisMatcher(
+            None, None, bucket=storage.LocalBucket(args.local_store), **kwargs
+        )
+    if args.s3_bucket:
+        return matcher.S3CivisMatcher(
+            args.aws_access_key_id or os.environ.get('AWS_ACCESS_KEY_ID'),
+            args.aws_secret_access_key or
+            os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            bucket=args.s3_bucket, **kwargs
+        )
+    return None
+
+
+def build_matcher(args, store=None):
+    ''' Returns the matcher rows are matched with. Rows are sent keyed by row
+    number, so with a store they're matched by a plain CivisMatcher sharing
+    its transport, and stored under their ids once they've been mapped back.
+    '''
+    kwargs = _matcher_kwargs(args)
+    if store:
+        kwargs['transport'] = store.transport
+    return matcher.CivisMatcher(cache_hosts=args.cache_hosts or [], **kwargs)
+
+
+def _best_results(results):
+    ''' Keeps the result with the most people for each id of a list of
+    (id, result), as _store_match_results would
+    '''
+    best = {}
+    for person_id, result in results:
+        count = result.get('result', {}).get('people_count', 0)
+        stored = best.get(person_id)
+        if (stored is None or
+                count > stored.get('result', {}).get('people_count', 0)):
+            best[person_id] = dict(result)
+    return best
+
+
+def match_rows(cm, store, rows, args):
+    ''' Matches (row number, (id, person)) pairs in batches, storing the
+    results under their ids when there's a store. Rows are sent keyed by
+    their row number, which is unique even if ids repeat. Yields a list of
+    (row number, output line) for each batch, in row order.
+    '''
+    ids = {}
+
+    def numbered():
+        for row_number, (person_id, person) in rows:
+            ids[row_number] = person_id
+            yield row_number, person
+
+    batches = cm.match_batches(
+        numbered(), batch_size=args.chunk_size, workers=args.concurrency,
+        raw=True, retries=args.retries
+    )
+    for batch, results in batches:
+        lines = []
+        to_store = []
+        for row_number in sorted(batch):
+            line = {'id': ids.pop(row_number)}
+            result = results.get('%s' % row_number)
+            if result is None:
+                line['error'] = 'No result returned'
+            else:
+                line['result'] = result
+                if 'result' in result:
+                    to_store.append((line['id'], result))
+            lines.append((row_number, line))
+        if store and to_store:
+            store._store_match_results(_best_results(to_store))
+        yield lines
+
+
+def _record(progress, lines, rows):
+    ''' Updates progress with a batch of output lines, returning the row
+    numbers of those that got no result
+    '''
+    matched = sum(1 for _, line in lines if 'result' in line.get('result', {}))
+    progress.update(rows, matched, len(lines) - matched)
+    return set(
+        row_number for row_number, line in lines if 'error' in line
+    )
+
+
+def retry_failed(cm, store, records, checkpoint, args, progress):
+    ''' Matches the rows a previous run got no result for again, and
+    replaces their lines in the output with the new results. The rest of
+    the output is copied as is, up to the checkpoint.
+    '''
+    failed = set(checkpoint.failed_rows)
+    rows = (
+        (row_number, record) for row_number, record in enumerate(
+            islice(records, max(failed) + 1)
+        ) if row_number in failed
+    )
+    retried = {}
+    for lines in match_rows(cm, store, rows, args):
+        failed -= set(row_number for row_number, _ in lines)
+        failed |= _record(progress, lines, 0)
+        retried.update(
+            (row_number, line) for row_number, line in lines
+            if 'error' not in line
+        )
+    if not retried:
+        return
+
+    tmp_path = '%s.tmp' % args.output
+    with open(args.output, 'rb') as output, open(tmp_path, 'wb') as copy:
+        for row_number, line in enumerate(
+                islice(output, checkpoint.rows_done)):
+            if row_number in retried:
+                line = json.dumps(retried[row_number]) + '\n'
+            copy.write(line)
+        copy.flush()
+        os.fsync(copy.fileno())
+        output_bytes = copy.tell()
+    os.rename(tmp_path, args.output)
+    checkpoint.save(checkpoint.rows_done, output_bytes, failed)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='civis-match', description=__doc__.splitlines()[0]
+    )
+    parser.add_argument('input', help='CSV or JSON lines file of people')
+    parser.add_argument('output', help='JSON lines file to write results to')
+    parser.add_argument('--format', choices=READERS.keys(),
+                        help='Input format (default: from the file extension)')
+    parser.add_argument('--id-column', default='id',
+                        help='Field holding each person\'s id')
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help='People per request to Civis')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Requests to Civis in flight at once')
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--checkpoint',
+                        help='Checkpoint file (default: OUTPUT.checkpoint)')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore any checkpoint and start from scratch')
+    parser.add_argument('--progress-interval', type=float, default=5)
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--base-url', default='')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--cache-host', dest='cache_hosts', action='append',
+                        help='memcached host, may be repeated')
+    parser.add_argument('--s3-bucket',
+                        help='Store results in this bucket via S3CivisMatcher')
+    parser.add_argument('--local-store',
+                        help='Store results in this SQLite file instead of S3')
+    parser.add_argument('--aws-access-key-id')
+    parser.add_argument('--aws-secret-access-key')
+    return parser.parse_args(argv)
+
+
+def run(args, progress_stream=sys.stderr):
+    input_format = args.format or os.path.splitext(args.input)[1].lstrip('.')
+    if input_format not in READERS:
+        raise ValueError('Unknown input format: %s' % input_format)
+
+    checkpoint = Checkpoint(args.checkpoint or '%s.checkpoint' % args.output)
+    if args.restart:
+        checkpoint.clear()
+    checkpoint.load()
+
+    mode = 'r+b' if checkpoint.rows_done else 'wb'
+    if mode == 'r+b' and not os.path.exists(args.output):
+        raise ValueError('Checkpoint found but %s is missing' % args.output)
+
+    store = build_store(args)
+    cm = build_matcher(args, store)
+    progress = Progress(progress_stream, args.progress_interval,
+                        checkpoint.rows_done)
+    if checkpoint.failed_rows:
+        retry_failed(cm, store, READERS[input_format](args.input,
+                                                      args.id_column),
+                     checkpoint, args, progress)
+
+    # Skip the rows already matched. Rows that get no result are recorded
+    # in the checkpoint, so re-running the job retries just those.
+    records = islice(READERS[input_format](args.input, args.id_column),
+                     checkpoint.rows_done, None)
+    rows_done = checkpoint.rows_done
+    failed = set(checkpoint.failed_rows)
+    with open(args.output, mode) as output:
+        # Drop any results written after the last checkpoint
+        output.seek(checkpoint.output_bytes)
+        output.truncate()
+        rows = enumerate(records, rows_done)
+        for lines in match_rows(cm, store, rows, args):
+            for _, line in lines:
+                output.write(json.dumps(line) + '\n')
+            output.flush()
+            os.fsync(output.fileno())
+            failed |= _record(progress, lines, len(lines))
+            rows_done += len(lines)
+            checkpoint.save(rows_done, output.tell(), failed)
+
+    cm.close()
+    if store:
+        store.close()
+    progress.report()
+    if failed:
+        progress_stream.write(
+            '%s rows got no result; re-run to retry them\n' % len(failed)
+        )
+    else:
+        checkpoint.clear()
+    return progress
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARN)
+    progress = run(parse_args(argv))
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
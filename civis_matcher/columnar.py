@@ -0,0 +1,159 @@
+''' Columnar export of bulk match results, for aggregating scores over a
+whole audience without looping over MatchResult.people.
+
+NumPy is used if it's installed, giving float64 score columns and vectorized
+aggregations. Without it the columns are ``array('d')`` and the
+aggregations plain Python.
+'''
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NAN = float('nan')
+
+
+def _score(value):
+    if value is None:
+        return NAN
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def _iter_people(result, names):
+    ''' Yields the named fields of each person in a MatchResult or a raw
+    result from bulk_match(raw=True)
+    '''
+    if hasattr(result, 'iter_fields'):
+        return result.iter_fields(names)
+    people = (result.get('result') or {}).get('people') or ()
+    return (
+        tuple(person.get(name) for name in names) for person in people
+    )
+
+
+def summarize(values):
+    ''' count/min/max/mean/std of a column of scores, ignoring missing (NaN)
+    values. std is the population standard deviation. All but count are None
+    for a column with no scores.
+    '''
+    if numpy is not None:
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values)]
+        if not len(values):
+            return {'count': 0, 'min': None, 'max': None, 'mean': None,
+                    'std': None}
+        return {
+            'count': int(len(values)),
+            'min': float(values.min()),
+            'max': float(values.max()),
+            'mean': float(values.mean()),
+            'std': float(values.std()),
+        }
+
+    values = [value for value in values if not math.isnan(value)]
+    if not values:
+        return {'count': 0, 'min': None, 'max': None, 'mean': None,
+                'std': None}
+    mean = math.fsum(values) / len(values)
+    return {
+        'count': len(values),
+        'min': min(values),
+        'max': max(values),
+        'mean': mean,
+        'std': math.sqrt(
+            math.fsum((value - mean) ** 2 for value in values) / len(values)
+        ),
+    }
+
+
+class ResultColumns(object):
+    ''' The people of a set of bulk match results as columns, one row per
+    person matched. ``match_id`` holds the id each person was matched under,
+    followed by a column per person field and one per score. Missing fields
+    are None and missing scores NaN.
+    '''
+
+    def __init__(self, fields, scores, columns):
+        self.fields = fields
+        self.scores = scores
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['match_id'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def names(self):
+        return ['match_id'] + list(self.fields) + list(self.scores)
+
+    def summarize(self, scores=None):
+        ''' count/min/max/mean/std of each score, by score name. Numeric
+        person fields such as ``score`` can be summarized too.
+        '''
+        summaries = {}
+        for name in scores or self.scores:
+            column = self.columns[name]
+            if name in self.fields:
+                column = array('d', (_score(value) for value in column))
+            summaries[name] = summarize(column)
+        return summaries
+
+    def to_records(self):
+        ''' The columns as a NumPy record array '''
+        if numpy is None:
+            raise ImportError('to_records needs numpy')
+        return numpy.rec.fromarrays(
+            [self.columns[name] for name in self.names], names=self.names
+        )
+
+
+def to_columns(results, fields=('id',), scores=None):
+    '''
+    Converts the results of bulk_match, a dict of id -> MatchResult (or raw
+    result), into ResultColumns. ``fields`` are the person fields to include.
+    ``scores`` are the names in each person's ``scores`` to include, by
+    default every one found.
+    '''
+    fields = tuple(fields)
+    names = fields + ('scores',)
+    match_ids = []
+    values = dict((name, []) for name in fields)
+    found_scores = []
+    seen = set()
+    score_rows = []
+    for match_id, result in results.iteritems():
+        for person in _iter_people(result, names):
+            match_ids.append(match_id)
+            for name, value in zip(fields, person):
+                values[name].append(value)
+            person_scores = person[-1] or {}
+            score_rows.append(person_scores)
+            if scores is None:
+                for name in person_scores:
+                    if name not in seen:
+                        seen.add(name)
+                        found_scores.append(name)
+
+    scores = tuple(found_scores) if scores is None else tuple(scores)
+    for name in scores:
+        column = (_score(row.get(name)) for row in score_rows)
+        if numpy is not None:
+            values[name] = numpy.fromiter(column, numpy.float64,
+                                          len(score_rows))
+        else:
+            values[name] = array('d', column)
+    if numpy is not None:
+        for name in fields:
+            values[name] = numpy.array(values[name], dtype=object)
+        match_ids = numpy.array(match_ids, dtype=object)
+    values['match_id'] = match_ids
+    return ResultColumns(fields, scores, values)
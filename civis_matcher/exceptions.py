@@ -0,0 +1,11 @@
+class MatchException(Exception):
+
+    def __init__(self, message, status_code=None):
+        super(MatchException, self).__init__(message)
+        # HTTP status of the response that failed, if there was one
+        self.status_code = status_code
+
+
+class CircuitOpenError(MatchException):
+    ''' Raised instead of calling Civis while its circuit breaker is open '''
+    pass
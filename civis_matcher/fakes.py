@@ -0,0 +1,247 @@
+''' Local stand-ins for the Civis matching service, S3 and memcached, for
+use in tests and benchmarks.
+'''
+import cPickle as pickle
+import json
+import random
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qsl, urlparse
+
+from boto.exception import S3ResponseError
+
+
+def fake_result(person, people_count=1):
+    ''' Builds a Civis result of ``people_count`` people echoing back the
+    given fields
+    '''
+    people = []
+    for i in range(people_count):
+        people.append({
+            'id': '%s' % (i + 1),
+            'first_name': person.get('first_name', '').upper(),
+            'last_name': person.get('last_name', '').upper(),
+            'city': person.get('city', '').upper(),
+            'state': person.get('state', '').upper(),
+            'gender': 'M',
+            'birth_year': '1969',
+            'dma': '584',
+            'dma_name': 'Charlottesville VA',
+            'TokenCount': 6,
+            'scores': {
+                'persuasion_score': 25.59,
+                'turnout_2013': 85.419,
+                'support_cand_2013': 52.085,
+            },
+        })
+
+    scores = {}
+    if people_count:
+        for name, value in people[0]['scores'].items():
+            scores[name] = {
+                'count': people_count, 'max': value, 'mean': value,
+                'min': value, 'std': 0,
+            }
+    return {
+        'error': False,
+        'result': {
+            'more_people': False,
+            'people_count': people_count,
+            'people': people,
+            'scores': scores,
+        }
+    }
+
+
+class FakeCivisHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path != '/match':
+            return self._respond(404, {})
+        if self._simulate():
+            self._respond(200, fake_result(
+                dict(parse_qsl(parsed.query)), self.server.people_count
+            ))
+
+    def do_POST(self):
+        if self.path != '/multimatch':
+            return self._respond(404, {})
+        length = int(self.headers.getheader('content-length', 0))
+        people = json.loads(self.rfile.read(length)).get('people', {})
+        if self._simulate():
+            self._respond(200, dict(
+                (person_id, fake_result(person, self.server.people_count))
+                for person_id, person in people.items()
+            ))
+
+    def _simulate(self):
+        ''' Applies the configured latency and error rate. Returns False if
+        an error response was sent.
+        '''
+        self.server.request_count += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self._respond(500, {})
+            return False
+        return True
+
+    def _respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeCivisServer(object):
+    ''' Serves the /match and /multimatch end points on a local port. Use
+    ``url`` as the ``base_url`` of a matcher. Each request takes ``latency``
+    seconds, fails with a 500 at the given ``error_rate`` and otherwise
+    matches ``people_count`` people per person.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 people_count=1):
+        self.server = _ThreadedHTTPServer((host, port), FakeCivisHandler)
+        self.server.latency = latency
+        self.server.error_rate = error_rate
+        self.server.people_count = people_count
+        self.server.request_count = 0
+        self.url = 'http://%s:%s' % self.server.server_address
+        self._thread = None
+
+    @property
+    def request_count(self):
+        return self.server.request_count
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeKey(object):
+    ''' Stand-in for a boto S3 Key '''
+
+    def __init__(self, bucket, name, metadata=None):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = dict(metadata or {})
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_contents_as_string(self):
+        self.bucket._delay()
+        try:
+            return self.bucket.objects[self.name]
+        except KeyError:
+            raise S3ResponseError(404, 'Not Found')
+
+    def set_contents_from_string(self, contents):
+        self.bucket._delay()
+        self.bucket.objects[self.name] = contents
+        self.bucket.metadata[self.name] = dict(self.metadata)
+
+
+class FakeBucket(object):
+    ''' In-memory stand-in for a boto S3 Bucket, adding ``latency`` seconds
+    to each request
+    '''
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.objects = {}
+        self.metadata = {}
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_key(self, name):
+        self._delay()
+        if name in self.objects:
+            return FakeKey(self, name, self.metadata.get(name))
+        return None
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def delete_key(self, name):
+        self._delay()
+        self.objects.pop(name, None)
+        self.metadata.pop(name, None)
+
+
+class FakeMemcache(object):
+    ''' In-memory stand-in for a pylibmc Client, adding ``latency`` seconds
+    to each call. Values are pickled like pylibmc does; expiry times are
+    ignored.
+    '''
+    name = 'memcached'
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, key):
+        self._delay()
+        value = self.data.get(key)
+        return pickle.loads(value) if value is not None else None
+
+    def get_multi(self, keys):
+        self._delay()
+        return dict(
+            (key, pickle.loads(self.data[key]))
+            for key in keys if key in self.data
+        )
+
+    def set(self, key, value, time=0):
+        self._delay()
+        with self._lock:
+            self.data[key] = pickle.dumps(value, -1)
+        return True
+
+    def set_multi(self, mapping, time=0):
+        self._delay()
+        with self._lock:
+            for key, value in mapping.iteritems():
+                self.data[key] = pickle.dumps(value, -1)
+        return []
+
+    def delete(self, key):
+        self._delay()
+        with self._lock:
+            self.data.pop(key, None)
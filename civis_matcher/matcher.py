@@ -1,23 +1,62 @@
 import json
-import hashlib
 import logging
+import sys
+import threading
+import time
+from collections import deque
 from datetime import datetime, timedelta
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 import boto
 from boto.exception import S3ResponseError
 
 import pylibmc
-import requests
+from requests.exceptions import RequestException
 from urllib import urlencode
 
+from civis_matcher.cache import (
+    BackgroundRefresher, CacheKeyBuilder, CacheStats, LocalCache,
+    LockedClient, SerializingClient, SingleFlight, TieredCache, get_first
+)
+from civis_matcher.exceptions import CircuitOpenError, MatchException
+from civis_matcher.metrics import Instrumentation, summarize_latencies
+from civis_matcher.prefetch import Prefetcher
+from civis_matcher.resilience import Resilience
+from civis_matcher.serialization import DEFAULT_SERIALIZER
+from civis_matcher.storage import ResultStore, person_digest
+from civis_matcher.streaming import iter_object_items
+from civis_matcher.transport import Transport
+from civis_matcher.writebehind import WriteBehindQueue
+
 
 CIVIS_BASE_URL = 'http://match.civisanalytics.com'
 TIME_FORMAT = '%m-%d-%y_%H:%M:%S'
+# Bump whenever the metadata stored alongside S3 results changes, so objects
+# written with older metadata are read in full instead
+STORED_SCHEMA_VERSION = 1
+STREAM_CHUNK_SIZE = 64 * 1024
+CACHE_WRITE_BATCH = 500
 logger = logging.getLogger(__name__)
 
 
-class MatchException(Exception):
-    pass
+def _is_negative(data):
+    ''' Whether a Civis result is a successful lookup that matched no one '''
+    result = data.get('result')
+    return (result is not None and not result.get('people_count') and
+            not result.get('people'))
+
+
+def _batches(records, size):
+    ''' Groups an iterable of (key, value) pairs into dicts of up to size
+    entries, reading it lazily
+    '''
+    records = iter(records)
+    while True:
+        batch = dict(islice(records, size))
+        if not batch:
+            return
+        yield batch
 
 
 class Struct(object):
@@ -25,7 +64,80 @@ class Struct(object):
         self.__dict__.update(entries)
 
 
-class Person(Struct):
+_MISSING = object()
+
+
+class CompactStruct(object):
+    ''' Memory efficient alternative to Struct. Fields named in __slots__
+    are stored in slots, and any others in a small dict that's only created
+    when needed, so arbitrary attributes still work.
+    '''
+    __slots__ = ('_extra',)
+    # Names set directly on the object rather than kept in _extra
+    _direct = frozenset(('_extra',))
+
+    def __init__(self, **entries):
+        self._extra = None
+        for name, value in entries.iteritems():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # Only called once the slots and class attributes have been checked
+        try:
+            extra = object.__getattribute__(self, '_extra')
+        except AttributeError:
+            extra = None
+        if extra and name in extra:
+            return extra[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self._direct:
+            object.__setattr__(self, name, value)
+        else:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', {})
+            self._extra[name] = value
+
+    def to_dict(self):
+        data = dict(self._extra or {})
+        for name in self.__slots__:
+            if name.startswith('_'):
+                continue
+            value = getattr(self, name, _MISSING)
+            if value is not _MISSING:
+                data[name] = value
+        return data
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self._extra = None
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+
+PERSON_FIELDS = (
+    'id', 'first_name', 'last_name', 'nick_name', 'gender', 'city',
+    'state', 'birth_year', 'birth_month', 'birth_day', 'dma', 'dma_name',
+    'score', 'scores', 'TokenCount',
+)
+
+
+class Person(CompactStruct):
+    __slots__ = PERSON_FIELDS
+    _direct = frozenset(PERSON_FIELDS + ('_extra',))
+
+    @classmethod
+    def _from_row(cls, row, extra):
+        ''' Builds a Person from a row packed by _pack_person '''
+        person = cls.__new__(cls)
+        for name, value in zip(PERSON_FIELDS, row):
+            if value is not _MISSING:
+                object.__setattr__(person, name, value)
+        object.__setattr__(person, '_extra', extra)
+        return person
 
     def __unicode__(self):
         return u'Person: %s %s' % (self.first_name, self.last_name)
@@ -37,17 +149,89 @@ class Person(Struct):
         return self.__unicode__()
 
 
-class MatchResult(Struct):
+def _pack_person(person):
+    ''' Packs a person dict from Civis into a tuple of the known fields,
+    plus a dict of any others, which takes far less memory than the dict
+    '''
+    row = tuple(person.get(name, _MISSING) for name in PERSON_FIELDS)
+    extra = None
+    if len(person) > len(row) - row.count(_MISSING):
+        extra = dict(
+            (name, value) for name, value in person.iteritems()
+            if name not in Person._direct
+        )
+    return row, extra
+
+
+RESULT_FIELDS = (
+    'url', 'people_count', 'more_people', 'scores', 'score_mean',
+    'score_min', 'score_max', 'score_std',
+)
+
+
+class MatchResult(CompactStruct):
+    ''' A Civis match result. The people are kept packed and only built
+    into Person objects the first time ``people`` is accessed, so fields such
+    as people_count can be read without that cost.
+    '''
+    __slots__ = RESULT_FIELDS + ('_people', '_people_rows')
+    _direct = frozenset(
+        RESULT_FIELDS + ('_people', '_people_rows', '_extra', 'people')
+    )
 
     def __init__(self, **entries):
-        self.__dict__.update(entries)
-        self.url = ''
-        people_list = []
-        if self.people:
-            for person in self.people:
-                people_list.append(Person(**person))
+        entries.setdefault('url', '')
+        entries.setdefault('people', None)
+        super(MatchResult, self).__init__(**entries)
+
+    @property
+    def people(self):
+        if self._people is None:
+            self._people = [
+                Person._from_row(row, extra)
+                for row, extra in self._people_rows
+            ]
+            self._people_rows = None
+        return self._people
+
+    @people.setter
+    def people(self, people):
+        people = people or []
+        if people and isinstance(people[0], dict):
+            self._people = None
+            self._people_rows = [_pack_person(person) for person in people]
+        else:
+            self._people = list(people)
+            self._people_rows = None
+
+    def iter_fields(self, names):
+        ''' Yields a tuple of the named fields of each person, with None for
+        any they don't have. People that haven't been built yet are read
+        from their packed rows, without building Person objects.
+        '''
+        if self._people is not None:
+            for person in self._people:
+                yield tuple(getattr(person, name, None) for name in names)
+            return
 
-        self.people = people_list
+        positions = [
+            PERSON_FIELDS.index(name) if name in PERSON_FIELDS else None
+            for name in names
+        ]
+        for row, extra in self._people_rows:
+            values = []
+            for name, position in zip(names, positions):
+                if position is None:
+                    value = extra.get(name) if extra else None
+                else:
+                    value = row[position]
+                values.append(None if value is _MISSING else value)
+            yield tuple(values)
+
+    def to_dict(self):
+        data = super(MatchResult, self).to_dict()
+        data['people'] = [person.to_dict() for person in self.people]
+        return data
 
     def __unicode__(self):
         return u'MatchResult: %s' % self.url
@@ -63,37 +247,240 @@ class CivisMatcher(object):
 
     def __init__(self, user='edgeflip', password='civis!19',
                  cache_hosts=[], cache_expiry=3600, base_url='',
-                 timeout=5):
+                 timeout=5, pool_size=10, max_retries=0, backoff_factor=0.5,
+                 transport=None, cache_namespace='civis', local_cache_size=0,
+                 local_cache_ttl=60, write_through=True, cache_tiers=None,
+                 limiter=None, resilience=None, stale_cache_size=0,
+                 stale_cache_ttl=86400, cache_soft_expiry=None,
+                 refresh_workers=2, metrics=None, serializer=None,
+                 negative_cache_expiry=600):
         self.auth = (user, password)
         self.caching_enabled = False
         self.expiry = cache_expiry
-        if cache_hosts:
-            self.cache = pylibmc.Client(cache_hosts)
+        # Results matching no one are cached under their own keys for a
+        # shorter time, and any positive result for the person takes
+        # precedence over them
+        self.negative_expiry = negative_cache_expiry
+        self.cache_keys = CacheKeyBuilder(namespace=cache_namespace)
+        self.cache_stats = CacheStats()
+        self.metrics = metrics or Instrumentation()
+        self.in_flight = SingleFlight()
+        # An in-process LRU can sit in front of memcached; a custom stack of
+        # tiers can also be given
+        if cache_tiers is None:
+            cache_tiers = []
+            if local_cache_size:
+                cache_tiers.append(
+                    LocalCache(local_cache_size, local_cache_ttl)
+                )
+            if cache_hosts:
+                cache_tiers.append(SerializingClient(
+                    LockedClient(pylibmc.Client(cache_hosts)),
+                    serializer or DEFAULT_SERIALIZER
+                ))
+        if cache_tiers:
+            self.cache = TieredCache(cache_tiers, write_through=write_through)
             self.caching_enabled = True
+        # Last known results, served if Civis can't be reached
+        self.stale_cache = None
+        if stale_cache_size:
+            self.stale_cache = LocalCache(stale_cache_size, stale_cache_ttl)
+        self.resilience = resilience or Resilience()
+        # Past the soft expiry cached results are still served, but are
+        # refreshed in the background. cache_expiry stays the hard limit.
+        self.soft_expiry = cache_soft_expiry
+        self.refresher = None
+        if cache_soft_expiry is not None and self.caching_enabled:
+            self.refresher = BackgroundRefresher(
+                self._refresh_cached, refresh_workers
+            )
 
         # Useful if you want to test against their staging instance
         self.base_url = base_url if base_url else CIVIS_BASE_URL
         self.timeout = timeout
+        self.transport = transport or Transport(
+            auth=self.auth, timeout=timeout, pool_size=pool_size,
+            max_retries=max_retries, backoff_factor=backoff_factor,
+            limiter=limiter
+        )
 
-    def _check_cache(self, url, params):
-        ''' Checks the cache for Civis match results. Hashes the URL plus the
-        params used in the check to create a key.
+    def _cache_key(self, url, params):
+        ''' Hashes the URL plus the normalized params to create a key. Used by
+        both the read and write paths, and shared between match() and
+        bulk_match() for the same person.
         '''
+        return self.cache_keys.key(url, params)
+
+    def _check_cache(self, url, params):
+        ''' Checks the cache for Civis match results '''
         if not self.caching_enabled:
             return None
 
-        url_hash = hashlib.md5('%s?%s' % (url, urlencode(params))).hexdigest()
-        return self.cache.get(url_hash)
+        key = self._cache_key(url, params)
+        return self._get_cached({key: params}).get(key)
+
+    def _get_cached(self, people):
+        ''' Looks up the cached results for a dict of cache key -> person
+        fields. Returns the results found by key, as Civis returned them,
+        counting hits and misses and scheduling refreshes of any that are
+        stale.
+        '''
+        cached, negative_hits = self._lookup_cached(people.keys())
+        misses = len(people) - len(cached)
+        self.cache_stats.record(hits=len(cached), misses=misses,
+                                negative_hits=negative_hits)
+        self.metrics.incr('cache.hits', len(cached))
+        self.metrics.incr('cache.misses', misses)
+        if negative_hits:
+            self.metrics.incr('cache.negative_hits', negative_hits)
+        self._revalidate(cached, people)
+        return dict(
+            (key, self._unstamp(data)) for key, data in cached.iteritems()
+        )
+
+    def _lookup_cached(self, keys):
+        ''' Reads the cached results for a list of keys, falling back to the
+        negative entries of those with no positive result. Returns the
+        results found by key and how many of them were negative.
+        '''
+        # Both keys of each person are read in the same request
+        pairs = [
+            (key, self.cache_keys.negative(key) if self.negative_expiry
+             else None)
+            for key in keys
+        ]
+        with self.metrics.timer('cache.get'):
+            if isinstance(self.cache, TieredCache):
+                cached, negatives = self.cache.get_first(pairs)
+            else:
+                cached, negatives = get_first(self.cache, pairs)
+        return cached, len(negatives)
+
+    def _entry_key(self, key, data):
+        ''' Returns the key and expiry to cache a result under '''
+        if self.negative_expiry and _is_negative(data):
+            return self.cache_keys.negative(key), self.negative_expiry
+        return key, self.expiry
+
+    def _stamp(self, data):
+        ''' Records when a result was cached, if soft expiry is in use '''
+        if self.refresher:
+            return dict(data, cached_at=time.time())
+        return data
+
+    def _unstamp(self, data):
+        ''' Drops the time _stamp recorded from a cached result '''
+        if 'cached_at' not in data:
+            return data
+        data = dict(data)
+        del data['cached_at']
+        return data
 
     def _set_cache(self, url, params, data):
         ''' Sets the cache with the key being a hashed form of the URL and
         params
         '''
+        if self.stale_cache is not None:
+            self.stale_cache.set(self._cache_key(url, params), data)
         if self.caching_enabled:
-            url_hash = hashlib.md5('%s?%s' % (url, params)).hexdigest()
-            self.cache.set(url_hash, data, time=self.expiry)
+            key, expiry = self._entry_key(self._cache_key(url, params), data)
+            with self.metrics.timer('cache.set'):
+                self.cache.set(key, self._stamp(data), time=expiry)
+            self.cache_stats.record(sets=1)
 
-    def _validate_result(self, resp):
+    def _revalidate(self, found, people):
+        ''' Schedules a background refresh of any of the ``found`` cache
+        entries that are past the soft expiry. ``people`` maps each key to
+        the fields of the person it's for. Entries cached without a time are
+        left until they expire.
+        '''
+        if not self.refresher:
+            return
+        cutoff = time.time() - self.soft_expiry
+        stale = dict(
+            (key, people[key]) for key, data in found.iteritems()
+            if data.get('cached_at', cutoff) < cutoff
+        )
+        if stale:
+            self.refresher.schedule(stale)
+
+    def _refresh_cached(self, people):
+        ''' Re-matches the people of soft expired cache entries with a single
+        multimatch request, using the cache keys as their ids. Returns the
+        results by key.
+        '''
+        results = self._check_civis(
+            '%s/multimatch' % self.base_url, {'people': people}, 'POST'
+        )
+        self._cache_results(dict(
+            (key, result) for key, result in results.iteritems()
+            if key in people and 'result' in result
+        ))
+        return results
+
+    def _find_stale(self, people):
+        ''' Returns the people of a dict of id -> person fields whose cached
+        results are missing or past their soft expiry
+        '''
+        if not self.caching_enabled:
+            raise ValueError('Prefetching needs a cache to fill')
+        match_url = '%s/match' % self.base_url
+        keys = dict(
+            (person_id, self._cache_key(match_url, person))
+            for person_id, person in people.iteritems()
+        )
+        cached, _ = self._lookup_cached(keys.values())
+        cutoff = time.time() - (self.soft_expiry or 0)
+        return dict(
+            (person_id, person) for person_id, person in people.iteritems()
+            if keys[person_id] not in cached or (
+                self.refresher and
+                cached[keys[person_id]].get('cached_at', cutoff) < cutoff
+            )
+        )
+
+    def _warm(self, people):
+        ''' Matches and caches a dict of id -> person fields regardless of
+        what's cached, returning the results by id
+        '''
+        match_url = '%s/match' % self.base_url
+        ids = {}
+        for person_id, person in people.iteritems():
+            key = self._cache_key(match_url, person)
+            ids.setdefault(key, []).append(person_id)
+        results = self._refresh_cached(dict(
+            (key, people[person_ids[0]]) for key, person_ids in ids.iteritems()
+        ))
+        return dict(
+            (person_id, results[key])
+            for key, person_ids in ids.iteritems() if key in results
+            for person_id in person_ids
+        )
+
+    def prefetch(self, records, batch_size=100, rate=None, progress=None):
+        '''
+        Fills the cache ahead of time for an iterable of (id, person fields)
+        records, such as the people a campaign is about to look up. People
+        whose cached result is still fresh are skipped. The rest are bulk
+        matched in batches of ``batch_size``, sending no more than ``rate``
+        people per second if given.
+
+        Returns a PrefetchReport of how many people were skipped, fetched,
+        matched and failed, and the resulting cache coverage. If given,
+        ``progress(report)`` is called after each batch. Raises ValueError if
+        the matcher has no cache.
+        '''
+        return Prefetcher(self, batch_size, rate, progress).run(records)
+
+    def _check_stale(self, keys):
+        ''' Looks up the last known results for the given cache keys, for use
+        when Civis is unavailable
+        '''
+        if self.stale_cache is None:
+            return {}
+        return self.stale_cache.get_multi(keys)
+
+    def _check_status(self, resp):
         if resp.status_code != 200:
             logger.error('Invalid status code (%s) on %s' % (
                 resp.status_code,
@@ -103,10 +490,11 @@ class CivisMatcher(object):
                 'Invalid response code: %s, url: %s' % (
                     resp.status_code,
                     resp.url
-                )
+                ),
+                status_code=resp.status_code
             )
 
-        data = json.loads(resp.content)
+    def _check_error(self, data, url):
         if data.get('error'):
             logger.error('Civis Error: %s, %s' % (
                 data['error_id'],
@@ -116,44 +504,270 @@ class CivisMatcher(object):
                 'Error returned by Civis: id: %s, message: %s, url: %s' % (
                     data['error_id'],
                     data['error_message'],
-                    resp.url
+                    url
                 )
             )
+
+    def _validate_result(self, resp):
+        self._check_status(resp)
+        with self.metrics.timer('parse'):
+            try:
+                data = json.loads(resp.content)
+            except ValueError as e:
+                logger.error('Invalid JSON (%s) on %s' % (e, resp.url))
+                raise MatchException(
+                    'Invalid response body: %s, url: %s' % (e, resp.url)
+                )
+        self._check_error(data, resp.url)
         return data
 
     def _get(self, url, params):
         req_url = '%s?%s' % (url, urlencode(params))
-        resp = requests.get(req_url, auth=self.auth, timeout=self.timeout)
+        self.metrics.incr('civis.requests')
+        with self.metrics.timer('http'):
+            resp = self.transport.get(req_url, auth=self.auth,
+                                      timeout=self.timeout)
         data = self._validate_result(resp)
         self._set_cache(url, params, data)
         return data
 
     def _post(self, url, params):
-        resp = requests.post(url, data=json.dumps(params),
-                            auth=self.auth, timeout=self.timeout)
-        data = self._validate_result(resp)
-        post_url = '%s?%s' % (url, urlencode(params))
-        self._set_cache(post_url, params, data)
-        return data
+        self.metrics.incr('civis.requests')
+        with self.metrics.timer('http'):
+            resp = self.transport.post(url, data=json.dumps(params),
+                                       auth=self.auth, timeout=self.timeout)
+        return self._validate_result(resp)
+
+    def _open_stream(self, url, params):
+        self.metrics.incr('civis.requests')
+        with self.metrics.timer('http'):
+            resp = self.transport.post(url, data=json.dumps(params),
+                                       auth=self.auth, timeout=self.timeout,
+                                       stream=True)
+        try:
+            self._check_status(resp)
+        except MatchException:
+            self._release_stream(resp)
+            raise
+        return resp
+
+    def _release_stream(self, resp):
+        ''' Reads what's left of a streamed response so its connection can go
+        back to the pool
+        '''
+        try:
+            resp.content
+        finally:
+            resp.close()
+
+    def _stream_post(self, url, params):
+        ''' POSTs to Civis and decodes the JSON object returned as it's read,
+        yielding its (key, value) pairs. Opening the response is retried and
+        hedged like any other call, but a failure part way through reading
+        it is not. The response is closed once reading stops, including when
+        the caller stops early.
+        '''
+        resp = self.resilience.call_releasing(
+            self._release_stream, self._open_stream, url, params
+        )
+        try:
+            items = iter_object_items(resp.iter_content(STREAM_CHUNK_SIZE))
+            for key, value in items:
+                # Per person results are objects, anything else means Civis
+                # returned an error for the whole request
+                if not isinstance(value, dict):
+                    error = dict(items)
+                    error[key] = value
+                    self._check_error(error, resp.url)
+                    return
+                yield key, value
+        finally:
+            resp.close()
 
     def _check_civis(self, url, params, method):
         ''' Makes an actual call to Civis in the event that we don't already
-        have anything stored in the cache
+        have anything stored in the cache. Calls are retried, hedged and
+        short circuited according to ``self.resilience``.
         '''
         if method == 'GET':
-            return self._get(url, params)
+            return self.resilience.call(self._get, url, params)
         elif method == 'POST':
-            return self._post(url, params)
+            return self.resilience.call(self._post, url, params)
 
     def _make_request(self, url, params, method='GET'):
         ''' Helper function for making a request to Civis. Checks our cache
-        before moving on the actually make a request to Civis.
+        before moving on the actually make a request to Civis. Identical
+        requests already in flight are waited on rather than repeated. If
+        Civis fails, the last known result is returned where there is one.
         '''
         data = self._check_cache(url, params)
         if not data:
-            data = self._check_civis(url, params, method)
+            key = self._cache_key(url, params)
+            try:
+                data = self.in_flight.do(
+                    key, self._check_civis, url, params, method
+                )
+            except (MatchException, RequestException):
+                exc_info = sys.exc_info()
+                data = self._check_stale([key]).get(key)
+                if not data:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self.resilience.count(stale_served=1)
+                logger.warn('Civis unavailable, using stale result for %s' % (
+                    url
+                ))
         return data, '%s?%s' % (url, urlencode(params))
 
+    def _cache_results(self, to_cache):
+        if self.stale_cache is not None and to_cache:
+            self.stale_cache.set_multi(to_cache)
+        if self.caching_enabled and to_cache:
+            by_expiry = {}
+            for key, data in to_cache.iteritems():
+                key, expiry = self._entry_key(key, data)
+                by_expiry.setdefault(expiry, {})[key] = self._stamp(data)
+            with self.metrics.timer('cache.set'):
+                for expiry, mapping in by_expiry.iteritems():
+                    self.cache.set_multi(mapping, time=expiry)
+            self.cache_stats.record(sets=len(to_cache))
+
+    def _iter_bulk_request(self, match_dict, stream=False):
+        ''' Looks up each person of a bulk request in the cache individually,
+        under the same key match() would use for them, and only sends the
+        cache misses on to the multimatch end point. People already being
+        matched by another request are waited on instead of being sent
+        again. Successful results from Civis are then cached per person. If
+        Civis fails and every person sent has a stale result, those are used
+        instead.
+
+        Yields (person_id, raw result) pairs. With ``stream`` the response
+        from Civis is decoded incrementally, and each result is yielded as
+        soon as it has been read. The people sent aren't registered as in
+        flight then, as other requests for them would have to wait on the
+        caller consuming the results.
+        '''
+        match_url = '%s/match' % self.base_url
+        people = dict(
+            ('%s' % person_id, person)
+            for person_id, person in match_dict.get('people', {}).items()
+        )
+        keys = dict(
+            (person_id, self._cache_key(match_url, person))
+            for person_id, person in people.items()
+        )
+        cached = {}
+        if self.caching_enabled:
+            found = self._get_cached(dict(
+                (keys[person_id], person)
+                for person_id, person in people.iteritems()
+            ))
+            for person_id, key in keys.items():
+                if key in found:
+                    cached[person_id] = found[key]
+            for person_id, result in cached.iteritems():
+                yield person_id, result
+
+        misses = {}
+        waiting = {}
+        for person_id, person in people.items():
+            if person_id in cached:
+                continue
+            if stream:
+                misses[person_id] = (person, None)
+                continue
+            call, leader = self.in_flight.begin(keys[person_id])
+            if leader:
+                misses[person_id] = (person, call)
+            else:
+                waiting[person_id] = call
+
+        if misses:
+            url = '%s/multimatch' % self.base_url
+            params = {'people': dict(
+                (person_id, person)
+                for person_id, (person, _) in misses.items()
+            )}
+            to_cache = {}
+            stale = {}
+            try:
+                if stream:
+                    results = self._stream_post(url, params)
+                else:
+                    results = self._check_civis(
+                        url, params, 'POST'
+                    ).iteritems()
+                for person_id, result in results:
+                    _, call = misses.pop(person_id, (None, None))
+                    if call is not None:
+                        self.in_flight.finish(
+                            keys[person_id], call, result=result
+                        )
+                    if ((self.caching_enabled or self.stale_cache is not None)
+                            and person_id in keys and 'result' in result):
+                        to_cache[keys[person_id]] = result
+                        if len(to_cache) >= CACHE_WRITE_BATCH:
+                            self._cache_results(to_cache)
+                            to_cache = {}
+                    yield person_id, result
+            except Exception:
+                exc_info = sys.exc_info()
+                found = self._check_stale(
+                    [keys[person_id] for person_id in misses]
+                )
+                if not misses or len(found) < len(misses):
+                    for person_id, (_, call) in misses.items():
+                        if call is not None:
+                            self.in_flight.finish(
+                                keys[person_id], call, exc_info=exc_info
+                            )
+                    misses = {}
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                self.resilience.count(stale_served=len(found))
+                logger.warn('Civis unavailable, using %s stale results' % (
+                    len(found)
+                ))
+                for person_id, (_, call) in misses.items():
+                    stale[person_id] = found[keys[person_id]]
+                    if call is not None:
+                        self.in_flight.finish(
+                            keys[person_id], call, result=stale[person_id]
+                        )
+                misses = {}
+            finally:
+                # Releases anyone waiting on people Civis didn't return, or
+                # that weren't reached because iteration stopped early
+                for person_id, (_, call) in misses.items():
+                    if call is not None:
+                        self.in_flight.finish(keys[person_id], call)
+                self._cache_results(to_cache)
+            for item in stale.iteritems():
+                yield item
+
+        for person_id, call in waiting.items():
+            result = call.wait()
+            if result is not None:
+                yield person_id, result
+
+    def _bulk_request(self, match_dict):
+        return dict(self._iter_bulk_request(match_dict))
+
+    def iter_bulk_match(self, match_dict, raw=False):
+        '''
+        Streaming version of bulk_match. The response from Civis is decoded
+        incrementally and (id, MatchResult) pairs, or (id, raw result) pairs
+        with ``raw``, are yielded as they are read, so memory use doesn't
+        grow with the size of the batch. Error entries are logged and
+        skipped, as bulk_match does.
+        '''
+        for person_id, result in self._iter_bulk_request(match_dict, True):
+            if raw:
+                yield person_id, result
+            elif 'result' in result:
+                yield person_id, MatchResult(**result['result'])
+            else:
+                logger.warn('Match Result Error: %s' % result)
+
     def match(self, first_name, last_name, **kwargs):
         '''
         Performs a request against the Civis Matching service with the
@@ -175,8 +789,9 @@ class CivisMatcher(object):
         })
         data, req_url = self._make_request(url, request_params)
 
-        data['result'].update({'url': req_url})
-        return MatchResult(**data['result'])
+        # Copied rather than updated, as data may be shared with the cache
+        with self.metrics.timer('build'):
+            return MatchResult(**dict(data['result'], url=req_url))
 
     def bulk_match(self, match_dict, raw=False):
         '''
@@ -233,36 +848,251 @@ class CivisMatcher(object):
             }
         }
 
+        Each person is cached individually, so only the people not already
+        cached (by either match or bulk_match) are sent to Civis.
+
         '''
-        url = '%s/multimatch' % self.base_url
-        data, req_url = self._make_request(url, match_dict, 'POST')
+        data = self._bulk_request(match_dict)
         if raw:
             return data
         else:
             full_result = {}
-            for k, v in data.items():
-                if 'result' in v:
-                    full_result[k] = MatchResult(**v['result'])
-                else:
-                    logger.warn('Match Result Error: %s' % v)
+            with self.metrics.timer('build'):
+                for k, v in data.items():
+                    if 'result' in v:
+                        full_result[k] = MatchResult(**v['result'])
+                    else:
+                        logger.warn('Match Result Error: %s' % v)
             return full_result
 
+    def _match_chunk(self, people, raw, retries, on_error):
+        ''' Runs a single chunk of a parallel bulk match, retrying it on
+        failure. A chunk that keeps failing is logged and handed to
+        ``on_error`` instead of raising, so other chunks are unaffected.
+        '''
+        attempt = 0
+        while True:
+            try:
+                return self.bulk_match({'people': people}, raw)
+            except (MatchException, RequestException) as e:
+                if attempt >= retries:
+                    logger.error('Bulk match chunk of %s people failed: %s' % (
+                        len(people),
+                        e
+                    ))
+                    if on_error:
+                        on_error(people, e)
+                    return {}
+
+                time.sleep(self.transport.backoff_factor * (2 ** attempt))
+                attempt += 1
+
+    def parallel_bulk_match(self, match_dict, raw=False, chunk_size=100,
+                            workers=4, retries=2, on_error=None):
+        '''
+        Bulk matches any number of people. The people in ``match_dict``
+        (structured as for bulk_match) are split into chunks of
+        ``chunk_size``, which are sent through bulk_match concurrently on a
+        pool of ``workers`` threads. The results are merged into the same
+        structure bulk_match returns.
+
+        Failed chunks are retried up to ``retries`` times. A chunk that still
+        fails is left out of the results and passed to
+        ``on_error(people, exception)``, if given.
+
+        The transport's pool_size should be at least ``workers`` so every
+        thread can keep its connection alive.
+        '''
+        chunks = list(_batches(match_dict.get('people', {}).iteritems(),
+                               chunk_size))
+        if not chunks:
+            return {}
+
+        pool = ThreadPool(min(workers, len(chunks)))
+        try:
+            chunk_results = pool.map(
+                lambda chunk: self._match_chunk(chunk, raw, retries, on_error),
+                chunks
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+        full_result = {}
+        for chunk_result in chunk_results:
+            full_result.update(chunk_result)
+        return full_result
+
+    def match_batches(self, records, batch_size=100, workers=1, raw=False,
+                      retries=2, on_error=None):
+        '''
+        Matches an iterable of (id, person fields) records of any length,
+        such as rows from a CSV reader or a database cursor, in constant
+        memory. Records are read in batches of ``batch_size`` and each batch
+        is bulk matched (using the cache as usual). Yields a (batch, results)
+        pair for each batch, in input order, where results is what
+        bulk_match returned for it.
+
+        Up to ``workers`` batches are matched concurrently. Records are only
+        read as results are consumed, at most ``workers`` batches ahead.
+        Failed batches are retried and reported as for parallel_bulk_match.
+        '''
+        batches = _batches(records, batch_size)
+        if workers <= 1:
+            for batch in batches:
+                yield batch, self._match_chunk(batch, raw, retries, on_error)
+            return
+
+        pool = ThreadPool(workers)
+        pending = deque()
+        try:
+            for batch in batches:
+                pending.append((batch, pool.apply_async(
+                    self._match_chunk, (batch, raw, retries, on_error)
+                )))
+                if len(pending) < workers:
+                    continue
+                batch, results = pending.popleft()
+                yield batch, results.get()
+
+            while pending:
+                batch, results = pending.popleft()
+                yield batch, results.get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def match_stream(self, records, batch_size=100, workers=1, raw=False,
+                     retries=2, on_error=None):
+        '''
+        Same as match_batches, but yields the (id, MatchResult) pairs of each
+        batch as it completes.
+        '''
+        for _, results in self.match_batches(records, batch_size, workers,
+                                             raw, retries, on_error):
+            for item in results.iteritems():
+                yield item
+
+    def close(self):
+        ''' Waits for any background cache refreshes to finish '''
+        if self.refresher:
+            self.refresher.close()
+
+
+class S3ResultTier(object):
+    ''' Cache tier over the match results an S3CivisMatcher has stored in
+    S3, keyed by fbid. Writes go through _store_match_results, so its
+    overwrite rules still apply.
+    '''
+    name = 's3'
+
+    def __init__(self, matcher, workers=8):
+        self.matcher = matcher
+        self.workers = workers
+
+    def get(self, fbid):
+        return self.matcher._fetch_cached(fbid)[1]
+
+    def get_multi(self, fbids):
+        if isinstance(self.matcher.bucket, ResultStore):
+            return self.matcher._get_stored_multi(fbids)
+        return dict(
+            (fbid, data) for fbid, data, _ in
+            self.matcher.iter_cache_match(fbids, self.workers)
+            if data is not None
+        )
+
+    def set(self, fbid, value, time=0):
+        self.matcher._store_match_results({fbid: value})
+
+    def set_multi(self, mapping, time=0):
+        self.matcher._store_match_results(mapping)
+        return []
+
+    def delete(self, fbid):
+        self.matcher.bucket.delete_key(fbid)
+        self.matcher.bucket.delete_key(self.matcher.cache_keys.negative(fbid))
+
 
 class S3CivisMatcher(CivisMatcher):
 
     def __init__(self, aws_access_key_id, aws_secret_access_key,
                  user='edgeflip', password='civis!19',
                  bucket='civis_cache', cache_expiry_days=30,
-                 base_url='', timeout=5):
+                 base_url='', timeout=5, pool_size=10, max_retries=0,
+                 backoff_factor=0.5, transport=None, write_behind=False,
+                 flush_size=500, flush_interval=5, local_cache_size=0,
+                 local_cache_ttl=300, limiter=None, resilience=None,
+                 cache_soft_expiry_days=None, refresh_workers=2,
+                 metrics=None, serializer=None, negative_expiry_days=7,
+                 negative_index_size=10000):
         self.auth = (user, password)
+        self.serializer = serializer or DEFAULT_SERIALIZER
         self.caching_enabled = False
         self.expiry = datetime.now() - timedelta(days=cache_expiry_days)
+        self.hard_expiry = timedelta(days=cache_expiry_days)
+        # Results matching no one are stored under their own key (fbid:none)
+        # and only served for negative_expiry_days. A positive result stored
+        # for the fbid always takes precedence.
+        self.negative_expiry = None
+        # The no-match results this matcher has stored are also remembered
+        # in memory, so bulk_match can skip sending those fbids to Civis
+        # without a request to S3 per fbid
+        self.negative_index = None
+        if negative_expiry_days is not None:
+            self.negative_expiry = timedelta(days=negative_expiry_days)
+            if negative_index_size:
+                self.negative_index = LocalCache(
+                    negative_index_size,
+                    self.negative_expiry.total_seconds()
+                )
+        # Stored results older than the soft expiry are still served, but are
+        # re-matched in the background; past the hard expiry they're treated
+        # as missing. Only results stored with their query can be re-matched.
+        self.soft_expiry = None
+        self.refresher = None
+        if cache_soft_expiry_days is not None:
+            self.soft_expiry = timedelta(days=cache_soft_expiry_days)
+            self.refresher = BackgroundRefresher(
+                self._refresh_stored, refresh_workers
+            )
+        self.cache_keys = CacheKeyBuilder()
+        self.cache_stats = CacheStats()
+        self.metrics = metrics or Instrumentation()
+        self.in_flight = SingleFlight()
+        self.stale_cache = None
+        self.resilience = resilience or Resilience()
         self.base_url = base_url if base_url else CIVIS_BASE_URL
         self.timeout = timeout
-        self.s3_conn = boto.connect_s3(
-            aws_access_key_id, aws_secret_access_key
+        self.transport = transport or Transport(
+            auth=self.auth, timeout=timeout, pool_size=pool_size,
+            max_retries=max_retries, backoff_factor=backoff_factor,
+            limiter=limiter
         )
-        self.bucket = self._get_bucket(bucket)
+        # An already opened bucket can be passed in place of a bucket name
+        if isinstance(bucket, basestring):
+            self.s3_conn = boto.connect_s3(
+                aws_access_key_id, aws_secret_access_key
+            )
+            self.bucket = self._get_bucket(bucket)
+        else:
+            self.s3_conn = None
+            self.bucket = bucket
+        # Stored results are keyed by fbid, so they get their own tiers rather
+        # than sharing the request keyed ones
+        self.stored_cache = None
+        if local_cache_size:
+            self.stored_cache = TieredCache([
+                LocalCache(local_cache_size, local_cache_ttl),
+                S3ResultTier(self),
+            ])
+        # Optionally store match results from background threads
+        self.write_queue = None
+        if write_behind:
+            self.write_queue = WriteBehindQueue(
+                self._store_match_results, flush_size=flush_size,
+                flush_interval=flush_interval
+            )
 
     def _get_bucket(self, bucket_name):
         ''' Retrieves bucket if it exists, otherwise creates it '''
@@ -280,24 +1110,396 @@ class S3CivisMatcher(CivisMatcher):
         return bucket
 
     def cache_match(self, fbids):
+        if self.stored_cache:
+            fbids = list(fbids)
+            match_results = self.stored_cache.get_multi(fbids)
+            return match_results, len(set(fbids)) - len(match_results)
+
+        if isinstance(self.bucket, ResultStore):
+            fbids = list(fbids)
+            match_results = self._get_stored_multi(fbids)
+            return match_results, len(set(fbids)) - len(match_results)
+
         missing_count = 0
         match_results = {}
         for fbid in fbids:
-            key = self.bucket.get_key(fbid)
-            if not key:
+            data = self._read_stored(fbid, fbid)
+            if data is None and self.negative_expiry:
+                data = self._read_stored(fbid, self.cache_keys.negative(fbid))
+            if data is None:
                 missing_count += 1
                 continue
-
-            match_results[fbid] = json.loads(key.get_contents_as_string())
+            match_results[fbid] = data
 
         return match_results, missing_count
 
+    def _read_stored(self, fbid, name):
+        with self.metrics.timer('s3.get'):
+            key = self.bucket.get_key(name)
+            contents = key.get_contents_as_string() if key else None
+        if not key:
+            return None
+        with self.metrics.timer('parse'):
+            data = self.serializer.loads(contents)
+        self._resolve_people([data])
+        return self._check_stored(fbid, data)
+
+    def _check_stored(self, fbid, data):
+        ''' Applies the negative, soft and hard expiry to a stored result,
+        returning None if it has expired and scheduling a refresh if it's
+        stale
+        '''
+        if data is None or 'timestamp' not in data:
+            return data
+        negative = self.negative_expiry and _is_negative(data)
+        if not negative and not self.soft_expiry:
+            return data
+
+        stored_at = datetime.strptime(data['timestamp'], TIME_FORMAT)
+        now = datetime.now()
+        if negative and stored_at < now - self.negative_expiry:
+            return None
+        if not self.soft_expiry:
+            return data
+        if stored_at < now - self.hard_expiry:
+            return None
+        if stored_at < now - self.soft_expiry and data.get('query'):
+            self.refresher.schedule({fbid: data['query']})
+        return data
+
+    def _refresh_stored(self, queries):
+        self.bulk_match({'people': queries})
+
+    def _fetch_cached(self, fbid):
+        ''' Fetches a stored match directly, skipping the HEAD request
+        bucket.get_key makes. Returns the fbid, the stored data (None if
+        missing) and how long the fetch took.
+        '''
+        start = time.time()
+        data = self._get_stored(fbid, fbid)
+        if data is None and self.negative_expiry:
+            data = self._get_stored(fbid, self.cache_keys.negative(fbid))
+        return fbid, data, time.time() - start
+
+    def _get_stored(self, fbid, name, check=True):
+        try:
+            with self.metrics.timer('s3.get'):
+                contents = self.bucket.new_key(name).get_contents_as_string()
+        except S3ResponseError as e:
+            if e.status != 404:
+                raise
+            return None
+        with self.metrics.timer('parse'):
+            data = self.serializer.loads(contents)
+        self._resolve_people([data])
+        return self._check_stored(fbid, data) if check else data
+
+    def _get_stored_multi(self, fbids):
+        ''' Reads the results stored for a list of fbids in bulk, falling back
+        to the negative results of those with no positive one. Returns the
+        unexpired results by fbid.
+        '''
+        found = {}
+        names = dict(('%s' % fbid, fbid) for fbid in fbids)
+        pairs = [
+            (name, self.cache_keys.negative(name) if self.negative_expiry
+             else None)
+            for name in names
+        ]
+        with self.metrics.timer('s3.get'):
+            stored, _ = get_first(self.bucket, pairs)
+        with self.metrics.timer('parse'):
+            stored = dict(
+                (name, self.serializer.loads(contents))
+                for name, contents in stored.iteritems()
+            )
+        self._resolve_people(stored.values())
+        for name, data in stored.iteritems():
+            data = self._check_stored(names[name], data)
+            if data is not None:
+                found[names[name]] = data
+        return found
+
+    def _is_fresh(self, data):
+        ''' Whether a stored result is within its negative expiry, or its soft
+        expiry if set and its hard expiry otherwise
+        '''
+        if 'timestamp' not in data:
+            return True
+        if self.negative_expiry and _is_negative(data):
+            expiry = self.negative_expiry
+        else:
+            expiry = self.soft_expiry or self.hard_expiry
+        stored_at = datetime.strptime(data['timestamp'], TIME_FORMAT)
+        return stored_at >= datetime.now() - expiry
+
+    def _head_stored(self, fbid, name):
+        ''' Returns enough of a stored result to check its freshness: the
+        metadata from a HEAD request, or the whole result if it was stored
+        without metadata. None if nothing is stored under the name.
+        '''
+        with self.metrics.timer('s3.get'):
+            match_key = self.bucket.get_key(name)
+        if not match_key:
+            return None
+        stored_json = self._stored_metadata(match_key)
+        if stored_json and stored_json['timestamp']:
+            return stored_json
+        return self._get_stored(fbid, name, check=False)
+
+    def _fetch_freshness(self, fbid):
+        data = self._head_stored(fbid, fbid)
+        if self.negative_expiry and (data is None or not self._is_fresh(data)):
+            negative = self._head_stored(fbid, self.cache_keys.negative(fbid))
+            data = negative if negative is not None else data
+        return fbid, data
+
+    def _fetch_freshness_multi(self, fbids):
+        ''' Reads the stored results of a list of fbids, positive and
+        negative, in one bulk read. Their people aren't looked up, as only
+        their timestamps and counts are needed.
+        '''
+        names = dict(('%s' % fbid, fbid) for fbid in fbids)
+        negatives = []
+        if self.negative_expiry:
+            negatives = [self.cache_keys.negative(name) for name in names]
+        with self.metrics.timer('s3.get'):
+            contents = self.bucket.get_multi(names.keys() + negatives)
+        with self.metrics.timer('parse'):
+            stored = dict(
+                (name, self.serializer.loads(value))
+                for name, value in contents.iteritems()
+            )
+        fetched = []
+        for name, fbid in names.iteritems():
+            data = stored.get(name)
+            negative = stored.get(self.cache_keys.negative(name))
+            if negative is not None and (data is None or
+                                         not self._is_fresh(data)):
+                data = negative
+            fetched.append((fbid, data))
+        return fetched
+
+    def _find_stale(self, people, workers=8):
+        ''' Returns the people of a dict of fbid -> person fields with no
+        fresh result stored. Stores that read in bulk are read in one go,
+        otherwise the metadata of the stored results is fetched concurrently.
+        '''
+        if isinstance(self.bucket, ResultStore):
+            stored = self._fetch_freshness_multi(people.keys())
+        else:
+            pool = ThreadPool(min(workers, len(people)))
+            try:
+                stored = pool.map(self._fetch_freshness, people.keys())
+            finally:
+                pool.terminate()
+                pool.join()
+        return dict(
+            (fbid, people[fbid]) for fbid, data in stored
+            if data is None or not self._is_fresh(data)
+        )
+
+    def _warm(self, people):
+        ''' Matches and stores a dict of fbid -> person fields, returning the
+        results by fbid once they're stored
+        '''
+        data = self.bulk_match({'people': people})
+        self.flush()
+        return dict(
+            (fbid, data['%s' % fbid]) for fbid in people
+            if '%s' % fbid in data
+        )
+
+    def iter_cache_match(self, fbids, workers=8):
+        ''' Fetches stored matches concurrently on a pool of ``workers``
+        threads, yielding (fbid, data, seconds) as each fetch completes. data
+        is None for fbids with nothing stored.
+        '''
+        pool = ThreadPool(workers)
+        try:
+            for fetched in pool.imap_unordered(self._fetch_cached, fbids):
+                yield fetched
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def batch_cache_match(self, fbids, workers=8, callback=None):
+        ''' Concurrent version of cache_match. Returns the stored matches, a
+        list of the fbids with nothing stored, and latency statistics for the
+        individual fetches. If given, ``callback(fbid, data)`` is called for
+        each stored match as it arrives.
+        '''
+        match_results = {}
+        missing = []
+        latencies = []
+        for fbid, data, elapsed in self.iter_cache_match(fbids, workers):
+            latencies.append(elapsed)
+            if data is None:
+                missing.append(fbid)
+                continue
+
+            match_results[fbid] = data
+            if callback:
+                callback(fbid, data)
+
+        return match_results, missing, summarize_latencies(latencies)
+
+    def _stored_metadata(self, match_key):
+        ''' Reads the people_count and timestamp a result was stored with
+        from the metadata returned by the HEAD request, or None if the object
+        was written without (or with an older version of) that metadata
+        '''
+        version = match_key.get_metadata('schema-version')
+        if version != str(STORED_SCHEMA_VERSION):
+            return None
+        people_count = match_key.get_metadata('people-count') or 0
+        return {
+            'result': {'people_count': int(people_count)},
+            'timestamp': match_key.get_metadata('timestamp'),
+        }
+
+    def _put_stored(self, writes, match_key, match):
+        ''' Adds a result to ``writes``, along with the metadata
+        _store_match_results needs to compare it against later ones
+        '''
+        match['timestamp'] = datetime.now().strftime(TIME_FORMAT)
+        match_key.set_metadata('schema-version', str(STORED_SCHEMA_VERSION))
+        match_key.set_metadata('people-count', str(
+            match.get('result', {}).get('people_count', 0)
+        ))
+        match_key.set_metadata('timestamp', match['timestamp'])
+        writes.append((match_key, match))
+
+    def _write_stored(self, writes):
+        ''' Writes a list of (key, result), in one go if the store supports
+        bulk writes. Stores that index people are sent the people of each
+        result alongside it.
+        '''
+        if not writes:
+            return
+        people = {}
+        if self._indexes_people():
+            writes = [
+                (key, self._split_people(key.name, match, people))
+                for key, match in writes
+            ]
+        writes = [
+            (key, self.serializer.dumps(match)) for key, match in writes
+        ]
+        with self.metrics.timer('s3.put'):
+            if isinstance(self.bucket, ResultStore):
+                self.bucket.set_multi(dict(
+                    (key.name, (contents, key.metadata))
+                    for key, contents in writes
+                ), people)
+                return
+            for key, contents in writes:
+                key.set_contents_from_string(contents)
+
+    def _indexes_people(self):
+        return (isinstance(self.bucket, ResultStore) and
+                self.bucket.index_people)
+
+    def _split_people(self, fbid, match, people):
+        ''' Returns a copy of a result with its people replaced by the
+        digests of their records, adding the records to ``people`` by fbid.
+        A result without people still gets an empty entry, so the people of
+        the result it replaces are unlinked.
+        '''
+        result = match.get('result') or {}
+        if not result.get('people'):
+            people[fbid] = []
+            return match
+        people[fbid] = [
+            (person_digest(person), person.get('id'),
+             self.serializer.dumps(person))
+            for person in result['people']
+        ]
+        result = dict(result, person_refs=[
+            digest for digest, _, _ in people[fbid]
+        ])
+        del result['people']
+        return dict(match, result=result)
+
+    def _resolve_people(self, stored):
+        ''' Puts back the people of a list of stored results from the records
+        their digests refer to
+        '''
+        if not self._indexes_people():
+            return
+        refs = set()
+        for data in stored:
+            refs.update((data.get('result') or {}).get('person_refs', ()))
+        if not refs:
+            return
+        with self.metrics.timer('s3.get'):
+            records = self.bucket.get_people(refs)
+        for data in stored:
+            result = data.get('result') or {}
+            if 'person_refs' in result:
+                result['people'] = [
+                    self.serializer.loads(records[digest])
+                    for digest in result.pop('person_refs')
+                    if digest in records
+                ]
+
+    def fbids_for_person(self, person_id):
+        ''' Returns the fbids whose stored results include a Civis person.
+        Needs a store that indexes people, such as
+        ``storage.LocalBucket(index_people=True)``.
+        '''
+        if not self._indexes_people():
+            raise ValueError('The result store does not index people')
+        return self.bucket.fbids_for(person_id)
+
+    def person_ids_for_fbid(self, fbid):
+        ''' Returns the ids of the Civis people in the result stored for an
+        fbid. Needs a store that indexes people.
+        '''
+        if not self._indexes_people():
+            raise ValueError('The result store does not index people')
+        return self.bucket.person_ids_for('%s' % fbid)
+
     def _store_match_results(self, data):
+        ''' Stores each result unless what's stored for the fbid is at least
+        as good and hasn't expired. Stored results are compared using their
+        object metadata, so only objects written before it was added need to
+        be downloaded.
+        '''
+        writes = []
         for fbid, match in data.iteritems():
-            match_key = self.bucket.get_key(fbid)
-            if match_key:
-                stored_json = json.loads(match_key.get_contents_as_string())
-            else:
+            if self.negative_expiry and _is_negative(match):
+                # Only compared with the negative result already stored, as
+                # it never takes precedence over a positive one
+                name = self.cache_keys.negative(fbid)
+                with self.metrics.timer('s3.get'):
+                    match_key = self.bucket.get_key(name)
+                stored_json = match_key and self._stored_metadata(match_key)
+                if (stored_json and stored_json['timestamp'] and
+                        self._is_fresh(stored_json)):
+                    self.metrics.incr('s3.puts_skipped')
+                    self._index_negative(
+                        fbid, match, stored_json['timestamp']
+                    )
+                    continue
+                self._put_stored(
+                    writes, match_key or self.bucket.new_key(name), match
+                )
+                self._index_negative(fbid, match, match['timestamp'])
+                continue
+
+            if self.negative_index is not None:
+                self.negative_index.delete('%s' % fbid)
+
+            with self.metrics.timer('s3.get'):
+                match_key = self.bucket.get_key(fbid)
+                if match_key:
+                    stored_json = self._stored_metadata(match_key)
+                    if stored_json is None:
+                        stored_json = self.serializer.loads(
+                            match_key.get_contents_as_string()
+                        )
+            if not match_key:
                 match_key = self.bucket.new_key(fbid)
                 stored_json = {}
 
@@ -307,19 +1509,149 @@ class S3CivisMatcher(CivisMatcher):
                 stored_json.get('timestamp', datetime.now().strftime(TIME_FORMAT)),
                 TIME_FORMAT
             )
+            # A stale result is refreshed by one at least as good
+            refreshing = (
+                self.soft_expiry and match_count >= people_count and
+                cache_time < datetime.now() - self.soft_expiry
+            )
             if (not stored_json or
                     match_count > people_count or
-                    cache_time < self.expiry):
-                match['timestamp'] = datetime.now().strftime(TIME_FORMAT)
-                match_key.set_contents_from_string(json.dumps(match))
+                    cache_time < self.expiry or refreshing):
+                self._put_stored(writes, match_key, match)
+            else:
+                self.metrics.incr('s3.puts_skipped')
+        self._write_stored(writes)
 
     def bulk_match(self, match_dict, raw=False):
         ''' Very similar to its parent in regards to how the bulk matching
         is performed, however it does contain some minor differences. Instead
         of returning result objects, this will return raw JSON, and also
-        will store that raw JSON in S3 for later usage
+        will store that raw JSON in S3 for later usage. With write_behind
+        enabled the results are queued and stored in the background.
+
+        People this matcher stored a no-match result for within
+        negative_expiry_days aren't sent to Civis again, and get that result
+        instead.
         '''
-        url = '%s/multimatch' % self.base_url
-        data, req_url = self._make_request(url, match_dict, 'POST')
-        self._store_match_results(data)
+        people = match_dict.get('people', {})
+        negatives = {}
+        if self.negative_index is not None:
+            negatives = self.negative_index.get_multi(
+                '%s' % fbid for fbid in people
+            )
+        if negatives:
+            match_dict = dict(match_dict, people=dict(
+                (fbid, person) for fbid, person in people.items()
+                if '%s' % fbid not in negatives
+            ))
+        data = {}
+        if match_dict.get('people'):
+            data = self._bulk_request(match_dict)
+        stored = data
+        if self.refresher:
+            # Stored along with the fields matched on, so they can be
+            # refreshed once stale
+            people = dict(
+                ('%s' % fbid, person)
+                for fbid, person in match_dict.get('people', {}).items()
+            )
+            stored = dict(
+                (fbid, dict(result, query=people.get(fbid)))
+                for fbid, result in data.iteritems()
+            )
+        if self.write_queue:
+            self.write_queue.put(stored)
+        else:
+            self._store_match_results(stored)
+        if self.stored_cache:
+            self.stored_cache.discard(data.keys())
+        if negatives:
+            data = dict(data)
+            data.update(negatives)
         return data
+
+    def _index_negative(self, fbid, match, timestamp):
+        ''' Remembers a no-match result stored at ``timestamp`` until it
+        expires, without the fields added when it was stored
+        '''
+        if self.negative_index is None:
+            return
+        expires = (
+            datetime.strptime(timestamp, TIME_FORMAT) +
+            self.negative_expiry - datetime.now()
+        ).total_seconds()
+        if expires <= 0:
+            return
+        self.negative_index.set('%s' % fbid, dict(
+            (field, value) for field, value in match.items()
+            if field not in ('timestamp', 'query')
+        ), time=expires)
+
+    def flush(self):
+        ''' Stores any results still waiting in the write-behind queue '''
+        if self.write_queue:
+            return self.write_queue.flush()
+        return 0
+
+    def close(self):
+        ''' Flushes and stops the write-behind queue and any background
+        refreshes
+        '''
+        if self.refresher:
+            self.refresher.close()
+        if self.write_queue:
+            self.write_queue.close()
+
+
+class AsyncCivisMatcher(object):
+    ''' Non-blocking front end for a CivisMatcher or S3CivisMatcher. Calls
+    are dispatched to a shared pool of ``concurrency`` worker threads and
+    return a multiprocessing AsyncResult straight away; use ``.get()`` on it
+    to wait for the result, or pass a ``callback``. Results and errors are
+    exactly those of the wrapped matcher.
+
+    At most ``max_pending`` calls can be queued or running at once; further
+    calls block until one completes.
+
+    If no matcher is given a CivisMatcher is built from the remaining
+    keyword arguments, with a connection pool sized to ``concurrency``.
+    '''
+
+    def __init__(self, matcher=None, concurrency=10, max_pending=1000,
+                 **kwargs):
+        if matcher is None:
+            kwargs.setdefault('pool_size', concurrency)
+            matcher = CivisMatcher(**kwargs)
+        self.matcher = matcher
+        self.pool = ThreadPool(concurrency)
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+
+    def _submit(self, func, args, kwargs, callback):
+        self.semaphore.acquire()
+
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.semaphore.release()
+
+        return self.pool.apply_async(run, callback=callback)
+
+    def match(self, first_name, last_name, callback=None, **kwargs):
+        return self._submit(
+            self.matcher.match, (first_name, last_name), kwargs, callback
+        )
+
+    def bulk_match(self, match_dict, raw=False, callback=None):
+        return self._submit(
+            self.matcher.bulk_match, (match_dict, raw), {}, callback
+        )
+
+    def cache_match(self, fbids, callback=None):
+        ''' Only available when wrapping an S3CivisMatcher '''
+        return self._submit(self.matcher.cache_match, (fbids,), {}, callback)
+
+    def close(self):
+        ''' Waits for outstanding calls to finish and stops the workers '''
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,224 @@
+''' Timings and counters for each stage of a match: cache lookups and
+writes, HTTP round trips to Civis, parsing responses, building result
+objects and S3 reads and writes. Measurements go to any number of sinks,
+and a trace can break down a single call. With no sinks and no trace active
+each measurement costs a single check.
+'''
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+def summarize_latencies(samples):
+    ''' Summarizes a list of latencies, in seconds, as count/min/max/mean and
+    50th/99th percentiles
+    '''
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+    count = len(ordered)
+    return {
+        'count': count,
+        'min': ordered[0],
+        'max': ordered[-1],
+        'mean': sum(ordered) / count,
+        'p50': ordered[int(0.50 * (count - 1))],
+        'p99': ordered[int(0.99 * (count - 1))],
+    }
+
+
+class MemorySink(object):
+    ''' Keeps the last ``max_samples`` timings of each stage, and running
+    totals of each counter, in memory
+    '''
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = defaultdict(
+                lambda: deque(maxlen=self.max_samples)
+            )
+            self.counters = defaultdict(int)
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+    def summary(self):
+        with self._lock:
+            timings = dict(
+                (name, list(samples))
+                for name, samples in self.timings.items()
+            )
+            counters = dict(self.counters)
+        return {
+            'timings': dict(
+                (name, summarize_latencies(samples))
+                for name, samples in timings.items()
+            ),
+            'counters': counters,
+        }
+
+
+class LoggingSink(object):
+    ''' Logs every measurement, at debug level by default '''
+
+    def __init__(self, log=None, level=logging.DEBUG):
+        self.log = log or logger
+        self.level = level
+
+    def timing(self, name, seconds):
+        self.log.log(self.level, '%s took %.2fms' % (name, seconds * 1000))
+
+    def incr(self, name, count=1):
+        self.log.log(self.level, '%s +%s' % (name, count))
+
+
+class StatsdSink(object):
+    ''' Sends measurements to a StatsD server over UDP, as timers in
+    milliseconds and counters. Sending is fire and forget; failures are
+    ignored.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='civis_matcher'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, stat):
+        try:
+            self.socket.sendto(stat, self.address)
+        except socket.error:
+            pass
+
+    def timing(self, name, seconds):
+        self._send('%s.%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+    def incr(self, name, count=1):
+        self._send('%s.%s:%s|c' % (self.prefix, name, count))
+
+
+class Trace(object):
+    ''' Breakdown of a single call: the total seconds spent in each stage,
+    how many times each was entered, and any counters incremented
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.elapsed = None
+        self.stages = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def add(self, stage, seconds):
+        self.stages[stage] += seconds
+        self.calls[stage] += 1
+
+    def incr(self, name, count=1):
+        self.counters[name] += count
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    def as_dict(self):
+        return {
+            'elapsed': self.elapsed,
+            'stages': dict(self.stages),
+            'calls': dict(self.calls),
+            'counters': dict(self.counters),
+        }
+
+    def __repr__(self):
+        stages = ', '.join(
+            '%s=%.2fms' % (stage, seconds * 1000)
+            for stage, seconds in sorted(self.stages.items())
+        )
+        return '<Trace %.2fms: %s>' % ((self.elapsed or 0) * 1000, stages)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'stage', 'trace', 'start')
+
+    def __init__(self, metrics, stage, trace):
+        self.metrics = metrics
+        self.stage = stage
+        self.trace = trace
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        if self.trace is not None:
+            self.trace.add(self.stage, elapsed)
+        for sink in self.metrics.sinks:
+            sink.timing(self.stage, elapsed)
+        return False
+
+
+class Instrumentation(object):
+    ''' Routes the timings and counters a matcher records to its sinks, and
+    to the trace active on the current thread, if any
+    '''
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self._local = threading.local()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def timer(self, stage):
+        ''' Context manager timing a stage '''
+        trace = getattr(self._local, 'trace', None)
+        if trace is None and not self.sinks:
+            return _NULL_TIMER
+        return _Timer(self, stage, trace)
+
+    def incr(self, name, count=1):
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.incr(name, count)
+        for sink in self.sinks:
+            sink.incr(name, count)
+
+    @contextmanager
+    def trace(self):
+        ''' Collects a Trace of everything recorded on this thread within
+        the block. Work the matcher hands to other threads isn't included.
+        '''
+        previous = getattr(self._local, 'trace', None)
+        trace = self._local.trace = Trace()
+        try:
+            yield trace
+        finally:
+            trace.finish()
+            self._local.trace = previous
@@ -0,0 +1,123 @@
+import logging
+import time
+from itertools import islice
+
+from requests.exceptions import RequestException
+
+from civis_matcher.exceptions import MatchException
+
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchReport(object):
+    ''' Progress of a prefetch. ``fresh`` people were already cached and
+    skipped, ``fetched`` ones were matched and cached (``matched`` of them
+    matching someone, ``no_match`` no one) and ``failed`` ones couldn't be
+    matched.
+    '''
+
+    def __init__(self):
+        self.total = 0
+        self.fresh = 0
+        self.fetched = 0
+        self.matched = 0
+        self.no_match = 0
+        self.failed = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+    @property
+    def coverage(self):
+        ''' Fraction of the people seen so far that are now cached '''
+        if not self.total:
+            return 0.0
+        return float(self.fresh + self.fetched) / self.total
+
+    def record(self, people, results):
+        for person_id in people:
+            data = results.get(person_id) or {}
+            if 'result' not in data:
+                self.failed += 1
+                continue
+            self.fetched += 1
+            if data['result'].get('people_count'):
+                self.matched += 1
+            else:
+                self.no_match += 1
+
+    def as_dict(self):
+        return {
+            'total': self.total,
+            'fresh': self.fresh,
+            'fetched': self.fetched,
+            'matched': self.matched,
+            'no_match': self.no_match,
+            'failed': self.failed,
+            'batches': self.batches,
+            'elapsed': self.elapsed,
+            'coverage': self.coverage,
+        }
+
+    def __repr__(self):
+        return '<PrefetchReport %s/%s cached (%.1f%%), %s failed>' % (
+            self.fresh + self.fetched, self.total, self.coverage * 100,
+            self.failed
+        )
+
+
+class Prefetcher(object):
+    ''' Warms a matcher's cache for people ahead of time. Records are read
+    lazily in batches of ``batch_size``. The matcher's ``_find_stale`` picks
+    out the people of a batch that aren't freshly cached, and ``_warm``
+    matches and caches them through the bulk path.
+
+    With ``rate``, no more than that many people per second are sent to
+    Civis, on top of the limits the transport already applies.
+    ``progress(report)`` is called after every batch.
+    '''
+
+    def __init__(self, matcher, batch_size=100, rate=None, progress=None):
+        self.matcher = matcher
+        self.batch_size = batch_size
+        self.rate = rate
+        self.progress = progress
+
+    def _pace(self, sent, start):
+        ''' Sleeps until sending more stays within the rate budget '''
+        if not self.rate:
+            return
+        delay = start + float(sent) / self.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self, records):
+        report = PrefetchReport()
+        start = time.time()
+        records = iter(records)
+        while True:
+            batch = dict(islice(records, self.batch_size))
+            if not batch:
+                break
+
+            report.total += len(batch)
+            report.batches += 1
+            stale = self.matcher._find_stale(batch)
+            report.fresh += len(batch) - len(stale)
+            if stale:
+                self._pace(report.fetched + report.failed, start)
+                try:
+                    results = self.matcher._warm(stale)
+                except (MatchException, RequestException) as e:
+                    logger.error('Prefetch of %s people failed: %s' % (
+                        len(stale), e
+                    ))
+                    report.failed += len(stale)
+                else:
+                    report.record(stale, results)
+
+            report.elapsed = time.time() - start
+            if self.progress:
+                self.progress(report)
+
+        return report
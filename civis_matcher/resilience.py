@@ -0,0 +1,265 @@
+import logging
+import random
+import sys
+import threading
+import time
+import Queue
+from collections import deque
+
+from requests.exceptions import ConnectionError, Timeout
+
+from civis_matcher.exceptions import CircuitOpenError
+
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def is_transient(exc, statuses=RETRY_STATUSES):
+    ''' Whether an exception means Civis is unavailable or struggling, as
+    opposed to rejecting this particular request
+    '''
+    if isinstance(exc, (ConnectionError, Timeout)):
+        return True
+    return getattr(exc, 'status_code', None) in statuses
+
+
+class RetryPolicy(object):
+    ''' Retries transient failures up to ``retries`` times, sleeping for a
+    random time of up to ``backoff_factor * 2 ** attempt`` seconds (capped at
+    ``max_backoff``) between attempts. The jitter keeps clients that failed
+    together from retrying together.
+    '''
+
+    def __init__(self, retries=2, backoff_factor=0.5, max_backoff=10,
+                 statuses=RETRY_STATUSES):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+
+    def delay(self, attempt):
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        )
+
+
+class HedgePolicy(object):
+    ''' Sends a duplicate request when the first hasn't finished within the
+    ``percentile`` latency of recent successful calls, using whichever
+    answers first. Hedging starts once ``min_samples`` latencies have been
+    seen, and never fires sooner than ``min_delay`` seconds.
+    '''
+
+    def __init__(self, percentile=95, min_samples=20, window=500,
+                 min_delay=0.01):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies = deque(maxlen=window)
+
+    def record(self, latency):
+        self.latencies.append(latency)
+
+    def delay(self):
+        ''' Seconds to wait before hedging, or None if there aren't enough
+        samples yet
+        '''
+        samples = sorted(self.latencies)
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1,
+                    int(len(samples) * self.percentile / 100.0))
+        return max(self.min_delay, samples[index])
+
+
+class CircuitBreaker(object):
+    ''' Opens after ``failure_threshold`` consecutive transient failures,
+    failing calls straight away. After ``reset_timeout`` seconds a single
+    trial call is let through (half open), which closes the circuit again if
+    it succeeds.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            self._trial = False
+            if success:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    self.opens += 1
+                    logger.error('Civis circuit opened after %s failures' % (
+                        self.failures
+                    ))
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+class Resilience(object):
+    ''' Runs calls to Civis under an optional retry policy, hedge policy and
+    circuit breaker, counting what each of them did. With none of them
+    given, calls are made once as they are.
+    '''
+
+    def __init__(self, retry=None, hedge=None, breaker=None):
+        self.retry = retry
+        self.hedge = hedge
+        self.breaker = breaker
+        self.counters = dict.fromkeys([
+            'calls', 'attempts', 'retries', 'failures', 'hedged',
+            'hedge_wins', 'short_circuited', 'stale_served',
+        ], 0)
+        self._lock = threading.Lock()
+
+    def count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+    def call(self, func, *args, **kwargs):
+        return self._call(func, args, kwargs)
+
+    def call_releasing(self, release, func, *args, **kwargs):
+        ''' Same as call, for calls returning something that holds on to a
+        resource, such as a streamed response. ``release`` is called on the
+        result of a hedged attempt that loses the race, once it arrives.
+        '''
+        return self._call(func, args, kwargs, release)
+
+    def _call(self, func, args, kwargs, release=None):
+        self.count(calls=1)
+        statuses = self.retry.statuses if self.retry else RETRY_STATUSES
+        attempt = 0
+        while True:
+            if self.breaker and not self.breaker.allow():
+                self.count(short_circuited=1)
+                raise CircuitOpenError('Circuit open, not calling Civis')
+            try:
+                result = self._attempt(func, args, kwargs, release)
+            except Exception as e:
+                exc_info = sys.exc_info()
+                transient = is_transient(e, statuses)
+                if self.breaker:
+                    # Anything but a transient failure means Civis is up
+                    self.breaker.record(not transient)
+                if (not transient or not self.retry or
+                        attempt >= self.retry.retries):
+                    self.count(failures=1)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                delay = self.retry.delay(attempt)
+                attempt += 1
+                self.count(retries=1)
+                logger.warn('Civis call failed (%s), retry %s in %.2fs' % (
+                    e, attempt, delay
+                ))
+                time.sleep(delay)
+                continue
+
+            if self.breaker:
+                self.breaker.record(True)
+            return result
+
+    def _timed(self, func, args, kwargs):
+        self.count(attempts=1)
+        start = time.time()
+        result = func(*args, **kwargs)
+        if self.hedge:
+            self.hedge.record(time.time() - start)
+        return result
+
+    def _release_later(self, outcomes, release):
+        ''' Releases the result of the attempt still running, if it
+        succeeds
+        '''
+        def wait():
+            _, ok, value = outcomes.get()
+            if ok:
+                try:
+                    release(value)
+                except Exception as e:
+                    logger.warn('Failed to release hedged result: %s' % e)
+
+        thread = threading.Thread(target=wait)
+        thread.daemon = True
+        thread.start()
+
+    def _attempt(self, func, args, kwargs, release=None):
+        delay = self.hedge.delay() if self.hedge else None
+        if delay is None:
+            return self._timed(func, args, kwargs)
+
+        outcomes = Queue.Queue()
+
+        def run(hedged):
+            try:
+                outcomes.put((hedged, True, self._timed(func, args, kwargs)))
+            except Exception:
+                outcomes.put((hedged, False, sys.exc_info()))
+
+        def start(hedged):
+            thread = threading.Thread(target=run, args=(hedged,))
+            thread.daemon = True
+            thread.start()
+
+        start(False)
+        pending = 0
+        try:
+            outcome = outcomes.get(timeout=delay)
+        except Queue.Empty:
+            self.count(hedged=1)
+            start(True)
+            pending = 1
+            outcome = outcomes.get()
+
+        hedged, ok, value = outcome
+        if not ok and pending:
+            # The other request may still succeed
+            hedged, ok, value = outcomes.get()
+        elif pending and release:
+            self._release_later(outcomes, release)
+        if not ok:
+            raise value[0], value[1], value[2]
+        if hedged:
+            self.count(hedge_wins=1)
+        return value
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        if self.breaker:
+            stats['circuit'] = self.breaker.state
+            stats['circuit_opens'] = self.breaker.opens
+        if self.hedge:
+            stats['hedge_delay'] = self.hedge.delay()
+        return stats
@@ -0,0 +1,68 @@
+''' Serializers for match results stored in memcached and S3.
+
+Encoded values start with a header naming the format they're in, so they can
+always be read back whichever serializer is in use. Values without a header
+are from before serializers were added: plain JSON in S3, or objects pickled
+by the memcached client.
+'''
+import json
+import zlib
+
+
+HEADER = 'CMS'
+ZLIB_JSON = 1
+
+
+def _zlib_json(payload):
+    return json.loads(zlib.decompress(payload))
+
+
+FORMATS = {
+    ZLIB_JSON: _zlib_json,
+}
+
+
+def loads(value):
+    ''' Decodes a stored value written in any known format '''
+    if value is None or not isinstance(value, basestring):
+        # Missing, or pickled by the memcached client
+        return value
+    if value.startswith(HEADER):
+        version = ord(value[len(HEADER)])
+        if version not in FORMATS:
+            raise ValueError('Unknown serialization format: %s' % version)
+        return FORMATS[version](value[len(HEADER) + 1:])
+    return json.loads(value)
+
+
+class JsonSerializer(object):
+    ''' Plain JSON without a header, as results were stored before
+    serializers were added
+    '''
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def loads(self, value):
+        return loads(value)
+
+
+class CompressedJsonSerializer(object):
+    ''' Compact JSON compressed with zlib. Results repeat the same field
+    names for every person and score, which compresses well.
+    '''
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def dumps(self, data):
+        payload = json.dumps(data, separators=(',', ':'))
+        return '%s%s%s' % (
+            HEADER, chr(ZLIB_JSON), zlib.compress(payload, self.level)
+        )
+
+    def loads(self, value):
+        return loads(value)
+
+
+DEFAULT_SERIALIZER = CompressedJsonSerializer()
@@ -0,0 +1,287 @@
+''' Storage backends for S3CivisMatcher.
+
+S3CivisMatcher talks to its store through the subset of boto's Bucket and Key
+interface it needs: ``get_key(name)`` (a HEAD request returning a key with
+its metadata, or None), ``new_key(name)`` and ``delete_key(name)``, with keys
+providing ``get_contents_as_string()`` (raising a 404 S3ResponseError if
+missing), ``set_contents_from_string(contents)`` and ``get_metadata`` /
+``set_metadata``. Any object providing these can be passed as ``bucket``.
+
+Stores subclassing ResultStore also provide bulk reads and writes, which the
+matcher uses in place of a request per result. Those with ``index_people``
+set also store the people of each result once, by content, and index them by
+their Civis person id.
+'''
+import hashlib
+import json
+import sqlite3
+import threading
+
+from boto.exception import S3ResponseError
+
+
+def person_digest(person):
+    ''' Content address of a person record '''
+    return hashlib.sha1(json.dumps(person, sort_keys=True)).hexdigest()
+
+
+class ResultStore(object):
+    ''' Base class for stores S3CivisMatcher can read and write in bulk.
+    Subclasses implement the bucket interface above. The bulk methods
+    default to a call per name and should be overridden where the store can
+    do better. Stores that set ``index_people`` implement the person methods
+    at the end.
+    '''
+    index_people = False
+
+    def get_key(self, name):
+        raise NotImplementedError
+
+    def new_key(self, name):
+        raise NotImplementedError
+
+    def delete_key(self, name):
+        raise NotImplementedError
+
+    def get_multi(self, names):
+        ''' Returns the contents stored under each of names, by name '''
+        found = {}
+        for name in names:
+            try:
+                found[name] = self.new_key(name).get_contents_as_string()
+            except S3ResponseError as e:
+                if e.status != 404:
+                    raise
+        return found
+
+    def set_multi(self, mapping, people=None):
+        ''' Stores a dict of name -> (contents, metadata), along with the
+        people of those results as taken by put_people
+        '''
+        for name, (contents, metadata) in mapping.iteritems():
+            key = self.new_key(name)
+            for field, value in (metadata or {}).iteritems():
+                key.set_metadata(field, value)
+            key.set_contents_from_string(contents)
+        if people:
+            self.put_people(people)
+
+    def put_people(self, people):
+        ''' Stores the people of a dict of fbid -> list of (digest, person
+        id, record), replacing the people previously linked to each fbid.
+        Records already stored under a digest aren't stored again, and
+        records no result refers to any more are deleted.
+        '''
+        raise NotImplementedError
+
+    def get_people(self, digests):
+        ''' Returns the records stored under each of digests, by digest '''
+        raise NotImplementedError
+
+    def fbids_for(self, person_id):
+        ''' Returns the fbids whose results include the person id '''
+        raise NotImplementedError
+
+    def person_ids_for(self, fbid):
+        ''' Returns the person ids in the result stored for the fbid '''
+        raise NotImplementedError
+
+
+class StoredKey(object):
+    ''' Key of a LocalBucket, holding the metadata it was stored with '''
+
+    def __init__(self, bucket, name, metadata=None):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = dict(metadata or {})
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_contents_as_string(self):
+        contents = self.bucket.get_multi([self.name]).get(self.name)
+        if contents is None:
+            raise S3ResponseError(404, 'Not Found')
+        return contents
+
+    def set_contents_from_string(self, contents):
+        self.bucket.set_multi({self.name: (contents, self.metadata)})
+
+
+class LocalBucket(ResultStore):
+    ''' Stores results in a SQLite database at ``path`` instead of S3, for
+    batch jobs running on a single machine. Lookups are indexed by name and
+    the database is shared by every thread of the matcher. Writes are
+    committed in batches, one transaction per set_multi covering both the
+    results and their people.
+
+    With ``index_people`` each person record is kept once however many
+    results include it, and person ids and fbids can be looked up from each
+    other.
+    '''
+
+    def __init__(self, path=':memory:', max_variables=500,
+                 index_people=False):
+        self.path = path
+        self.max_variables = max_variables
+        self.index_people = index_people
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'name TEXT PRIMARY KEY, contents BLOB, metadata TEXT)'
+        )
+        if index_people:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS people ('
+                'digest TEXT PRIMARY KEY, person_id TEXT, record BLOB)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS person_fbids ('
+                'person_id TEXT, fbid TEXT, PRIMARY KEY (person_id, fbid))'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS person_fbids_fbid '
+                'ON person_fbids (fbid)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS person_refs ('
+                'fbid TEXT, digest TEXT, PRIMARY KEY (fbid, digest))'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS person_refs_digest '
+                'ON person_refs (digest)'
+            )
+        self._conn.commit()
+
+    def _select(self, query, names):
+        ''' Yields the rows of a query on a list of names, in chunks small
+        enough for SQLite's limit on query parameters. The query takes the
+        placeholders for a chunk as its format argument.
+        '''
+        names = list(names)
+        for start in xrange(0, len(names), self.max_variables):
+            chunk = names[start:start + self.max_variables]
+            with self._lock:
+                rows = self._conn.execute(
+                    query % ', '.join('?' * len(chunk)), chunk
+                ).fetchall()
+            for row in rows:
+                yield row
+
+    def get_key(self, name):
+        for _, metadata in self._select(
+                'SELECT name, metadata FROM results WHERE name IN (%s)',
+                [name]):
+            return StoredKey(self, name, json.loads(metadata))
+        return None
+
+    def new_key(self, name):
+        return StoredKey(self, name)
+
+    def delete_key(self, name):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM results WHERE name = ?', (name,))
+            if self.index_people:
+                self._prune(self._unlink([name]))
+
+    def get_multi(self, names):
+        return dict(
+            (name, str(contents)) for name, contents in self._select(
+                'SELECT name, contents FROM results WHERE name IN (%s)', names
+            )
+        )
+
+    def set_multi(self, mapping, people=None):
+        rows = [
+            (name, sqlite3.Binary(contents), json.dumps(metadata or {}))
+            for name, (contents, metadata) in mapping.iteritems()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)', rows
+            )
+            if people:
+                self._put_people(people)
+
+    def put_people(self, people):
+        self.set_multi({}, people)
+
+    def _put_people(self, people):
+        ''' Writes the people of put_people, as part of the transaction the
+        caller holds the lock for
+        '''
+        records = {}
+        links = []
+        refs = []
+        for fbid, fbid_people in people.iteritems():
+            for digest, person_id, record in fbid_people:
+                records[digest] = (digest, person_id, sqlite3.Binary(record))
+                refs.append((fbid, digest))
+                if person_id is not None:
+                    links.append((person_id, fbid))
+        replaced = self._unlink(people)
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO people VALUES (?, ?, ?)', records.values()
+        )
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO person_fbids VALUES (?, ?)', links
+        )
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO person_refs VALUES (?, ?)', refs
+        )
+        self._prune(replaced)
+
+    def _unlink(self, fbids):
+        ''' Removes the people linked to each of fbids, returning the digests
+        their results referred to
+        '''
+        rows = [(fbid,) for fbid in fbids]
+        replaced = set()
+        for row in rows:
+            replaced.update(digest for (digest,) in self._conn.execute(
+                'SELECT digest FROM person_refs WHERE fbid = ?', row
+            ))
+        self._conn.executemany('DELETE FROM person_fbids WHERE fbid = ?', rows)
+        self._conn.executemany('DELETE FROM person_refs WHERE fbid = ?', rows)
+        return replaced
+
+    def _prune(self, digests):
+        ''' Deletes the records of digests no result refers to any more '''
+        self._conn.executemany(
+            'DELETE FROM people WHERE digest = ? AND NOT EXISTS ('
+            'SELECT 1 FROM person_refs WHERE digest = ?)',
+            [(digest, digest) for digest in digests]
+        )
+
+    def get_people(self, digests):
+        return dict(
+            (digest, str(record)) for digest, record in self._select(
+                'SELECT digest, record FROM people WHERE digest IN (%s)',
+                digests
+            )
+        )
+
+    def fbids_for(self, person_id):
+        with self._lock:
+            return [fbid for (fbid,) in self._conn.execute(
+                'SELECT fbid FROM person_fbids WHERE person_id = ?',
+                (person_id,)
+            )]
+
+    def person_ids_for(self, fbid):
+        with self._lock:
+            return [person_id for (person_id,) in self._conn.execute(
+                'SELECT person_id FROM person_fbids WHERE fbid = ?', (fbid,)
+            )]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
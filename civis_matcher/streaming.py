@@ -0,0 +1,91 @@
+import json
+import re
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+_number_tail = re.compile(r'[0-9.eE+\-]*')
+
+
+class _Buffer(object):
+    ''' Accumulates chunks of a JSON document, discarding what's been
+    consumed so only the unread part is held in memory
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.data = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def read_more(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.data = self.data[self.pos:] + chunk
+                self.pos = 0
+                return True
+        self.exhausted = True
+        return False
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = _whitespace.match(self.data, self.pos).end()
+            if self.pos < len(self.data) or not self.read_more():
+                return
+
+    def expect(self, chars):
+        ''' Consumes and returns the next non-whitespace character, which must
+        be one of chars
+        '''
+        self.skip_whitespace()
+        char = self.data[self.pos:self.pos + 1]
+        if not char or char not in chars:
+            raise ValueError('Expected one of %r at position %s, got %r' % (
+                chars, self.pos, char
+            ))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        ''' Decodes the next complete JSON value, reading more chunks until
+        there's enough data to do so
+        '''
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.data, self.pos)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+
+            # A number running up to the end of the buffer may continue in
+            # the next chunk
+            tail = _number_tail.match(self.data, end).end()
+            if (isinstance(value, (int, long, float)) and
+                    not self.exhausted and tail == len(self.data)):
+                if self.read_more():
+                    continue
+            self.pos = end
+            return value
+
+
+def iter_object_items(chunks):
+    ''' Incrementally decodes a JSON object from an iterable of string
+    chunks, yielding (key, value) for each of its members as soon as it has
+    been read. Memory use depends on the size of a member rather than of the
+    whole document.
+    '''
+    buf = _Buffer(chunks)
+    buf.expect('{')
+    buf.skip_whitespace()
+    if buf.data[buf.pos:buf.pos + 1] == '}':
+        return
+
+    while True:
+        key = buf.decode()
+        buf.expect(':')
+        value = buf.decode()
+        yield key, value
+        if buf.expect(',}') == '}':
+            return
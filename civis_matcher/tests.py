@@ -1,11 +1,26 @@
+import gc
+import os
+import shutil
+import tempfile
 import unittest
 import json
+import pickle
+import socket
+import sqlite3
+from StringIO import StringIO
+import threading
+import time
+import weakref
 from datetime import datetime, timedelta
 
 from mock import Mock
 from boto.exception import S3ResponseError
+from requests.exceptions import ConnectionError
 
-from civis_matcher import matcher
+from civis_matcher import (
+    benchmark, cache, cli, columnar, fakes, matcher, metrics, resilience,
+    serialization, storage, streaming, throttle, transport, writebehind
+)
 
 
 class BaseCivisMatcher(unittest.TestCase):
@@ -14,11 +29,12 @@ class BaseCivisMatcher(unittest.TestCase):
         super(BaseCivisMatcher, self).setUp()
 
         # Requests Mock
-        self.orig_requests_get = matcher.requests.get
-        self.orig_requests_post = matcher.requests.post
+        self.orig_requests_session = transport.requests.Session
         self.requests_mock = Mock()
-        matcher.requests.get = self.requests_mock
-        matcher.requests.post = self.requests_mock
+        self.session_mock = Mock()
+        self.session_mock.get = self.requests_mock
+        self.session_mock.post = self.requests_mock
+        transport.requests.Session = Mock(return_value=self.session_mock)
 
         # pylibmc Mock
         self.orig_cache_client = matcher.pylibmc.Client
@@ -26,14 +42,14 @@ class BaseCivisMatcher(unittest.TestCase):
         self.client_mock = Mock()
         self.client_mock.set.return_value = None
         self.client_mock.get.return_value = None
+        self.client_mock.get_multi.return_value = {}
         self.cache_mock.return_value = self.client_mock
         matcher.pylibmc.Client = self.cache_mock
 
         self.cm = matcher.CivisMatcher(cache_hosts=['127.0.0.1'])
 
     def tearDown(self):
-        matcher.requests.get = self.orig_requests_get
-        matcher.requests.post = self.orig_requests_post
+        transport.requests.Session = self.orig_requests_session
         matcher.pylibmc.Client = self.orig_cache_client
 
         super(BaseCivisMatcher, self).tearDown()
@@ -282,6 +298,1240 @@ class TestCivisMatcher(BaseCivisMatcher):
             25.59
         )
 
+    def test_bulk_match_per_person_cache(self):
+        ''' People already cached by match() are served from the cache, and
+        only the misses are sent to the multimatch end point and cached
+        individually
+        '''
+        cached_person = {'first_name': 'Test', 'last_name': 'User'}
+        new_person = {'first_name': 'New', 'last_name': 'User'}
+        match_url = '%s/match' % self.cm.base_url
+        cached_key = self.cm._cache_key(match_url, cached_person)
+        new_key = self.cm._cache_key(match_url, new_person)
+        cached_result = {'error': False, 'result': {'people_count': 0,
+                                                    'people': []}}
+        new_result = {'error': False, 'result': {'people_count': 1,
+                                                 'people': [{'id': '1'}]}}
+        self.client_mock.get_multi.return_value = {cached_key: cached_result}
+        self.requests_mock.return_value = Mock(
+            status_code=200,
+            url='http://example.com/multimatch',
+            content=json.dumps({'1': new_result})
+        )
+        result = self.cm.bulk_match(
+            {'people': {0: cached_person, 1: new_person}}, raw=True
+        )
+        self.assertEqual(result, {'0': cached_result, '1': new_result})
+        post_body = json.loads(self.requests_mock.call_args[1]['data'])
+        self.assertEqual(post_body, {'people': {'1': new_person}})
+        self.assertEqual(self.client_mock.set_multi.call_count, 1)
+        written, = self.client_mock.set_multi.call_args[0]
+        self.assertEqual(written.keys(), [new_key])
+        self.assertEqual(serialization.loads(written[new_key]), new_result)
+        self.assertEqual(self.client_mock.set_multi.call_args[1],
+                         {'time': self.cm.expiry})
+
+    def test_bulk_match_all_cached(self):
+        ''' A fully cached bulk match never calls out to Civis '''
+        person = {'first_name': 'Test', 'last_name': 'User'}
+        key = self.cm._cache_key('%s/match' % self.cm.base_url, person)
+        self.client_mock.get_multi.return_value = {
+            key: {'error': False, 'result': {'people': []}}
+        }
+        result = self.cm.bulk_match({'people': {'a': person}})
+        assert isinstance(result['a'], matcher.MatchResult)
+        assert not self.requests_mock.called
+
+    def _multimatch_response(self, url, data, **kwargs):
+        ''' Echoes back a no-match result for every person posted, failing any
+        request that includes a person with the last name "Fail" and
+        answering with HTML any that includes one named "Html"
+        '''
+        people = json.loads(data)['people']
+        if any(p['last_name'] == 'Fail' for p in people.values()):
+            return Mock(status_code=500, url=url)
+        if any(p['last_name'] == 'Html' for p in people.values()):
+            return Mock(status_code=200, url=url, content='<html></html>')
+        return Mock(status_code=200, url=url, content=json.dumps(dict(
+            (person_id, {'error': False,
+                         'result': {'people_count': 0, 'people': []}})
+            for person_id in people
+        )))
+
+    def test_parallel_bulk_match(self):
+        ''' People are split into chunks which are matched and merged back
+        into a single result
+        '''
+        self.client_mock.get_multi.return_value = {}
+        self.requests_mock.side_effect = self._multimatch_response
+        match_dict = {'people': dict(
+            (i, {'first_name': 'Test', 'last_name': 'User%s' % i})
+            for i in range(5)
+        )}
+        result = self.cm.parallel_bulk_match(
+            match_dict, chunk_size=2, workers=3
+        )
+        self.assertEqual(sorted(result.keys()), ['0', '1', '2', '3', '4'])
+        assert isinstance(result['4'], matcher.MatchResult)
+        self.assertEqual(self.requests_mock.call_count, 3)
+
+    def test_parallel_bulk_match_chunk_failure(self):
+        ''' A failing chunk is retried and then reported, without affecting
+        the results of the other chunks, whether Civis fails it or returns
+        a body that can't be decoded
+        '''
+        self.cm.transport.backoff_factor = 0
+        self.requests_mock.side_effect = self._multimatch_response
+        errors = []
+        result = self.cm.parallel_bulk_match(
+            {'people': {
+                'a': {'first_name': 'Test', 'last_name': 'User'},
+                'b': {'first_name': 'Test', 'last_name': 'Fail'},
+                'c': {'first_name': 'Test', 'last_name': 'Html'},
+            }},
+            chunk_size=1, retries=1,
+            on_error=lambda people, e: errors.append((people, e))
+        )
+        self.assertEqual(result.keys(), ['a'])
+        self.assertEqual(
+            sorted(people.keys()[0] for people, _ in errors), ['b', 'c']
+        )
+        assert all(isinstance(e, matcher.MatchException) for _, e in errors)
+        # One call for the good chunk, two for each failing one
+        self.assertEqual(self.requests_mock.call_count, 5)
+
+    def _stream_response(self, data, chunk_size=7):
+        body = json.dumps(data)
+        return Mock(
+            status_code=200,
+            url='http://example.com/multimatch',
+            iter_content=Mock(return_value=(
+                body[i:i + chunk_size] for i in range(0, len(body), chunk_size)
+            ))
+        )
+
+    def test_iter_bulk_match(self):
+        ''' Results are decoded from the streamed response and yielded one at
+        a time, with error entries skipped
+        '''
+        people = {
+            'a': {'first_name': 'Test', 'last_name': 'User'},
+            'b': {'first_name': 'Test', 'last_name': 'Fail'},
+        }
+        self.requests_mock.return_value = self._stream_response({
+            'a': fakes.fake_result(people['a']),
+            'b': {'error': True, 'error_message': 'No match'},
+        })
+        results = self.cm.iter_bulk_match({'people': people})
+        person_id, result = next(results)
+        self.assertEqual(person_id, 'a')
+        self.assertEqual(result.people[0].first_name, 'TEST')
+        self.assertEqual(list(results), [])
+        self.assertEqual(self.requests_mock.call_args[1]['stream'], True)
+        self.assertEqual(self.client_mock.set_multi.call_count, 1)
+
+    def test_iter_bulk_match_error(self):
+        ''' An error returned by Civis for the whole request is raised '''
+        self.requests_mock.return_value = self._stream_response({
+            'error': True, 'error_id': 1, 'error_message': 'Fail'
+        })
+        with self.assertRaises(matcher.MatchException) as e:
+            list(self.cm.iter_bulk_match({'people': {
+                'a': {'first_name': 'Test', 'last_name': 'User'}
+            }}))
+        self.assertEqual(
+            e.exception.message,
+            'Error returned by Civis: id: 1, message: Fail, '
+            'url: http://example.com/multimatch'
+        )
+
+        self.requests_mock.return_value = self._stream_response({'a': 1})
+        self.requests_mock.return_value.iter_content.return_value = iter(
+            ['{"a": {"result": ', '<html>']
+        )
+        with self.assertRaises(ValueError):
+            list(self.cm.iter_bulk_match({'people': {
+                'a': {'first_name': 'Test', 'last_name': 'User'}
+            }}))
+        self.assertTrue(self.requests_mock.return_value.close.called)
+
+    def test_iter_bulk_match_stopped_early(self):
+        ''' Stopping iteration early closes the response and releases the
+        people still in flight
+        '''
+        people = dict(
+            (i, {'first_name': 'Test', 'last_name': 'User%s' % i})
+            for i in range(3)
+        )
+        self.requests_mock.return_value = self._stream_response(dict(
+            ('%s' % i, fakes.fake_result(person))
+            for i, person in people.items()
+        ))
+        results = self.cm.iter_bulk_match({'people': people})
+        next(results)
+        results.close()
+        self.assertEqual(self.cm.in_flight.stats()['in_flight'], 0)
+        self.assertTrue(self.requests_mock.return_value.close.called)
+
+    def test_iter_bulk_match_match_in_loop(self):
+        ''' People of a streamed batch can be matched while its results are
+        being consumed, without waiting on the stream
+        '''
+        people = {
+            'a': {'first_name': 'Test', 'last_name': 'User1'},
+            'b': {'first_name': 'Test', 'last_name': 'User2'},
+        }
+        self.requests_mock.return_value = self._stream_response(dict(
+            (person_id, fakes.fake_result(person))
+            for person_id, person in people.items()
+        ))
+        self.session_mock.get = Mock(return_value=Mock(
+            status_code=200, url='x',
+            content=json.dumps(fakes.fake_result(people['b']))
+        ))
+        matched = []
+        for person_id, _ in self.cm.iter_bulk_match({'people': people}):
+            other = people['b' if person_id == 'a' else 'a']
+            thread = threading.Thread(
+                target=lambda: matched.append(self.cm.match(**other))
+            )
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            break
+        self.assertEqual(len(matched), 1)
+
+    def test_match_stream(self):
+        ''' Records from any iterable are matched in batches and yielded
+        lazily, reading at most one batch per worker ahead
+        '''
+        self.requests_mock.side_effect = self._multimatch_response
+        consumed = []
+
+        def records():
+            for i in range(7):
+                consumed.append(i)
+                yield i, {'first_name': 'Test', 'last_name': 'User%s' % i}
+
+        for workers in (1, 2):
+            del consumed[:]
+            self.requests_mock.reset_mock()
+            results = self.cm.match_stream(records(), batch_size=3,
+                                           workers=workers)
+            person_id, result = next(results)
+            assert isinstance(result, matcher.MatchResult)
+            self.assertEqual(len(consumed), 3 * workers)
+            rest = list(results)
+            self.assertEqual(
+                sorted([person_id] + [r[0] for r in rest]),
+                ['0', '1', '2', '3', '4', '5', '6']
+            )
+            self.assertEqual(self.requests_mock.call_count, 3)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_iter_object_items(self):
+        ''' Objects are decoded correctly however the document is chunked '''
+        doc = {'a': {'b': [1, 2.5, {'c': u'\xe9'}]}, 'd': 12345, 'e': True,
+               'f': None, 'g': 'x,}{"', 'h': -1.5e3}
+        body = json.dumps(doc, indent=2)
+        for size in range(1, 30):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(
+                dict(streaming.iter_object_items(chunks)), doc
+            )
+        self.assertEqual(list(streaming.iter_object_items([' {', '} '])), [])
+
+    def test_truncated_document(self):
+        ''' A document that ends early raises a ValueError '''
+        with self.assertRaises(ValueError):
+            list(streaming.iter_object_items(['{"a": {"b": 1']))
+        with self.assertRaises(ValueError):
+            list(streaming.iter_object_items(['{"a": 1', ', "b"']))
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = fakes.fake_result({'first_name': 'Test'}, people_count=3)
+        for serializer in (serialization.JsonSerializer(),
+                           serialization.CompressedJsonSerializer()):
+            self.assertEqual(serializer.loads(serializer.dumps(data)), data)
+        compressed = serialization.DEFAULT_SERIALIZER.dumps(data)
+        self.assertTrue(compressed.startswith(serialization.HEADER))
+        self.assertLess(len(compressed), len(json.dumps(data)) / 2)
+
+    def test_reads_old_entries(self):
+        ''' Plain JSON from S3 and objects pickled by memcached are read as
+        they are
+        '''
+        data = {'error': False, 'result': {'people_count': 0}}
+        self.assertEqual(serialization.loads(json.dumps(data)), data)
+        self.assertIs(serialization.loads(data), data)
+        self.assertIsNone(serialization.loads(None))
+        with self.assertRaises(ValueError):
+            serialization.loads(serialization.HEADER + chr(99) + 'x')
+
+    def test_serializing_client(self):
+        memcache = fakes.FakeMemcache()
+        memcache.set('old', {'result': {}})
+        client = cache.SerializingClient(
+            memcache, serialization.DEFAULT_SERIALIZER
+        )
+        client.set_multi({'new': {'result': {'people_count': 1}}})
+        self.assertTrue(memcache.get('new').startswith(serialization.HEADER))
+        self.assertEqual(client.get_multi(['old', 'new']), {
+            'old': {'result': {}}, 'new': {'result': {'people_count': 1}},
+        })
+        self.assertEqual(client.name, 'memcached')
+
+
+class TestColumnar(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = {
+            '1': fakes.fake_result({'first_name': 'a'}, people_count=2),
+            '2': fakes.fake_result({'first_name': 'b'}, people_count=0),
+            '3': {'error': False, 'result': {'people_count': 1, 'people': [
+                {'id': '9', 'score': 40, 'scores': {'persuasion_score': 5.0,
+                                                    'other': None}},
+            ]}},
+        }
+        self.raw['1']['result']['people'][1]['score'] = 'n/a'
+        self.raw['1']['result']['people'][1]['scores'] = {
+            'persuasion_score': 15.0, 'turnout_2013': 75.0
+        }
+
+    def test_to_columns(self):
+        ''' Results become a row per person matched, and raw results and
+        MatchResults give the same columns
+        '''
+        columns = columnar.to_columns(self.raw, fields=('id', 'state'))
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(sorted(columns['match_id']), ['1', '1', '3'])
+        self.assertEqual(sorted(columns.scores), [
+            'other', 'persuasion_score', 'support_cand_2013', 'turnout_2013'
+        ])
+        self.assertEqual(columns.names[:3], ['match_id', 'id', 'state'])
+
+        results = dict(
+            (key, matcher.MatchResult(**value['result']))
+            for key, value in self.raw.items()
+        )
+        results['3'].people
+        built = columnar.to_columns(results, fields=('id', 'state'))
+        for name in columns.names:
+            self.assertEqual(map(repr, built[name]), map(repr, columns[name]))
+
+    def test_summarize(self):
+        ''' Scores are summarized like the result level scores Civis
+        returns, skipping people without them
+        '''
+        columns = columnar.to_columns(self.raw, fields=('score',))
+        summary = columns.summarize()
+        self.assertEqual(summary['persuasion_score']['count'], 3)
+        self.assertEqual(summary['persuasion_score']['min'], 5.0)
+        self.assertEqual(summary['persuasion_score']['max'], 25.59)
+        self.assertAlmostEqual(summary['persuasion_score']['mean'],
+                               (25.59 + 15 + 5) / 3)
+        self.assertAlmostEqual(summary['turnout_2013']['std'],
+                               (85.419 - 75) / 2)
+        self.assertEqual(summary['other'], {
+            'count': 0, 'min': None, 'max': None, 'mean': None, 'std': None
+        })
+        self.assertEqual(columns.summarize(['score'])['score']['count'], 1)
+
+        one = fakes.fake_result({}, people_count=1)
+        self.assertEqual(
+            columnar.to_columns({'1': one}).summarize(),
+            one['result']['scores']
+        )
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_to_records(self):
+        records = columnar.to_columns(self.raw).to_records()
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records.dtype.names[:2], ('match_id', 'id'))
+
+
+class TestMatchResult(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMatchResult, self).setUp()
+        self.raw = fakes.fake_result({'first_name': 'Test',
+                                      'last_name': 'User'}, 2)['result']
+        self.raw['people'][0]['new_field'] = 'new'
+        self.raw['score_mean'] = 357
+
+    def test_people_built_lazily(self):
+        ''' People are only built into Person objects when accessed '''
+        result = matcher.MatchResult(**self.raw)
+        self.assertEqual(result.people_count, 2)
+        self.assertEqual(result.score_mean, 357)
+        assert result._people is None
+        person = result.people[0]
+        assert isinstance(person, matcher.Person)
+        assert result.people[0] is person
+        self.assertEqual(person.first_name, 'TEST')
+        self.assertEqual(person.scores['persuasion_score'], 25.59)
+        self.assertEqual(person.TokenCount, 6)
+        with self.assertRaises(AttributeError):
+            person.birth_day
+
+    def test_unknown_fields(self):
+        ''' Fields outside the known set are still available as attributes '''
+        result = matcher.MatchResult(extra_info='x', **self.raw)
+        result.note = 'added'
+        self.assertEqual(result.extra_info, 'x')
+        self.assertEqual(result.note, 'added')
+        self.assertEqual(result.people[0].new_field, 'new')
+        with self.assertRaises(AttributeError):
+            result.people[1].new_field
+
+    def test_pickle(self):
+        ''' Results survive pickling, as pylibmc would do '''
+        result = matcher.MatchResult(url='http://example.com', **self.raw)
+        for protocol in (0, 2):
+            loaded = pickle.loads(pickle.dumps(result, protocol))
+            self.assertEqual(loaded.to_dict(), result.to_dict())
+            self.assertEqual(loaded.url, 'http://example.com')
+            self.assertEqual(loaded.people[0].new_field, 'new')
+
+class TestCacheKeys(BaseCivisMatcher):
+
+    def test_key_normalization(self):
+        ''' Field order, case and whitespace don't change the key, but the
+        namespace and version do
+        '''
+        builder = cache.CacheKeyBuilder()
+        key = builder.key('http://example.com/match', {
+            'first_name': 'Test', 'last_name': 'User', 'state': 'IL'
+        })
+        self.assertEqual(key, builder.key('http://example.com/match', {
+            'State': ' il', 'last_name': 'USER ', 'first_name': 'test',
+            'city': '',
+        }))
+        assert key.startswith('civis:v%s:' % cache.CACHE_KEY_VERSION)
+        self.assertNotEqual(
+            key,
+            cache.CacheKeyBuilder(version=2).key('http://example.com/match', {
+                'first_name': 'Test', 'last_name': 'User', 'state': 'IL'
+            })
+        )
+
+    def test_read_and_write_use_same_key(self):
+        ''' A match result is written under the key it's later read from, and
+        the hit/miss counters are updated
+        '''
+        result = {'error': False,
+                  'result': {'people_count': 1, 'people': [{'id': '1'}]}}
+        self.requests_mock.return_value = Mock(
+            status_code=200,
+            url='http://example.com/match',
+            content=json.dumps(result)
+        )
+        self.cm.match('Test', 'User', state='IL')
+        self.assertEqual(self.client_mock.get_multi.call_count, 1)
+        read_key = self.client_mock.get_multi.call_args_list[0][0][0][0]
+        write_key = self.client_mock.set.call_args[0][0]
+        self.assertEqual(read_key, write_key)
+
+        self.client_mock.get_multi.return_value = {
+            read_key: serialization.DEFAULT_SERIALIZER.dumps(result)
+        }
+        self.cm.match('test', 'user ', state='il')
+        # The negative entry is read in the same request
+        self.assertEqual(self.client_mock.get_multi.call_args[0][0],
+                         [read_key, read_key + ':none'])
+        self.assertEqual(self.cm.cache_stats.as_dict(), {
+            'hits': 1, 'misses': 1, 'sets': 1, 'negative_hits': 0,
+            'hit_rate': 0.5
+        })
+
+
+class TestTieredCache(BaseCivisMatcher):
+
+    def test_local_cache_lru_and_ttl(self):
+        ''' The least recently used entry is evicted once the cache is full,
+        and entries expire after their TTL
+        '''
+        local = cache.LocalCache(max_size=2, ttl=60)
+        local.set('a', 1)
+        local.set('b', 2)
+        local.get('a')
+        local.set('c', 3)
+        self.assertEqual(local.get_multi(['a', 'b', 'c']), {'a': 1, 'c': 3})
+        self.assertEqual(local.stats()['evictions'], 1)
+
+        local.set('a', 1, time=-1)
+        self.assertEqual(local.get('a'), None)
+        self.assertEqual(local.stats()['expirations'], 1)
+
+    def test_read_through_fills_upper_tiers(self):
+        ''' Hits in memcached are copied into the local tier, and per tier hit
+        rates are reported
+        '''
+        self.client_mock.get_multi.return_value = {'b': 2}
+        self.client_mock.get.return_value = None
+        local = cache.LocalCache()
+        local.set('a', 1)
+        memcached = cache.LockedClient(self.client_mock)
+        tiered = cache.TieredCache([local, memcached])
+        self.assertEqual(tiered.get_multi(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        self.assertEqual(local.get('b'), 2)
+        self.client_mock.get_multi.assert_called_once_with(['b', 'c'])
+        local_stats, memcached_stats = tiered.stats()
+        self.assertEqual(local_stats['hits'], 1)
+        self.assertEqual(local_stats['misses'], 2)
+        self.assertEqual(local_stats['size'], 2)
+        self.assertEqual(memcached_stats['hit_rate'], 0.5)
+
+    def test_write_through(self):
+        ''' Sets go to every tier with write_through, otherwise only to the
+        last tier
+        '''
+        local = cache.LocalCache()
+        cache.TieredCache([local, self.client_mock]).set('a', 1, time=10)
+        self.assertEqual(local.get('a'), 1)
+        self.client_mock.set.assert_called_once_with('a', 1, time=10)
+
+        local = cache.LocalCache()
+        cache.TieredCache(
+            [local, self.client_mock], write_through=False
+        ).set('b', 2)
+        self.assertEqual(local.get('b'), None)
+
+    def test_matcher_local_tier(self):
+        ''' A repeated match is served from the in-process tier without
+        going to memcached or Civis
+        '''
+        cm = matcher.CivisMatcher(cache_hosts=['127.0.0.1'],
+                                  local_cache_size=10)
+        self.requests_mock.return_value = Mock(
+            status_code=200,
+            url='http://example.com/match',
+            content=json.dumps({'error': False, 'result': {
+                'people_count': 1, 'people': [{'id': '1'}]
+            }})
+        )
+        cm.match('Test', 'User')
+        lookups = self.client_mock.get_multi.call_count
+        cm.match('Test', 'User')
+        self.assertEqual(self.requests_mock.call_count, 1)
+        self.assertEqual(self.client_mock.get_multi.call_count, lookups)
+        self.assertEqual(cm.cache.stats()[0]['hits'], 1)
+
+    def test_stale_while_revalidate(self):
+        ''' Past the soft expiry the cached result is returned straight
+        away and refreshed in the background
+        '''
+        memcache = fakes.FakeMemcache()
+        cm = matcher.CivisMatcher(cache_tiers=[memcache], cache_soft_expiry=60)
+        key = cm._cache_key('%s/match' % cm.base_url,
+                            {'first_name': 'Test', 'last_name': 'User'})
+        memcache.set(key, {'error': False, 'cached_at': time.time() - 120,
+                           'result': {'people_count': 1, 'people': []}})
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='x', content=json.dumps({key: {
+                'error': False, 'result': {'people_count': 2, 'people': []}
+            }})
+        )
+
+        self.assertEqual(cm.match('Test', 'User').people_count, 1)
+        cm.close()
+        self.assertEqual(cm.refresher.stats()['refreshed'], 1)
+        refreshed = memcache.get(key)
+        self.assertEqual(refreshed['result']['people_count'], 2)
+        self.assertGreater(refreshed['cached_at'], time.time() - 5)
+        self.assertEqual(cm.match('Test', 'User').people_count, 2)
+        self.assertEqual(self.requests_mock.call_count, 1)
+
+        people = {'people': {'1': {'first_name': 'Test',
+                                   'last_name': 'User'}}}
+        self.assertEqual(sorted(cm.bulk_match(people, raw=True)['1']),
+                         ['error', 'result'])
+
+    def test_negative_cache(self):
+        ''' No-match results are cached under their own key for a shorter
+        time and served without calling Civis, but a positive result for the
+        same person takes precedence
+        '''
+        no_match = {'error': False, 'result': {'people_count': 0,
+                                               'people': []}}
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='x', content=json.dumps(no_match)
+        )
+        self.cm.match('Test', 'User')
+        key = self.cm._cache_key('%s/match' % self.cm.base_url,
+                                 {'first_name': 'Test', 'last_name': 'User'})
+        self.assertEqual(self.client_mock.set.call_args[0][0], key + ':none')
+        self.assertEqual(self.client_mock.set.call_args[1], {'time': 600})
+
+        memcache = fakes.FakeMemcache()
+        cm = matcher.CivisMatcher(cache_tiers=[memcache])
+        memcache.set(key + ':none', no_match)
+        self.assertEqual(cm.match('Test', 'User').people_count, 0)
+        self.assertEqual(self.requests_mock.call_count, 1)
+        self.assertEqual(cm.cache_stats.negative_hits, 1)
+
+        memcache.set(key, {'error': False, 'result': {'people_count': 2}})
+        self.assertEqual(cm.match('Test', 'User').people_count, 2)
+
+    def test_prefetch(self):
+        ''' Prefetching skips people that are freshly cached, matches and
+        caches the rest and reports the coverage
+        '''
+        memcache = fakes.FakeMemcache()
+        cm = matcher.CivisMatcher(cache_tiers=[memcache])
+        url = '%s/match' % cm.base_url
+        people = {
+            '1': {'first_name': 'Test', 'last_name': 'User1'},
+            '2': {'first_name': 'Test', 'last_name': 'User2'},
+            '3': {'first_name': 'Test', 'last_name': 'User3'},
+        }
+        memcache.set(cm._cache_key(url, people['1']),
+                     {'error': False, 'result': {'people_count': 1}})
+        key2 = cm._cache_key(url, people['2'])
+        key3 = cm._cache_key(url, people['3'])
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='x', content=json.dumps({
+                key2: {'error': False, 'result': {'people_count': 1}},
+                key3: {'error': False, 'result': {'people_count': 0}},
+            })
+        )
+        reports = []
+
+        report = cm.prefetch(people.iteritems(), batch_size=2,
+                             progress=lambda r: reports.append(r.total))
+        self.assertEqual(reports, [2, 3])
+        self.assertEqual(report.as_dict()['fresh'], 1)
+        self.assertEqual((report.matched, report.no_match), (1, 1))
+        self.assertEqual(report.coverage, 1.0)
+        self.assertEqual(memcache.get(key2)['result']['people_count'], 1)
+        self.assertTrue(memcache.get(key3 + ':none'))
+
+        self.requests_mock.side_effect = ConnectionError()
+        self.assertEqual(cm.prefetch(people.iteritems()).fresh, 3)
+
+    def test_prefetch_without_cache(self):
+        ''' Prefetching without a cache raises instead of matching people
+        whose results would be thrown away
+        '''
+        cm = matcher.CivisMatcher()
+        self.assertFalse(cm.caching_enabled)
+        with self.assertRaises(ValueError):
+            cm.prefetch([('1', {'first_name': 'Test', 'last_name': 'User'})])
+        assert not self.requests_mock.called
+
+
+class TestSingleFlight(BaseCivisMatcher):
+
+    def _run_concurrently(self, func, count):
+        ''' Calls func from count threads, returning results and errors '''
+        results = []
+        errors = []
+
+        def run():
+            try:
+                results.append(func())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results, errors
+
+    def _slow_response(self, release, response):
+        def respond(*args, **kwargs):
+            release.wait(5)
+            return response
+        return respond
+
+    def test_concurrent_matches_coalesced(self):
+        ''' Identical concurrent matches make a single call to Civis and all
+        share its result
+        '''
+        release = threading.Event()
+        self.requests_mock.side_effect = self._slow_response(release, Mock(
+            status_code=200,
+            url='http://example.com/match',
+            content=json.dumps({'error': False, 'result': {'people': []}})
+        ))
+        threading.Timer(0.2, release.set).start()
+        results, errors = self._run_concurrently(
+            lambda: self.cm.match('Test', 'User'), 5
+        )
+        self.assertEqual(len(results), 5)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.requests_mock.call_count, 1)
+        stats = self.cm.in_flight.stats()
+        self.assertEqual(stats['leaders'], 1)
+        self.assertEqual(stats['coalesced'], 4)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_shared_exception(self):
+        ''' Every waiter receives the exception raised by the shared call '''
+        release = threading.Event()
+        self.requests_mock.side_effect = self._slow_response(release, Mock(
+            status_code=500, url='http://example.com/match'
+        ))
+        threading.Timer(0.2, release.set).start()
+        results, errors = self._run_concurrently(
+            lambda: self.cm.match('Test', 'User'), 3
+        )
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        assert all(isinstance(e, matcher.MatchException) for e in errors)
+        self.assertEqual(self.requests_mock.call_count, 1)
+
+    def test_bulk_waits_on_in_flight_person(self):
+        ''' A person already being matched isn't sent again by bulk_match,
+        which uses the in-flight result instead
+        '''
+        person = {'first_name': 'Test', 'last_name': 'User'}
+        key = self.cm._cache_key('%s/match' % self.cm.base_url, person)
+        call, leader = self.cm.in_flight.begin(key)
+        shared = {'error': False, 'result': {'people': []}}
+        threading.Timer(
+            0.1, self.cm.in_flight.finish, (key, call), {'result': shared}
+        ).start()
+        result = self.cm.bulk_match({'people': {'a': person}}, raw=True)
+        self.assertEqual(result, {'a': shared})
+        assert not self.requests_mock.called
+
+
+class TestTransport(BaseCivisMatcher):
+
+    def test_matcher_uses_shared_session(self):
+        ''' Every request a matcher makes should go through the same pooled
+        session rather than opening a new one per call
+        '''
+        self.requests_mock.return_value = Mock(
+            status_code=200,
+            url='http://example.com/test',
+            content=json.dumps({'error': False, 'result': {'people': []}})
+        )
+        self.cm.match('Test', 'User')
+        self.cm.match('Test', 'User2')
+        self.assertEqual(transport.requests.Session.call_count, 1)
+        self.assertEqual(self.requests_mock.call_count, 2)
+        self.assertEqual(self.cm.transport.request_count, 2)
+
+    def test_retry_on_connection_error(self):
+        ''' Connection failures are retried up to max_retries times '''
+        ok_resp = Mock(status_code=200)
+        self.requests_mock.side_effect = [ConnectionError('down'), ok_resp]
+        trans = transport.Transport(max_retries=1, backoff_factor=0)
+        self.assertEqual(trans.get('http://example.com'), ok_resp)
+        self.assertEqual(trans.retry_count, 1)
+
+        self.requests_mock.side_effect = ConnectionError('still down')
+        with self.assertRaises(ConnectionError):
+            trans.get('http://example.com')
+
+    def test_pool_stats(self):
+        ''' The adapter is configured with the requested pool size and its
+        pools are reported through stats()
+        '''
+        transport.requests.Session = self.orig_requests_session
+        trans = transport.Transport(pool_size=25)
+        trans.adapter.poolmanager.connection_from_url(
+            'http://match.civisanalytics.com'
+        )
+        stats = trans.stats()
+        self.assertEqual(stats['pool_size'], 25)
+        self.assertEqual(stats['requests'], 0)
+        self.assertEqual(stats['pools'][0]['host'], 'match.civisanalytics.com')
+        self.assertEqual(stats['pools'][0]['connections_opened'], 0)
+
+
+class TestAdaptiveLimiter(BaseCivisMatcher):
+
+    def test_aimd_window(self):
+        ''' The window grows additively on success and halves on failure,
+        at most once per cooldown
+        '''
+        limiter = throttle.AdaptiveLimiter(window=4, cooldown=60)
+        limiter.acquire()
+        limiter.release(True, 0.1)
+        self.assertAlmostEqual(limiter.window, 4.25)
+        for i in range(2):
+            limiter.acquire()
+            limiter.release(False, 0.1)
+        stats = limiter.stats()
+        self.assertAlmostEqual(stats['window'], 2.125)
+        self.assertEqual(stats['decreases'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_latency_spike_shrinks(self):
+        limiter = throttle.AdaptiveLimiter(window=8, rate=100,
+                                           latency_warmup=5)
+        for i in range(6):
+            limiter.acquire()
+            limiter.release(True, 0.01)
+        self.assertGreater(limiter.window, 8)
+        limiter.acquire()
+        limiter.release(True, 1)
+        self.assertLess(limiter.window, 5)
+        self.assertLess(limiter.rate, 51)
+
+    def test_latency_per_kind(self):
+        ''' A slow request of another kind, such as a large bulk match after
+        single ones, isn't a latency spike
+        '''
+        limiter = throttle.AdaptiveLimiter(window=8, latency_warmup=5)
+        for i in range(6):
+            with limiter.slot('GET /match 0') as outcome:
+                outcome['success'] = True
+        window = limiter.window
+        limiter.acquire()
+        limiter.release(True, 1, 'POST /multimatch 6')
+        self.assertGreater(limiter.window, window)
+        self.assertEqual(
+            sorted(limiter.stats()['average_latency']),
+            ['GET /match 0', 'POST /multimatch 6']
+        )
+        self.assertNotEqual(
+            transport.request_kind('POST', 'http://x/multimatch', 'x' * 100),
+            transport.request_kind('POST', 'http://x/multimatch', 'x' * 10000)
+        )
+
+    def test_token_bucket(self):
+        ''' Requests beyond the burst wait for tokens to refill '''
+        limiter = throttle.AdaptiveLimiter(rate=20, burst=2)
+        start = time.time()
+        for i in range(4):
+            limiter.acquire()
+            limiter.release(True)
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertGreater(limiter.stats()['throttled_seconds'], 0)
+
+    def test_transport_reports_outcome(self):
+        ''' Transports share a limiter by default and count server errors
+        as failures
+        '''
+        self.assertIs(self.cm.transport.limiter, throttle.shared_limiter)
+        limiter = throttle.AdaptiveLimiter(window=4)
+        trans = transport.Transport(limiter=limiter)
+        self.requests_mock.return_value = Mock(status_code=503)
+        trans.get('http://example.com')
+        self.assertEqual(limiter.window, 2)
+        self.assertEqual(trans.stats()['limiter']['decreases'], 1)
+
+
+class TestResilience(BaseCivisMatcher):
+
+    def _ok(self, *args, **kwargs):
+        return Mock(status_code=200, url='http://example.com/match',
+                    content=json.dumps({'error': False, 'result': {
+                        'people_count': 1, 'people': []
+                    }}))
+
+    def test_retry_transient_status(self):
+        ''' Retryable statuses are retried, others fail straight away '''
+        policy = resilience.Resilience(
+            retry=resilience.RetryPolicy(retries=2, backoff_factor=0)
+        )
+        cm = matcher.CivisMatcher(resilience=policy)
+        self.requests_mock.side_effect = [
+            Mock(status_code=503, url='http://example.com'), self._ok()
+        ]
+        self.assertEqual(cm.match('Test', 'User').people_count, 1)
+        self.assertEqual(policy.stats()['retries'], 1)
+
+        self.requests_mock.side_effect = None
+        self.requests_mock.return_value = Mock(status_code=404, url='x')
+        with self.assertRaises(matcher.MatchException):
+            cm.match('Test', 'User')
+        self.assertEqual(policy.stats()['retries'], 1)
+        self.assertEqual(policy.stats()['failures'], 1)
+
+    def test_circuit_breaker_serves_stale(self):
+        ''' Once the circuit opens Civis isn't called, and the last known
+        result is served where there is one
+        '''
+        policy = resilience.Resilience(
+            breaker=resilience.CircuitBreaker(failure_threshold=2)
+        )
+        cm = matcher.CivisMatcher(resilience=policy, stale_cache_size=10)
+        self.requests_mock.side_effect = self._ok
+        cm.match('Test', 'User')
+
+        self.requests_mock.side_effect = None
+        self.requests_mock.return_value = Mock(status_code=503, url='x')
+        for i in range(3):
+            self.assertEqual(cm.match('Test', 'User').people_count, 1)
+        self.assertEqual(self.requests_mock.call_count, 3)
+        with self.assertRaises(matcher.CircuitOpenError):
+            cm.match('Test', 'Other')
+
+        stats = policy.stats()
+        self.assertEqual(stats['circuit'], 'open')
+        self.assertEqual(stats['short_circuited'], 2)
+        self.assertEqual(stats['stale_served'], 3)
+
+    def test_bulk_stale(self):
+        cm = matcher.CivisMatcher(stale_cache_size=10)
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='x', content=json.dumps({'1': {
+                'error': False, 'result': {'people_count': 0, 'people': []}
+            }})
+        )
+        people = {'people': {'1': {'first_name': 'Test', 'last_name': 'A'}}}
+        cm.bulk_match(people, raw=True)
+        self.requests_mock.return_value = Mock(status_code=500, url='x')
+        self.assertEqual(cm.bulk_match(people, raw=True).keys(), ['1'])
+
+        people['people']['2'] = {'first_name': 'Test', 'last_name': 'B'}
+        with self.assertRaises(matcher.MatchException):
+            cm.bulk_match(people, raw=True)
+
+    def test_hedged_request(self):
+        ''' A call slower than the latency threshold is duplicated, and the
+        first answer used
+        '''
+        policy = resilience.Resilience(
+            hedge=resilience.HedgePolicy(min_samples=1, min_delay=0.01)
+        )
+        policy.hedge.record(0.01)
+        delays = [0.5, 0]
+
+        def call():
+            delay = delays.pop(0)
+            time.sleep(delay)
+            return delay
+
+        self.assertEqual(policy.call(call), 0)
+        stats = policy.stats()
+        self.assertEqual(stats['hedged'], 1)
+        self.assertEqual(stats['hedge_wins'], 1)
+        self.assertEqual(stats['attempts'], 2)
+
+    def test_hedged_stream_released(self):
+        ''' The streamed response that loses a hedged race is released once
+        it arrives, as is one rejected for its status
+        '''
+        policy = resilience.Resilience(
+            hedge=resilience.HedgePolicy(min_samples=1, min_delay=0.01)
+        )
+        policy.hedge.record(0.01)
+        cm = matcher.CivisMatcher(resilience=policy)
+        slow = Mock(status_code=200, url='x')
+        fast = Mock(status_code=200, url='x', iter_content=Mock(
+            return_value=iter(['{"1": {"error": false}}'])
+        ))
+        responses = [slow, fast]
+
+        def post(url, **kwargs):
+            resp = responses.pop(0)
+            if resp is slow:
+                time.sleep(0.2)
+            return resp
+
+        self.requests_mock.side_effect = post
+        self.assertEqual(list(cm._stream_post('x', {})),
+                         [(u'1', {u'error': False})])
+        time.sleep(0.4)
+        slow.close.assert_called_once_with()
+        # The winner is closed once it has been read
+        fast.close.assert_called_once_with()
+
+        failed = Mock(status_code=500, url='x')
+        self.requests_mock.side_effect = None
+        self.requests_mock.return_value = failed
+        self.assertRaises(matcher.MatchException, cm._open_stream, 'x', {})
+        failed.close.assert_called_once_with()
+
+
+class TestMetrics(BaseCivisMatcher):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='http://example.com/match',
+            content=json.dumps({'error': False, 'result': {
+                'people_count': 1, 'people': [{'first_name': 'TEST'}]
+            }})
+        )
+
+    def test_trace(self):
+        ''' A trace breaks a call down by stage '''
+        with self.cm.metrics.trace() as trace:
+            self.cm.match('Test', 'User')
+        self.assertEqual(
+            sorted(trace.stages),
+            ['build', 'cache.get', 'cache.set', 'http', 'parse']
+        )
+        self.assertEqual(trace.counters['cache.misses'], 1)
+        self.assertGreaterEqual(trace.elapsed, sum(trace.stages.values()))
+        self.assertIn('http=', repr(trace))
+
+    def test_sinks(self):
+        sink = metrics.MemorySink()
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        statsd = metrics.StatsdSink(port=receiver.getsockname()[1],
+                                    prefix='test')
+        cm = matcher.CivisMatcher(
+            metrics=metrics.Instrumentation([sink, statsd])
+        )
+        cm.match('Test', 'User')
+
+        summary = sink.summary()
+        self.assertEqual(summary['timings']['http']['count'], 1)
+        self.assertEqual(summary['counters'], {'civis.requests': 1})
+        self.assertEqual(receiver.recv(512), 'test.civis.requests:1|c')
+        self.assertTrue(receiver.recv(512).startswith('test.http:'))
+        receiver.close()
+
+    def test_disabled(self):
+        ''' Without sinks or a trace nothing is timed '''
+        instrumentation = metrics.Instrumentation()
+        self.assertIs(instrumentation.timer('http'), metrics._NULL_TIMER)
+        with instrumentation.trace():
+            self.assertIsNot(instrumentation.timer('http'),
+                             metrics._NULL_TIMER)
+
+
+class TestAsyncCivisMatcher(BaseCivisMatcher):
+
+    def setUp(self):
+        super(TestAsyncCivisMatcher, self).setUp()
+        transport.requests.Session = self.orig_requests_session
+        self.server = fakes.FakeCivisServer().start()
+        self.am = matcher.AsyncCivisMatcher(
+            base_url=self.server.url, concurrency=4
+        )
+
+    def tearDown(self):
+        self.am.close()
+        self.server.stop()
+        super(TestAsyncCivisMatcher, self).tearDown()
+
+    def test_match(self):
+        ''' Concurrent matches against the stub server return MatchResults '''
+        pending = [
+            self.am.match('Test', 'User%s' % i, state='IL') for i in range(10)
+        ]
+        results = [p.get(5) for p in pending]
+        assert isinstance(results[0], matcher.MatchResult)
+        self.assertEqual(results[3].people[0].last_name, 'USER3')
+        self.assertEqual(results[3].people[0].state, 'IL')
+
+    def test_bulk_match(self):
+        ''' Bulk matches are dispatched without blocking, and the callback
+        receives the result
+        '''
+        received = []
+        pending = self.am.bulk_match(
+            {'people': {'a': {'first_name': 'Test', 'last_name': 'User'}}},
+            callback=received.append
+        )
+        result = pending.get(5)
+        self.assertEqual(result['a'].people[0].first_name, 'TEST')
+        self.am.close()
+        self.assertEqual(received, [result])
+
+    def test_errors_propagate(self):
+        ''' Errors raised by the wrapped matcher are raised from get() '''
+        self.am.matcher.base_url = '%s/missing' % self.server.url
+        with self.assertRaises(matcher.MatchException):
+            self.am.match('Test', 'User').get(5)
+
+
+class TestBenchmark(BaseCivisMatcher):
+
+    def test_run_scenarios(self):
+        ''' Every scenario runs against the fakes and reports latency,
+        throughput and memory, and runs can be compared
+        '''
+        transport.requests.Session = self.orig_requests_session
+        options = benchmark.parse_args(['--iterations', '3',
+                                        '--bulk-size', '2'])
+        results = benchmark.run(options)
+        self.assertEqual(results['scenarios'].keys(),
+                         benchmark.SCENARIOS.keys())
+        for result in results['scenarios'].values():
+            self.assertEqual(result['errors'], 0)
+            self.assertEqual(result['latency']['count'], 3)
+            assert result['requests_per_second'] > 0
+            assert result['max_rss_kb'] > 0
+        formats = results['scenarios']['serialized_size']['formats']
+        self.assertLess(formats['compressed']['bytes_per_entry'],
+                        formats['json']['bytes_per_entry'])
+        json.dumps(results)
+        self.assertEqual(
+            len(benchmark.compare(results, results)), len(benchmark.SCENARIOS)
+        )
+
+
+class TestCommandLine(BaseCivisMatcher):
+
+    def setUp(self):
+        super(TestCommandLine, self).setUp()
+        transport.requests.Session = self.orig_requests_session
+        self.server = fakes.FakeCivisServer().start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.tmp_dir, 'people.csv')
+        self.output_path = os.path.join(self.tmp_dir, 'results.jsonl')
+        with open(self.input_path, 'w') as input_file:
+            input_file.write('id,first_name,last_name,state\n')
+            for i in range(10):
+                input_file.write('%s,Test,User%s,IL\n' % (i % 8, i))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+        super(TestCommandLine, self).tearDown()
+
+    def _run(self, *extra):
+        args = cli.parse_args([
+            self.input_path, self.output_path, '--base-url', self.server.url,
+            '--chunk-size', '3', '--concurrency', '2',
+        ] + list(extra))
+        progress = StringIO()
+        cli.run(args, progress)
+        return progress.getvalue()
+
+    def _output(self):
+        with open(self.output_path) as output:
+            return [json.loads(line) for line in output]
+
+    def test_match_file(self):
+        ''' Every row, including repeated ids, is matched and written out in
+        input order with a progress readout
+        '''
+        progress = self._run()
+        lines = self._output()
+        self.assertEqual([line['id'] for line in lines],
+                         ['0', '1', '2', '3', '4', '5', '6', '7', '0', '1'])
+        self.assertEqual(
+            lines[9]['result']['result']['people'][0]['last_name'], 'USER9'
+        )
+        assert 'rows: 10  matched: 10  failed: 0' in progress
+        assert not os.path.exists('%s.checkpoint' % self.output_path)
+
+    def test_resume(self):
+        ''' A job resumed from a checkpoint only sends the remaining rows to
+        Civis, and discards output written after the checkpoint
+        '''
+        self._run()
+        with open(self.output_path) as output:
+            first_lines = ''.join(output.readlines()[:6])
+        with open(self.output_path, 'w') as output:
+            output.write(first_lines + '{"id": "partial')
+        cli.Checkpoint('%s.checkpoint' % self.output_path).save(
+            6, len(first_lines)
+        )
+
+        requests_before = self.server.request_count
+        self._run()
+        self.assertEqual(self.server.request_count - requests_before, 2)
+        lines = self._output()
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(
+            lines[6]['result']['result']['people'][0]['last_name'], 'USER6'
+        )
+
+    def test_store_under_ids(self):
+        ''' Results stored in S3 are keyed by each row's id rather than the
+        row number used to match it
+        '''
+        bucket = fakes.FakeBucket()
+        orig_boto = matcher.boto
+        matcher.boto = Mock()
+        matcher.boto.connect_s3.return_value.get_bucket.return_value = bucket
+        self.addCleanup(setattr, matcher, 'boto', orig_boto)
+        with open(self.input_path, 'w') as input_file:
+            input_file.write('id,first_name,last_name\n')
+            input_file.write('fb111,Test,User1\nfb222,Test,User2\n')
+
+        self._run('--s3-bucket', 'results')
+        self.assertEqual(sorted(bucket.objects), ['fb111', 'fb222'])
+        stored = serialization.loads(bucket.objects['fb222'])
+        self.assertEqual(stored['result']['people'][0]['last_name'], 'USER2')
+
+    def test_local_store(self):
+        ''' --local-store stores results in a SQLite file under each row's id,
+        where an S3CivisMatcher on the same file finds them
+        '''
+        store_path = os.path.join(self.tmp_dir, 'results.db')
+        with open(self.input_path, 'w') as input_file:
+            input_file.write('id,first_name,last_name\n')
+            input_file.write('fb111,Test,User1\nfb222,Test,User2\n')
+
+        self._run('--local-store', store_path)
+        bucket = storage.LocalBucket(store_path)
+        self.assertEqual(
+            sorted(bucket.get_multi(['0', '1', 'fb111', 'fb222'])),
+            ['fb111', 'fb222']
+        )
+        cm = matcher.S3CivisMatcher(None, None, bucket=bucket)
+        results, missing = cm.cache_match(['fb111', 'fb222'])
+        self.assertEqual(missing, 0)
+        self.assertEqual(
+            results['fb111']['result']['people'][0]['last_name'], 'USER1'
+        )
+
+    def test_failed_rows_are_retried(self):
+        ''' Rows that get no result are recorded in the checkpoint, so
+        re-running the job retries them, and the exit code shows failures
+        '''
+        self.server.server.error_rate = 1
+        progress = self._run('--retries', '0')
+        assert 'failed: 10' in progress
+        assert 're-run to retry' in progress
+        checkpoint = cli.Checkpoint('%s.checkpoint' % self.output_path)
+        self.assertEqual(checkpoint.load().rows_done, 10)
+        self.assertEqual(checkpoint.failed_rows, range(10))
+        orig_run = cli.run
+        self.addCleanup(setattr, cli, 'run', orig_run)
+        cli.run = Mock(return_value=cli.Progress(StringIO()))
+        self.assertEqual(cli.main([self.input_path, self.output_path]), 0)
+        cli.run.return_value.failed = 10
+        self.assertEqual(cli.main([self.input_path, self.output_path]), 1)
+        cli.run = orig_run
+
+        self.server.server.error_rate = 0
+        self._run()
+        lines = self._output()
+        self.assertEqual([line['id'] for line in lines],
+                         ['0', '1', '2', '3', '4', '5', '6', '7', '0', '1'])
+        assert all('result' in line for line in lines)
+        assert not os.path.exists(checkpoint.path)
+
+    def test_only_failed_rows_are_retried(self):
+        ''' Resuming a job whose rows failed part way through only sends the
+        failed rows to Civis, and puts their results in place
+        '''
+        self._run()
+        with open(self.output_path) as output:
+            lines = output.readlines()
+        lines[4] = json.dumps({'id': '4', 'error': 'No result returned'})
+        lines[4] += '\n'
+        with open(self.output_path, 'w') as output:
+            output.write(''.join(lines))
+        cli.Checkpoint('%s.checkpoint' % self.output_path).save(
+            10, len(''.join(lines)), [4]
+        )
+
+        requests_before = self.server.request_count
+        self._run()
+        self.assertEqual(self.server.request_count - requests_before, 1)
+        output = self._output()
+        self.assertEqual(len(output), 10)
+        self.assertEqual(
+            output[4]['result']['result']['people'][0]['last_name'], 'USER4'
+        )
+        self.assertEqual(output[5], json.loads(lines[5]))
+        assert not os.path.exists('%s.checkpoint' % self.output_path)
+
 
 class TestS3CivisMatcher(BaseCivisMatcher):
 
@@ -363,7 +1613,7 @@ class TestS3CivisMatcher(BaseCivisMatcher):
         self.cm.bucket.new_key.return_value = create_key_mock
         self.cm._store_match_results(self.civis_result)
         assert create_key_mock.set_contents_from_string.called
-        store_data = json.loads(
+        store_data = serialization.loads(
             create_key_mock.set_contents_from_string.call_args_list[0][0][0]
         )
         self.assertEqual(
@@ -402,3 +1652,483 @@ class TestS3CivisMatcher(BaseCivisMatcher):
         self.cm._store_match_results(self.civis_result)
         assert key_mock.get_contents_as_string.called
         assert not key_mock.set_contents_from_string.called
+
+    def test_store_match_results_uses_metadata(self):
+        ''' Stored results are compared using their object metadata instead
+        of being downloaded, and unchanged results aren't written again
+        '''
+        bucket = fakes.FakeBucket()
+        sink = metrics.MemorySink()
+        cm = matcher.S3CivisMatcher(None, None, bucket=bucket,
+                                    metrics=metrics.Instrumentation([sink]))
+        cm._store_match_results(json.loads(json.dumps(self.civis_result)))
+        self.assertEqual(bucket.metadata['123456']['people-count'], '1')
+        stored = bucket.objects['123456']
+
+        # Anything but a HEAD request would fail on this body
+        bucket.objects['123456'] = 'not a stored result'
+        cm._store_match_results(json.loads(json.dumps(self.civis_result)))
+        self.assertEqual(bucket.objects['123456'], 'not a stored result')
+        self.assertEqual(sink.summary()['counters']['s3.puts_skipped'], 1)
+
+        # Objects written without metadata are still read in full
+        bucket.objects['123456'] = stored
+        bucket.metadata['123456'] = {}
+        better = json.loads(json.dumps(self.civis_result))
+        better['123456']['result']['people_count'] = 2
+        cm._store_match_results(better)
+        self.assertEqual(bucket.metadata['123456']['people-count'], '2')
+
+    def test_local_store(self):
+        ''' Results can be stored in a local SQLite file in place of a
+        bucket, read and written in bulk with the same overwrite and expiry
+        rules
+        '''
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'results.db')
+        cm = matcher.S3CivisMatcher(None, None,
+                                    bucket=storage.LocalBucket(path))
+        no_match = {'error': False, 'result': {'people_count': 0,
+                                               'people': []}}
+        cm._store_match_results({
+            '123456': json.loads(json.dumps(self.civis_result['123456'])),
+            '2': dict(no_match),
+        })
+        worse = dict(no_match, result={'people_count': 0, 'people': [1]})
+        cm._store_match_results({'123456': worse})
+
+        cm = matcher.S3CivisMatcher(None, None,
+                                    bucket=storage.LocalBucket(path))
+        get_multi = Mock(wraps=cm.bucket.get_multi)
+        cm.bucket.get_multi = get_multi
+        results, missing = cm.cache_match(['123456', '2', '3'])
+        # Positive and negative results are read in one query
+        self.assertEqual(get_multi.call_count, 1)
+        self.assertEqual(sorted(results), ['123456', '2'])
+        self.assertEqual(results['123456']['result']['people_count'], 1)
+        self.assertEqual(missing, 1)
+
+        cm.bucket.delete_key('123456')
+        self.assertEqual(cm.bucket.get_key('123456'), None)
+        self.assertRaises(S3ResponseError,
+                          cm.bucket.new_key('123456').get_contents_as_string)
+
+    def test_person_index(self):
+        ''' Each person is stored once however many fbids match them, and
+        can be looked up from an fbid and the other way round
+        '''
+        store = storage.LocalBucket(index_people=True)
+        cm = matcher.S3CivisMatcher(None, None, bucket=store)
+        result = self.civis_result['123456']
+        cm._store_match_results({
+            '1': json.loads(json.dumps(result)),
+            '2': json.loads(json.dumps(result)),
+        })
+        self.assertEqual(sorted(cm.fbids_for_person('16595385')), ['1', '2'])
+        self.assertEqual(cm.person_ids_for_fbid(1), ['16595385'])
+        self.assertEqual(store._conn.execute(
+            'SELECT COUNT(*) FROM people'
+        ).fetchone()[0], 1)
+
+        results, _ = cm.cache_match(['1', '2'])
+        self.assertEqual(results['2']['result'], result['result'])
+        self.assertEqual(
+            cm.batch_cache_match(['1'])[0]['1']['result'], result['result']
+        )
+
+        other = json.loads(json.dumps(result))
+        other['result']['people'][0]['id'] = '42'
+        other['result']['people'].append({'id': '43'})
+        other['result']['people_count'] = 2
+        cm._store_match_results({'2': other})
+        self.assertEqual(cm.fbids_for_person('16595385'), ['1'])
+        self.assertEqual(sorted(cm.person_ids_for_fbid('2')), ['42', '43'])
+        self.assertRaises(ValueError, self.cm.fbids_for_person, '42')
+
+    def test_person_index_pruning(self):
+        ''' Results and their people are written in one transaction, and
+        records no result refers to any more are deleted
+        '''
+        store = storage.LocalBucket(index_people=True)
+        cm = matcher.S3CivisMatcher(None, None, bucket=store)
+        result = self.civis_result['123456']
+        cm._store_match_results({
+            '1': json.loads(json.dumps(result)),
+            '2': json.loads(json.dumps(result)),
+        })
+        other = json.loads(json.dumps(result))
+        other['result']['people'][0]['id'] = '42'
+        other['result']['people_count'] = 2
+        cm._store_match_results({'2': other})
+
+        def count():
+            return store._conn.execute(
+                'SELECT COUNT(*) FROM people'
+            ).fetchone()[0]
+        # The first record is still referred to by '1'
+        self.assertEqual(count(), 2)
+        store.delete_key('1')
+        self.assertEqual(count(), 1)
+        self.assertEqual(cm.fbids_for_person('16595385'), [])
+
+        # A result without people replacing one with people unlinks them
+        cm = matcher.S3CivisMatcher(None, None, bucket=store,
+                                    negative_expiry_days=None,
+                                    cache_expiry_days=0)
+        cm._store_match_results({'2': {'error': False, 'result': {
+            'people_count': 0, 'people': []
+        }}})
+        self.assertEqual(cm.person_ids_for_fbid('2'), [])
+        self.assertEqual(count(), 0)
+
+        store._put_people = Mock(side_effect=sqlite3.OperationalError)
+        with self.assertRaises(sqlite3.OperationalError):
+            cm._store_match_results({'3': json.loads(json.dumps(result))})
+        self.assertEqual(store.get_key('3'), None)
+
+    def test_batch_cache_match(self):
+        ''' Stored matches are fetched without a HEAD request, missing fbids
+        are reported and latency statistics are returned
+        '''
+        stored = {'1': {'result': {'people_count': 1}},
+                  '3': {'result': {'people_count': 0}}}
+
+        def new_key(fbid):
+            key = Mock()
+            if fbid in stored:
+                key.get_contents_as_string.return_value = json.dumps(
+                    stored[fbid]
+                )
+            else:
+                key.get_contents_as_string.side_effect = S3ResponseError(
+                    404, 'Not Found'
+                )
+            return key
+
+        self.cm.bucket = Mock()
+        self.cm.bucket.new_key.side_effect = new_key
+        arrived = []
+        results, missing, stats = self.cm.batch_cache_match(
+            ['1', '2', '3', '4'], workers=2,
+            callback=lambda fbid, data: arrived.append(fbid)
+        )
+        self.assertEqual(results, stored)
+        self.assertEqual(sorted(missing), ['2', '4'])
+        self.assertEqual(sorted(arrived), ['1', '3'])
+        self.assertEqual(stats['count'], 4)
+        assert stats['p99'] >= stats['p50']
+        assert not self.cm.bucket.get_key.called
+
+    def test_batch_cache_match_s3_error(self):
+        ''' S3 errors other than a missing key are raised '''
+        self.cm.bucket = Mock()
+        key = self.cm.bucket.new_key.return_value
+        key.get_contents_as_string.side_effect = S3ResponseError(
+            403, 'Forbidden'
+        )
+        with self.assertRaises(S3ResponseError):
+            self.cm.batch_cache_match(['1'])
+
+    def test_write_behind_bulk_match(self):
+        ''' With write_behind, results are only stored once flushed '''
+        cm = matcher.S3CivisMatcher('KEY', 'SECRET_KEY', write_behind=True,
+                                    flush_interval=60)
+        cm.bucket = Mock()
+        cm.bucket.get_key.return_value = None
+        self.requests_mock.return_value = Mock(
+            status_code=200,
+            url='http://example.com/multimatch',
+            content=json.dumps(self.civis_result)
+        )
+        data = cm.bulk_match({'people': {'123456': {'first_name': 'Test',
+                                                    'last_name': 'User'}}})
+        self.assertEqual(data, self.civis_result)
+        assert not cm.bucket.new_key.called
+        self.assertEqual(cm.flush(), 1)
+        assert cm.bucket.new_key.return_value.set_contents_from_string.called
+        assert 'timestamp' not in data['123456']
+        cm.close()
+
+    def test_cache_match_local_tier(self):
+        ''' With a local cache, stored matches are read from S3 once and then
+        served from memory until bulk_match replaces them
+        '''
+        cm = matcher.S3CivisMatcher('KEY', 'SECRET_KEY', local_cache_size=10)
+        cm.bucket = Mock()
+        key = cm.bucket.new_key.return_value
+        key.get_contents_as_string.return_value = json.dumps(
+            self.civis_result['123456']
+        )
+        self.assertEqual(
+            cm.cache_match(['123456']),
+            ({'123456': self.civis_result['123456']}, 0)
+        )
+        cm.cache_match(['123456'])
+        self.assertEqual(cm.bucket.new_key.call_count, 1)
+
+        cm.bucket.get_key.return_value = None
+        self.requests_mock.return_value = Mock(
+            status_code=200,
+            url='http://example.com/multimatch',
+            content=json.dumps(self.civis_result)
+        )
+        cm.bulk_match({'people': {'123456': {'first_name': 'Test',
+                                             'last_name': 'User'}}})
+        cm.cache_match(['123456'])
+        # One write from bulk_match and a fresh read afterwards
+        self.assertEqual(cm.bucket.new_key.call_count, 3)
+
+    def test_stale_while_revalidate(self):
+        ''' Stale stored results are served and re-matched in the
+        background, expired ones are treated as missing
+        '''
+        bucket = fakes.FakeBucket()
+        cm = matcher.S3CivisMatcher(None, None, bucket=bucket,
+                                    cache_soft_expiry_days=1)
+        stale = dict(self.civis_result['123456'],
+                     query={'first_name': 'Test', 'last_name': 'User'})
+        stale['timestamp'] = (
+            datetime.now() - timedelta(days=2)
+        ).strftime(matcher.TIME_FORMAT)
+        bucket.objects['123456'] = json.dumps(stale)
+        stale['timestamp'] = (
+            datetime.now() - timedelta(days=40)
+        ).strftime(matcher.TIME_FORMAT)
+        bucket.objects['654321'] = json.dumps(stale)
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='x', content=json.dumps(self.civis_result)
+        )
+
+        results, missing = cm.cache_match(['123456', '654321'])
+        self.assertEqual(results.keys(), ['123456'])
+        self.assertEqual(missing, 1)
+        cm.close()
+        stored = serialization.loads(bucket.objects['123456'])
+        self.assertEqual(stored['query']['last_name'], 'User')
+        self.assertGreater(
+            datetime.strptime(stored['timestamp'], matcher.TIME_FORMAT),
+            datetime.now() - timedelta(days=1)
+        )
+
+    def test_negative_results(self):
+        ''' No-match results are stored under their own key, and are only
+        served for negative_expiry_days
+        '''
+        bucket = fakes.FakeBucket()
+        cm = matcher.S3CivisMatcher(None, None, bucket=bucket)
+        no_match = {'error': False, 'result': {'people_count': 0,
+                                               'people': []}}
+        cm._store_match_results({'1': dict(no_match), '2': dict(no_match)})
+        self.assertEqual(sorted(bucket.objects), ['1:none', '2:none'])
+
+        old = dict(no_match, timestamp=(
+            datetime.now() - timedelta(days=8)
+        ).strftime(matcher.TIME_FORMAT))
+        bucket.objects['2:none'] = json.dumps(old)
+        bucket.objects['3'] = json.dumps(self.civis_result['123456'])
+        bucket.objects['3:none'] = bucket.objects['1:none']
+        results, missing = cm.cache_match(['1', '2', '3'])
+        self.assertEqual(sorted(results), ['1', '3'])
+        self.assertEqual(results['3']['result']['people_count'], 1)
+        self.assertEqual(missing, 1)
+
+    def test_repeat_negative_bulk_match(self):
+        ''' People the matcher stored a no-match result for aren't sent to
+        Civis again, without a request to S3, until a positive result is
+        stored for them. The result isn't written again either.
+        '''
+        bucket = fakes.FakeBucket()
+        sink = metrics.MemorySink()
+        cm = matcher.S3CivisMatcher(None, None, bucket=bucket,
+                                    metrics=metrics.Instrumentation([sink]))
+        no_match = {'error': False, 'result': {'people_count': 0,
+                                               'people': []}}
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='x', content=json.dumps({'1': no_match})
+        )
+        people = {'people': {'1': {'first_name': 'Test',
+                                   'last_name': 'User'}}}
+        cm.bulk_match(people)
+        stored = bucket.objects['1:none']
+
+        self.assertEqual(cm.bulk_match(people), {'1': no_match})
+        self.assertEqual(self.requests_mock.call_count, 1)
+        self.assertEqual(bucket.objects['1:none'], stored)
+
+        # Within negative_expiry_days the result isn't written again
+        cm._store_match_results({'1': dict(no_match)})
+        self.assertEqual(bucket.objects['1:none'], stored)
+        self.assertEqual(sink.summary()['counters']['s3.puts_skipped'], 1)
+
+        bucket.get_key = Mock(wraps=bucket.get_key)
+        cm.bulk_match(people)
+        assert not bucket.get_key.called
+
+        cm._store_match_results(json.loads(json.dumps({
+            '1': self.civis_result['123456']
+        })))
+        self.requests_mock.return_value.content = json.dumps(
+            self.civis_result
+        )
+        cm.bulk_match({'people': {'1': {'first_name': 'Test',
+                                        'last_name': 'User'},
+                                  '123456': {'first_name': 'Test',
+                                             'last_name': 'User2'}}})
+        self.assertEqual(self.requests_mock.call_count, 2)
+        self.assertEqual(
+            sorted(json.loads(self.requests_mock.call_args[1]['data'])[
+                'people'
+            ]), ['1', '123456']
+        )
+        # Only the HEADs comparing against the positive results stored
+        self.assertEqual(
+            sorted(c[0][0] for c in bucket.get_key.call_args_list),
+            ['1', '123456']
+        )
+
+    def test_prefetch(self):
+        ''' Only people without a fresh stored result are matched and
+        stored, and failures are counted rather than raised
+        '''
+        bucket = fakes.FakeBucket()
+        cm = matcher.S3CivisMatcher(None, None, bucket=bucket)
+        fresh = dict(self.civis_result['123456'], timestamp=(
+            datetime.now() - timedelta(days=1)
+        ).strftime(matcher.TIME_FORMAT))
+        bucket.objects['1'] = json.dumps(fresh)
+        expired = dict(fresh, timestamp=(
+            datetime.now() - timedelta(days=40)
+        ).strftime(matcher.TIME_FORMAT))
+        bucket.objects['123456'] = json.dumps(expired)
+        self.requests_mock.return_value = Mock(
+            status_code=200, url='x', content=json.dumps(self.civis_result)
+        )
+        people = {'1': {'first_name': 'Test', 'last_name': 'User1'},
+                  '123456': {'first_name': 'Test', 'last_name': 'User'}}
+
+        report = cm.prefetch(people.items(), rate=1000)
+        self.assertEqual((report.fresh, report.fetched), (1, 1))
+        stored = serialization.loads(bucket.objects['123456'])
+        self.assertGreater(
+            datetime.strptime(stored['timestamp'], matcher.TIME_FORMAT),
+            datetime.now() - timedelta(days=1)
+        )
+
+        self.requests_mock.side_effect = ConnectionError()
+        report = cm.prefetch([('2', {'first_name': 'Test'})])
+        self.assertEqual((report.failed, report.coverage), (1, 0.0))
+
+    def test_prefetch_reads_metadata(self):
+        ''' Freshness is checked from the metadata of stored results, or in
+        one bulk read on stores that support it, without downloading each
+        result
+        '''
+        bucket = fakes.FakeBucket()
+        cm = matcher.S3CivisMatcher(None, None, bucket=bucket)
+        cm._store_match_results(json.loads(json.dumps(self.civis_result)))
+        # Anything but a HEAD request would fail on this body
+        bucket.objects['123456'] = 'not a stored result'
+        people = [('123456', {'first_name': 'Test', 'last_name': 'User'})]
+        self.assertEqual(cm.prefetch(people).fresh, 1)
+
+        store = storage.LocalBucket()
+        cm = matcher.S3CivisMatcher(None, None, bucket=store)
+        cm._store_match_results(json.loads(json.dumps(self.civis_result)))
+        store.get_key = Mock()
+        store.get_multi = Mock(wraps=store.get_multi)
+        people.append(('2', {'first_name': 'Test', 'last_name': 'User2'}))
+        self.requests_mock.side_effect = ConnectionError()
+        report = cm.prefetch(people)
+        self.assertEqual((report.fresh, report.failed), (1, 1))
+        self.assertEqual(store.get_multi.call_count, 1)
+        assert not store.get_key.called
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWriteBehindQueue, self).setUp()
+        self.written = []
+
+    def test_coalescing(self):
+        ''' Repeated writes for an fbid are coalesced, keeping the richer
+        result
+        '''
+        queue = writebehind.WriteBehindQueue(
+            self.written.append, flush_interval=60, workers=1
+        )
+        queue.put({'1': {'result': {'people_count': 2}}})
+        queue.put({'1': {'result': {'people_count': 1}},
+                   '2': {'result': {'people_count': 0}}})
+        queue.put({'1': {'result': {'people_count': 3}}})
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(self.written, [{
+            '1': {'result': {'people_count': 3}},
+            '2': {'result': {'people_count': 0}},
+        }])
+        metrics = queue.metrics()
+        self.assertEqual(metrics['queued'], 4)
+        self.assertEqual(metrics['coalesced'], 2)
+        self.assertEqual(metrics['written'], 2)
+        self.assertEqual(metrics['pending'], 0)
+        queue.close()
+
+    def test_size_threshold_and_close(self):
+        ''' Reaching flush_size triggers a background flush, and close()
+        flushes whatever is left
+        '''
+        queue = writebehind.WriteBehindQueue(
+            self.written.append, flush_size=2, flush_interval=60, workers=1
+        )
+        queue.put({'1': {}, '2': {}})
+        for _ in range(100):
+            if queue.metrics()['written'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(queue.metrics()['written'], 2)
+
+        queue.put({'3': {}})
+        queue.close()
+        self.assertEqual(self.written, [{'1': {}, '2': {}}, {'3': {}}])
+
+    def test_put_racing_close(self):
+        ''' Results put while the queue is closing are either flushed by
+        close() or written directly, never dropped, and closed queues aren't
+        kept alive
+        '''
+        queue = writebehind.WriteBehindQueue(
+            self.written.append, flush_interval=60, workers=1
+        )
+
+        def put(queue, start):
+            for i in range(start, start + 200):
+                queue.put({'%s' % i: {}})
+
+        threads = [threading.Thread(target=put, args=(queue, i * 200))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        queue.close()
+        for thread in threads:
+            thread.join()
+        written = set()
+        for batch in self.written:
+            written.update(batch)
+        self.assertEqual(len(written), 800)
+
+        self.assertNotIn(queue, writebehind._open_queues)
+        ref = weakref.ref(queue)
+        del queue
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_write_failure(self):
+        ''' Failed writes are counted rather than raised '''
+        queue = writebehind.WriteBehindQueue(
+            Mock(side_effect=Exception('S3 down')), flush_interval=60
+        )
+        queue.put({'1': {}})
+        self.assertEqual(queue.flush(), 0)
+        self.assertEqual(queue.metrics()['failed'], 1)
+        queue.close()
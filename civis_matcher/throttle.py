@@ -0,0 +1,150 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class AdaptiveLimiter(object):
+    ''' Client side limit on calls to Civis, combining a token bucket (the
+    request rate) with a window on the number of requests in flight.
+
+    Both adapt AIMD style: every success grows them a little, while an error
+    or a latency spike (a response much slower than the recent average)
+    multiplies them by ``decrease_factor``, at most once per ``cooldown``
+    seconds so a burst of failures doesn't collapse them entirely. Averages
+    are kept per ``kind`` of request, so a bulk request isn't compared
+    against single ones.
+
+    ``rate`` is in requests per second, with None meaning no rate limit; the
+    window always applies.
+    '''
+
+    def __init__(self, rate=None, burst=None, min_rate=1, max_rate=None,
+                 window=32, min_window=1, max_window=256,
+                 decrease_factor=0.5, cooldown=1, latency_factor=3,
+                 latency_alpha=0.1, latency_warmup=20):
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self.throttled_seconds = 0.0
+        self._last_decrease = 0
+        self._latency = {}
+        self._samples = {}
+        self.configure(
+            rate=rate, burst=burst, min_rate=min_rate, max_rate=max_rate,
+            window=window, min_window=min_window, max_window=max_window,
+            decrease_factor=decrease_factor, cooldown=cooldown,
+            latency_factor=latency_factor, latency_alpha=latency_alpha,
+            latency_warmup=latency_warmup
+        )
+
+    def configure(self, **settings):
+        ''' Updates any of the settings accepted by the constructor '''
+        with self._cond:
+            for name, value in settings.items():
+                setattr(self, name, value)
+            if 'rate' in settings or 'burst' in settings:
+                self._tokens = self.burst or self.rate or 0
+                self._last_refill = time.time()
+            self._cond.notify_all()
+
+    def _wait_for_token(self):
+        ''' Takes a token from the bucket, returning how long it waited '''
+        waited = 0.0
+        while True:
+            with self._cond:
+                if self.rate is None:
+                    return waited
+                now = time.time()
+                burst = self.burst or max(self.rate, 1)
+                self._tokens = min(
+                    burst, self._tokens + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def acquire(self):
+        waited = self._wait_for_token()
+        start = time.time()
+        with self._cond:
+            while self.in_flight >= int(self.window):
+                self._cond.wait()
+            self.in_flight += 1
+        self.throttled_seconds += waited + time.time() - start
+
+    def release(self, success, latency=None, kind=None):
+        with self._cond:
+            self.in_flight -= 1
+            if success and not self._is_spike(latency, kind):
+                self._increase()
+            else:
+                self._decrease()
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, kind=None):
+        ''' Holds a slot for one request of the given kind. The block should
+        set ``outcome['success']`` to True once the request has succeeded;
+        latency is timed automatically.
+        '''
+        self.acquire()
+        outcome = {'success': False}
+        start = time.time()
+        try:
+            yield outcome
+        finally:
+            self.release(outcome['success'], time.time() - start, kind)
+
+    def _is_spike(self, latency, kind=None):
+        if latency is None:
+            return False
+        average = self._latency.get(kind)
+        self._samples[kind] = self._samples.get(kind, 0) + 1
+        if average is None:
+            self._latency[kind] = latency
+            return False
+        self._latency[kind] = (
+            self.latency_alpha * latency +
+            (1 - self.latency_alpha) * average
+        )
+        return (self._samples[kind] > self.latency_warmup and
+                latency > self.latency_factor * average)
+
+    def _increase(self):
+        self.increases += 1
+        self.window = min(self.max_window, self.window + 1.0 / self.window)
+        if self.rate is not None:
+            rate = self.rate + 1.0 / self.rate
+            self.rate = min(self.max_rate, rate) if self.max_rate else rate
+
+    def _decrease(self):
+        now = time.time()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.window = max(self.min_window, self.window * self.decrease_factor)
+        if self.rate is not None:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'rate': self.rate,
+                'window': self.window,
+                'in_flight': self.in_flight,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'throttled_seconds': self.throttled_seconds,
+                'average_latency': dict(self._latency),
+            }
+
+
+# Shared by every Transport that isn't given its own limiter, so all the
+# matchers in a process stay within the same limits
+shared_limiter = AdaptiveLimiter()
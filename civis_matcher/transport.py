@@ -0,0 +1,117 @@
+import logging
+import math
+import time
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+
+from civis_matcher import throttle
+
+
+logger = logging.getLogger(__name__)
+
+
+def request_kind(method, url, data=None):
+    ''' Groups requests with comparable latencies for the limiter: by method
+    and path, and by the size of their body to within a factor of 4
+    '''
+    size = int(math.log(len(data), 4)) if data else 0
+    return '%s %s %s' % (method, urlparse(url).path, size)
+
+
+class Transport(object):
+    ''' Pooled, keep-alive HTTP transport used for every call a matcher makes
+    to Civis. Wraps a single requests Session so connections to the matching
+    service are reused instead of being re-established on each request.
+
+    Every request goes through ``limiter``, an ``AdaptiveLimiter`` that
+    defaults to the one shared by the whole process.
+    '''
+
+    def __init__(self, auth=None, timeout=5, pool_connections=4,
+                 pool_size=10, pool_block=False, max_retries=0,
+                 backoff_factor=0.5, limiter=None):
+        self.auth = auth
+        self.limiter = limiter or throttle.shared_limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.request_count = 0
+        self.retry_count = 0
+
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_size,
+            pool_block=pool_block
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def request(self, method, url, **kwargs):
+        ''' Issues a request over the pooled session. Connection failures are
+        retried up to ``max_retries`` times, sleeping
+        ``backoff_factor * 2 ** attempt`` seconds between attempts.
+        '''
+        kwargs.setdefault('auth', self.auth)
+        kwargs.setdefault('timeout', self.timeout)
+        send = getattr(self.session, method.lower())
+        attempt = 0
+        while True:
+            try:
+                kind = request_kind(method, url, kwargs.get('data'))
+                with self.limiter.slot(kind) as outcome:
+                    resp = send(url, **kwargs)
+                    # Server errors and 429s mean Civis is struggling
+                    outcome['success'] = (
+                        resp.status_code < 500 and resp.status_code != 429
+                    )
+            except ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                attempt += 1
+                self.retry_count += 1
+                logger.warn('Connection to %s failed, retry %s in %ss' % (
+                    url, attempt, delay
+                ))
+                time.sleep(delay)
+                continue
+
+            self.request_count += 1
+            return resp
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        ''' Reports request/retry counters along with the state of each
+        underlying connection pool.
+        '''
+        pools = []
+        manager = self.adapter.poolmanager
+        for pool_key in manager.pools.keys():
+            pool = manager.pools[pool_key]
+            pools.append({
+                'host': pool.host,
+                'port': pool.port,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': pool.pool.qsize() if pool.pool else 0,
+            })
+
+        return {
+            'requests': self.request_count,
+            'retries': self.retry_count,
+            'pool_size': self.adapter._pool_maxsize,
+            'pools': pools,
+            'limiter': self.limiter.stats(),
+        }
+
+    def close(self):
+        self.session.close()
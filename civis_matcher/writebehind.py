@@ -0,0 +1,159 @@
+import atexit
+import logging
+import threading
+import time
+import weakref
+from multiprocessing.pool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
+
+# Queues still open at exit are closed, flushing what they hold. Only weak
+# references are kept, so closed queues can be freed.
+_open_queues = weakref.WeakSet()
+
+
+def _close_open_queues():
+    for queue in list(_open_queues):
+        queue.close()
+
+
+atexit.register(_close_open_queues)
+
+
+def _people_count(match):
+    return match.get('result', {}).get('people_count', 0)
+
+
+class WriteBehindQueue(object):
+    ''' Buffers match results and hands them to ``write_func`` (such as
+    S3CivisMatcher._store_match_results) from background threads, keeping
+    storage off the request path.
+
+    Results are keyed by fbid, so repeated writes for the same fbid before a
+    flush are coalesced into one; a pending result is only replaced by one
+    with at least as many people. The buffer is flushed once it holds
+    ``flush_size`` fbids, every ``flush_interval`` seconds, and on close(),
+    which also runs at exit for queues that are still open. Each flush is
+    split between ``workers`` threads.
+    '''
+
+    def __init__(self, write_func, flush_size=500, flush_interval=5,
+                 workers=2):
+        self.write_func = write_func
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.workers = workers
+
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._pool = ThreadPool(workers)
+
+        self.queued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _open_queues.add(self)
+
+    def put(self, data):
+        ''' Queues a dict of fbid -> raw match result for writing. Once the
+        queue has been closed results are written immediately.
+        '''
+        with self._cond:
+            # Checked under the lock, as close() only flushes what was
+            # queued before it set _closed
+            closed = self._closed
+            if not closed:
+                self._queue(data)
+        if closed:
+            self._write(data)
+
+    def _queue(self, data):
+        ''' Adds results to the buffer, with the lock held '''
+        for fbid, match in data.iteritems():
+            self.queued += 1
+            pending = self._pending.get(fbid)
+            if pending is not None:
+                self.coalesced += 1
+                if _people_count(match) < _people_count(pending):
+                    continue
+            # Copied so the caller's dict isn't modified by the writer
+            self._pending[fbid] = dict(match)
+
+        if len(self._pending) >= self.flush_size:
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.flush_size:
+                    self._cond.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _write(self, batch):
+        try:
+            self.write_func(batch)
+        except Exception:
+            logger.exception('Failed to write %s match results' % len(batch))
+            return 0, len(batch)
+        return len(batch), 0
+
+    def flush(self):
+        ''' Writes everything currently buffered, returning once it, and any
+        flush already in progress, has been written. Returns the number of
+        results written.
+        '''
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            items = batch.items()
+            slices = [
+                dict(items[i::self.workers]) for i in range(self.workers)
+            ]
+            start = time.time()
+            outcomes = self._pool.map(self._write, [s for s in slices if s])
+            self.last_flush_seconds = time.time() - start
+            written = sum(ok for ok, _ in outcomes)
+            self.written += written
+            self.failed += sum(failed for _, failed in outcomes)
+            self.flushes += 1
+            return written
+
+    def close(self):
+        ''' Flushes any buffered results and stops the background threads '''
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        _open_queues.discard(self)
+        self._thread.join()
+        self.flush()
+        self._pool.close()
+        self._pool.join()
+
+    def metrics(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'written': self.written,
+            'failed': self.failed,
+            'flushes': self.flushes,
+            'last_flush_seconds': self.last_flush_seconds,
+        }
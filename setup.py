@@ -22,7 +22,11 @@ setup(
     zip_safe=False,
     install_requires=install_requires,
     include_package_data=True,
-    entry_points={},
+    entry_points={
+        'console_scripts': [
+            'civis-match = civis_matcher.cli:main',
+        ],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',